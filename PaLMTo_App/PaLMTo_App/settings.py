@@ -145,4 +145,127 @@ MEDIA_ROOT = BASE_DIR / 'media'
 MEDIA_URL = '/media/'
 
 # Size limit of uploaded files set at 500MB. Default 2.5MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 500 * 1024 * 1024
\ No newline at end of file
+FILE_UPLOAD_MAX_MEMORY_SIZE = 500 * 1024 * 1024
+
+# Memory budget shared by concurrent n-gram and generation jobs. None uses 75% of physical memory
+JOB_MEMORY_BUDGET_MB = None
+
+# "queue" holds jobs that don't fit until memory frees up, "reject" turns them away immediately
+JOB_ADMISSION_MODE = 'queue'
+
+# Maximum number of jobs waiting for memory and how long each may wait in seconds
+JOB_ADMISSION_MAX_QUEUED = 8
+JOB_ADMISSION_TIMEOUT = 600
+
+# Worker processes sampling trajectories in parallel. None uses every available core
+GENERATION_WORKERS = None
+
+# Uploads of at least this size build n-grams out of core, unless a request sets "ingest_mode"
+INGEST_CHUNKED_THRESHOLD_MB = 512
+
+# Trajectories parsed per chunk by out-of-core n-gram builds
+INGEST_CHUNK_ROWS = 20000
+
+# Compress downloadable csv and cache files in the background as soon as they are written
+DOWNLOAD_PRECOMPRESS = True
+
+# Files smaller than this many bytes are always served uncompressed
+DOWNLOAD_COMPRESS_MIN_BYTES = 1024
+
+# Load generated and matched trajectories into a spatially indexed SQLite store for bbox queries
+TRAJECTORY_SPATIAL_INDEX = True
+
+# Location of that store. None keeps it in MEDIA_ROOT
+TRAJECTORY_STORE_PATH = None
+
+# Seconds between points of trajectories with a start "timestamp", used for their end time
+TRAJECTORY_SAMPLING_SECONDS = 15
+
+# Trajectories per task of imputation jobs and the longest cell path filled into one gap
+IMPUTATION_BATCH_ROWS = 2000
+IMPUTATION_MAX_HOPS = 100
+
+# Budget of one origin-destination pair in bidirectional point-to-point generation: cells
+# expanded by the searches. Pairs exceeding it are abandoned; being counted in steps rather
+# than time, the budget keeps output of a seed reproducible
+POINT_TO_POINT_MAX_STEPS = 20000
+
+# Landmarks whose hop distances bound path lengths in the reachability index of n-gram caches
+GRAPH_LANDMARKS = 8
+
+# Warm up serving processes at startup: import heavy dependencies and load the listed cache
+# files (names in MEDIA_ROOT/cache) with their samplers. /ready answers 503 until done
+STARTUP_WARMUP = False
+PRELOAD_NGRAM_CACHES = []
+
+# Loaded models kept in memory besides preloaded ones, least recently used dropped first
+MODEL_REGISTRY_SIZE = 2
+
+# Budgets of trajectories drawn for map previews (features and total points) and of the
+# points counted into each heatmap, which keep payloads bounded for any dataset size
+VISUALIZATION_MAX_FEATURES = 2000
+VISUALIZATION_MAX_POINTS = 100_000
+HEATMAP_MAX_POINTS = 1_000_000
+
+# Wall-clock limit in seconds of each kind of job, None for no limit. A job past its limit
+# stops at its next checkpoint and removes its partial output, as if cancelled via trajectory/cancel/
+JOB_TIMEOUTS = {
+    'ngrams': 3600,
+    'generate': 1800,
+    'batch': 3600,
+    'impute': 3600,
+    'map_match': 3600,
+}
+
+# Seconds that status and final results of background jobs are kept after their last update
+# for clients polling trajectory/jobs/<task_id> or reconnecting to the progress stream
+JOB_RESULT_TTL_SECONDS = 24 * 3600
+
+# Byte quotas of media sub-folders, None for no limit. Serving processes evict the least
+# recently used files of a folder over its quota every STORAGE_SWEEP_INTERVAL_SECONDS,
+# sparing pinned files and files used within STORAGE_EVICTION_GRACE_SECONDS. User inputs
+# that can't be regenerated, i.e. "uploads" and "networks", have no quota by default
+STORAGE_QUOTAS = {
+    'cache': 20 * 1024 ** 3,
+    'cache/uploaded': 20 * 1024 ** 3,
+    'generated': 50 * 1024 ** 3,
+    'matched': 10 * 1024 ** 3,
+    'imputed': 20 * 1024 ** 3,
+    'compressed': 10 * 1024 ** 3,
+}
+STORAGE_SWEEP_INTERVAL_SECONDS = 300
+STORAGE_EVICTION_GRACE_SECONDS = 3600
+
+# Cache files never evicted. Preloaded caches and caches renamed by users are pinned as well
+STORAGE_PINNED_CACHES = []
+
+# Seconds a progress queue may stay unused after its job stopped before it is dropped
+PROGRESS_QUEUE_IDLE_SECONDS = 600
+
+# Serve n-gram caches from memory-mapped bundles shared by all worker processes, instead of
+# unpickling a private copy in each. A cache is published on first use under MODEL_SHARED_DIR,
+# cache/shared in MEDIA_ROOT by default, and its bundle removed once replaced and unused
+MODEL_SHARING = False
+MODEL_SHARED_DIR = None
+
+# Dry run recommending a cell size: candidate sizes in meters, trajectories sampled from the
+# upload, and the mean number of times each distinct trigram should be observed
+CELL_SIZE_CANDIDATES = [100, 150, 200, 300, 500, 750, 1000, 1500, 2000]
+CELL_SIZE_SAMPLE_TRIPS = 2000
+CELL_SIZE_MIN_TRIGRAM_SUPPORT = 5
+# Uploads up to this size are scanned in full for the bounds of the grid; the grid sizes of
+# larger ones are predicted from the sample's bounds and are lower bounds
+CELL_SIZE_BOUNDS_SCAN_MB = 256
+
+# Offline map matching: default road network in MEDIA_ROOT/networks (GeoJSON or OSM XML; None
+# keeps the public OSRM service), candidate search radius, GPS noise and route-difference scale
+# in meters, candidate edges per point and trajectories matched per worker task
+MAP_MATCHING_NETWORK = None
+MAP_MATCHING_SEARCH_RADIUS_M = 100
+MAP_MATCHING_GPS_SIGMA_M = 25
+MAP_MATCHING_BETA_M = 50
+MAP_MATCHING_CANDIDATES = 8
+MAP_MATCHING_BATCH_ROWS = 100
+
+# OSRM server matching trajectories when no road network is given
+MAP_MATCHING_OSRM_URL = 'http://router.project-osrm.org'
@@ -17,9 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from trajectory.views import metrics, readiness
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('trajectory/', include('trajectory.urls')),  # Trajectory API endpoints with trajectory prefix
+    path('metrics', metrics, name='metrics'),   # Prometheus scrape target
+    path('ready', readiness, name='ready'),     # Load balancer readiness probe
     path('', TemplateView.as_view(template_name='index.html')),  # React frontend
 ]
@@ -11,6 +11,10 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from trajectory.apps import serve_requests
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'PaLMTo_App.settings')
 
+# Starts housekeeping and warm-up once the app is ready
+serve_requests()
 application = get_wsgi_application()
@@ -103,7 +103,11 @@ function App() {
          isDragActive: isSampleDragActive} = useDropzone({
     onDrop: handleSampleFileDrop,
     multiple: false,
-    accept: {"text/csv": [".csv"]},
+    accept: {
+      "text/csv": [".csv"],
+      "application/vnd.apache.parquet": [".parquet"],
+      "application/vnd.apache.arrow.file": [".feather", ".arrow"],
+    },
   });
 
   // Second drag zone instance for cache files
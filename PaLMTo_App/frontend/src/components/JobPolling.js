@@ -0,0 +1,42 @@
+/*
+  This JS function polls the status of a background job until it has ended, for clients that lost its progress stream.
+*/
+
+// Milliseconds between two polls of a running job
+const POLL_INTERVAL_MS = 2000;
+
+// Consecutive failed polls after which the job is given up
+const MAX_FAILED_POLLS = 5;
+
+async function waitForJob(taskId, onProgress) {
+  // Resolve to the final progress event of a job, or null if it is unknown, expired or unreachable
+  let failures = 0;
+  while (failures < MAX_FAILED_POLLS) {
+    try {
+      const response = await fetch(`${process.env.REACT_APP_API_URL}/trajectory/jobs/${taskId}`);
+      if (response.status === 404) {
+        return null;
+      }
+      if (response.ok) {
+        const job = await response.json();
+        failures = 0;
+        if (job.event) {
+          return job.event;
+        }
+        // Still queued or running, so report where it is and ask again later
+        if (onProgress) {
+          onProgress({ type: 'progress', progress: job.progress, message: job.message });
+        }
+      } else {
+        failures += 1;
+      }
+    } catch (e) {
+      console.error('Fetching job status failed:', e);
+      failures += 1;
+    }
+    await new Promise(resolve => setTimeout(resolve, POLL_INTERVAL_MS));
+  }
+  return null;
+}
+
+export default waitForJob;
@@ -6,6 +6,7 @@ import axios from "axios";
 import { FiDownload } from "react-icons/fi";
 import MapMatchInputModal from "./mapMatchInput";
 import Trajectory3DViewer from "./trajectory3DViewer";
+import waitForJob from "./jobPolling";
 
 const LocationSelectionMap = ({ mapCenter, locationCoordinates, onLocationSelect }) => (
   <div className="map-container">
@@ -68,6 +69,27 @@ function getRandomColor() {
   return '#' + Math.floor(Math.random() * 16777215).toString(16).padStart(6, '0');
 }
 
+async function loadMatchedFeatures(filename) {
+  // Page through the stored trajectories of a matched file and rebuild its features
+  const features = [];
+  let after = 0;
+  while (after !== null) {
+    const response = await fetch(`${process.env.REACT_APP_API_URL}/trajectory/trajectories/search` +
+      `?dataset=${encodeURIComponent(filename)}&limit=1000&after=${after}`);
+    if (!response.ok) {
+      throw new Error(`Search failed with status ${response.status}`);
+    }
+    const page = await response.json();
+    page.results.forEach(result => features.push({
+      type: 'Feature',
+      properties: { trip_id: result.trip_id },
+      geometry: result.geometry
+    }));
+    after = page.next;
+  }
+  return { type: 'FeatureCollection', features };
+}
+
 function onEachSnappedFeature(feature, layer) {
   // Add a popup window to each trajectory when hovered
   if (feature.properties && feature.properties.trip_id) {
@@ -76,10 +98,11 @@ function onEachSnappedFeature(feature, layer) {
   }
 }
 
-const  MapMatchingMap = ({ title, data, center, onDownload, perc, bounce }) => (
+const  MapMatchingMap = ({ title, data, center, onDownload, perc, bounce, status }) => (
   <div style={{ flex: 1 }}>
     <h3 style={{ textAlign: "center" }}>
       {title} {perc !== undefined && `(${perc}% Processed)`}
+      {status && <span style={{ fontSize: '14px', color: '#666', marginLeft: '12px' }}>{status}</span>}
     </h3>
     <div className="map-container" style={{ height: 'calc(100% - 40px)' }}>
       <MapContainer center={center} zoom={15} style={{ height: "100%", width: "100%" }}>
@@ -125,6 +148,9 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
   // Declare a state variable for status of fetching map matching data
   const [mapMatchLoading, setMapMatchLoading] = useState(false);
 
+  // Declare a state variable for latest progress message of map matching
+  const [mapMatchMessage, setMapMatchMessage] = useState('');
+
   // Declare a state variable for filename of matched trajectories saved in csv
   const [matchedTrajFile, setMatchedTrajFile] = useState(''); 
 
@@ -148,21 +174,84 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
 
 
   // ? Consider moving data fetching logic to a separate script
+  const streamMapMatching = useCallback((taskId) => {
+    const eventSource = new EventSource(`${process.env.REACT_APP_API_URL}/trajectory/progress/?task_id=${taskId}`);
+
+    const handleProgressEvent = (data) => {
+      switch (data.type) {
+        case 'progress':
+          setMapMatchMessage(data.message);
+          // Features of each batch arrive as soon as it is matched
+          if (data.features && data.features.length) {
+            setMapMatchData(prev => ({
+              type: 'FeatureCollection',
+              features: [...(prev ? prev.features : []), ...data.features]
+            }));
+          }
+          break;
+        case 'complete':
+          setMatchedTrajFile(data.result.output_file);
+          setMapMatchData(prev => prev || { type: 'FeatureCollection', features: [] });
+          setMapMatchMessage(data.message);
+          setMapMatchLoading(false);
+          eventSource.close();
+          break;
+        case 'error':
+        case 'cancelled':
+          console.error('Map matching failed: ', data.message);
+          setMapMatchMessage(data.message);
+          setMapMatchLoading(false);
+          eventSource.close();
+          break;
+        default:
+          break;
+      }
+    };
+
+    eventSource.onmessage = (event) => {
+      handleProgressEvent(JSON.parse(event.data));
+    };
+
+    eventSource.onerror = async (error) => {
+      console.error('EventSource failed:', error);
+      eventSource.close();
+
+      // The job keeps running on the server; poll it until it has ended
+      const finalEvent = await waitForJob(taskId, handleProgressEvent);
+      if (finalEvent) {
+        handleProgressEvent(finalEvent);
+        if (finalEvent.type === 'complete') {
+          // Features of batches streamed while disconnected were missed, so redraw from the output file
+          try {
+            setMapMatchData(await loadMatchedFeatures(finalEvent.result.output_file));
+          } catch (e) {
+            console.error('Failed to load matched trajectories: ', e);
+            setMapMatchMessage('Map matching completed, but the map only shows the trajectories received before the connection was lost');
+          }
+        }
+        return;
+      }
+      setMapMatchMessage('Lost track of the map-matching job');
+      setMapMatchLoading(false);
+    };
+  }, []);
+
   const fetchMapMatchingData = useCallback(async (percentage) => {
     setMapMatchLoading(true);
+    setMapMatchData(null);
+    setMapMatchMessage('');
+    setMatchedTrajFile('');
     try {
       const response = await axios.post('trajectory/map-match/', {
         filename: generatedFileName,
         percentage: percentage
       });
-      setMapMatchData(response.data.map_data);
-      setMatchedTrajFile(response.data.output_file)
+      streamMapMatching(response.data.task_id);
     } catch (error) {
-      console.error('Failed to fetch map-matching data: ', error);
-    } finally {
+      console.error('Failed to start map matching: ', error);
       setMapMatchLoading(false);
     }
-  }, [generatedFileName]);
+  }, [generatedFileName, streamMapMatching]);
 
   // Show input box when switching to map-matching view
   const handleMapMatchView = () => {
@@ -202,10 +291,10 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
 
   // Set up a side effect that calls bounce 
   useEffect(() => {
-    if (generatedFileName || mapMatchData) {
+    if (generatedFileName || matchedTrajFile) {
       triggerBounce();
     }
-  }, [generatedFileName, mapMatchData])
+  }, [generatedFileName, matchedTrajFile])
 
   const ViewBtns = () => {
     const snapshots = [
@@ -376,7 +465,7 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
         </div>
       ) : viewMode === 'map-matching' && generatedFileName ? (
         <div style={{ display: 'flex', height: '600px', marginTop: '10px'}}>
-          {mapMatchLoading ? (
+          {mapMatchLoading && !mapMatchData ? (
             <div style={{
               display: 'flex',
               flexDirection: 'row',
@@ -386,7 +475,7 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
               width: '100%',
               fontSize: '18px',
               color: '#666'}}>
-              <div>Generating map-matching data...</div>
+              <div>{mapMatchMessage || 'Generating map-matching data...'}</div>
               <div className="spinner" style={{
                 marginLeft: '24px',
                 width: '40px',
@@ -402,12 +491,13 @@ function MapSection({ mapCenter, locationCoordinates, onLocationSelect, visualDa
               title="Map-matched Trajectories"
               data={mapMatchData}
               center={visualData.center}
-              onDownload={() => {
+              onDownload={matchedTrajFile ? () => {
                 setPendingDownloadFile(matchedTrajFile);
                 setSaveAsFilename(matchedTrajFile);
                 setShowSaveAsModal(true);
-              }}
+              } : null}
               perc={mapMatchPerc}
+              status={mapMatchLoading ? mapMatchMessage : null}
               bounce={bounceDownload}
             />
           ) : (
@@ -71,7 +71,7 @@ function FormSteps({
         <label className="required">
           File Upload
           <span className="required-mark">*</span>
-          <FiInfo title="Sample trajectory which synthetic trajectories will be generated from. Must be a csv file with three columns: 'trip_id', 'timestamp', 'geometry'" className="info-icon"/>
+          <FiInfo title="Sample trajectory which synthetic trajectories will be generated from. Must be a csv, parquet or feather file with three columns: 'trip_id', 'timestamp', 'geometry'" className="info-icon"/>
         </label>
         <div className="dropzone-row">
           {/* Dropzone for sample trajectory file  */}
@@ -249,7 +249,8 @@ function FormSteps({
           Generation Method <span className="required-mark">*</span>
           <FiInfo 
             title="Approach via which trajectories should be generated. 'Length-constrained' method generates new
-            trajectories with a predefined length; 'Point-to-Point' fills the gap between two bigrams" 
+            trajectories with a predefined length; 'Point-to-Point' fills the gap between two bigrams; 'Bidirectional'
+            searches from both bigrams at once and skips pairs it cannot join within its budget" 
             className="info-icon"
           />
         </label>
@@ -262,6 +263,7 @@ function FormSteps({
           <option value="">Select a Method</option>
           <option value="length_constrained">Length Constrained</option>
           <option value="point_to_point">Point to Point</option>
+          <option value="bidirectional">Point to Point (Bidirectional)</option>
         </select>
       </div>
 
@@ -277,9 +279,9 @@ function FormSteps({
           onChange={handleChange} 
           step="100"
           min="100"
-          disabled={formData.generation_method === "point_to_point" || formData.generation_method === ""}
-          className={formData.generation_method === "point_to_point" ? "disabled-input" : ""}
-          required={formData.generation_method !== "point_to_point"}
+          disabled={formData.generation_method !== "length_constrained"}
+          className={formData.generation_method !== "length_constrained" ? "disabled-input" : ""}
+          required={formData.generation_method === "length_constrained"}
         />
       </div>
 
@@ -1,5 +1,6 @@
 import { useState } from "react";
 import axios from "axios";
+import waitForJob from "./jobPolling";
 
 function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
     setGeneratedFileName, setVisualData, setHeatmapData, setFormData) {
@@ -122,8 +123,10 @@ function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
 
         // Listen for messages
         eventSource.onmessage = (event) => {
-            const data = JSON.parse(event.data);
+            handleProgressEvent(JSON.parse(event.data));
+        };
 
+        const handleProgressEvent = (data) => {
             switch (data.type) {
                 case 'progress':
                     setProgress(data.progress);
@@ -152,6 +155,7 @@ function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
                     eventSource.close();
                     break;
                 case 'error':
+                case 'cancelled':
                     setNotification({
                         type: 'error',
                         message: data.message
@@ -167,14 +171,22 @@ function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
         };
 
         // Listen for errors 
-        eventSource.onerror = (error) => {
+        eventSource.onerror = async (error) => {
             console.error('EventSource failed:', error);
+            eventSource.close();
+
+            // The job keeps running on the server; poll it until it has ended
+            const finalEvent = await waitForJob(taskId, handleProgressEvent);
+            if (finalEvent) {
+                handleProgressEvent(finalEvent);
+                return;
+            }
+
             setNotification({
                 type: 'error',
                 message: 'Connection to progress stream failed'
             });
             setIsLoading(false);
-            eventSource.close();
         };
 
         return eventSource;
@@ -257,7 +269,7 @@ function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
                 payload.append("generation_method", formData.generation_method);
                 payload.append("cache_file", formData.cache_file);
 
-                if (formData.generation_method !== "point_to_point" && formData.trajectory_len) {
+                if (formData.generation_method === "length_constrained" && formData.trajectory_len) {
                     payload.append("trajectory_len", formData.trajectory_len);
                 }
 
@@ -280,11 +292,13 @@ function UnifiedFormSubmit(formData, setCurrentStep, setShowStats, setStatsData,
                 }
             }
         } catch (error) {
+            // Surface backend explanations such as memory admission rejections
+            const serverMessage = error.response?.data?.error;
             setNotification({
                 type: 'error',
-                message: currentStep === 2
+                message: serverMessage || (currentStep === 2
                     ? 'Failed to create ngram dictionaries. Please try again.'
-                    : 'Failed to generate trajectories. Please try again.'
+                    : 'Failed to generate trajectories. Please try again.')
             });
             setIsLoading(false);
         }
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import GeneratedTrajectory, GenerationConfig
+from .models import GeneratedTrajectory, GenerationConfig, JobMemoryRecord, JobResult
 
 @admin.register(GenerationConfig)
 class ConfigAdmin(admin.ModelAdmin):
@@ -16,3 +16,18 @@ class GeneratedTrajectoryAdmin(admin.ModelAdmin):
     search_fields = ('generated_file', )
     ordering = ('-created_at', )
 
+
+@admin.register(JobMemoryRecord)
+class JobMemoryRecordAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'task_id', 'estimated_bytes', 'peak_bytes', 'created_at')
+    list_filter = ('created_at', 'kind', )
+    search_fields = ('task_id', )
+    ordering = ('-created_at', )
+
+
+@admin.register(JobResult)
+class JobResultAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'task_id', 'status', 'progress', 'created_at', 'expires_at')
+    list_filter = ('created_at', 'kind', 'status', )
+    search_fields = ('task_id', )
+    ordering = ('-created_at', )
@@ -0,0 +1,482 @@
+"""
+    Memory-aware admission control for n-gram building, trajectory generation, imputation and map matching jobs
+"""
+import os
+import csv
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+from .cancellation import checkpoint
+from .formats import count_rows, format_of, iter_trajectory_batches, parse_geometry
+from .generation import CHUNK_SIZE, generation_workers
+from .metrics import PeakRssSampler, trim_heap
+from .registry import REGISTRY
+
+# Per-unit memory coefficients in bytes. They are deliberately rough; the calibration
+# factor learnt from recorded jobs corrects them for the deployment at hand.
+NGRAM_BASE_BYTES = 64 * 1024 * 1024
+NGRAM_BYTES_PER_FILE_BYTE = 3
+NGRAM_BYTES_PER_POINT = 700      # Shapely point, exploded GeoDataFrame row and spatial join
+NGRAM_BYTES_PER_CELL = 2500      # Grid polygon, centroid and ID tuple
+NGRAM_BYTES_PER_NGRAM = 64       # Packed int64 key and count, doubled while merging chunk counts
+NGRAM_NGRAMS_PER_CELL = 16       # Distinct bigrams and trigrams rarely exceed this per cell
+
+GENERATION_BASE_BYTES = 64 * 1024 * 1024
+GENERATION_BYTES_PER_CACHE_BYTE = 2     # Cache arrays plus the sampler's context indexes
+GENERATION_BYTES_PER_POINT = 200        # Sampled token plus its [lon, lat] list in the output frame
+POINT_TO_POINT_AVG_LEN = 60
+
+IMPUTATION_BYTES_PER_POINT = 400        # Input and imputed [lon, lat] lists of a batch in flight
+IMPUTATION_SEARCH_BYTES = 12 * 2 ** 22  # Distances and predecessors of one block of path searches
+
+MAP_MATCHING_BYTES_PER_NETWORK_BYTE = 40    # Graph arrays, adjacency lists and k-d tree of a loaded network
+MAP_MATCHING_BYTES_PER_POINT = 300          # [lon, lat] lists of the input frame plus matched geometry
+
+# Number of rows read from an upload to extrapolate its point count and extent
+SAMPLE_ROWS = 500
+
+# Bounds of the learnt correction factor and how many recent jobs feed it
+MIN_CALIBRATION = 0.25
+MAX_CALIBRATION = 4.0
+CALIBRATION_WINDOW = 50
+CALIBRATION_MIN_JOBS = 5
+
+# Seconds a job waiting for memory sleeps between two checks of its cancellation
+WAIT_POLL_SECONDS = 1.0
+
+
+class AdmissionRejected(Exception):
+    """Raised when a job cannot be admitted under the configured memory budget."""
+
+    def __init__(self, message, status_code=503):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class JobEstimate:
+    """Predicted peak memory of a job along with the features it was derived from.
+
+    Attributes:
+        shared(bool): set once another job ran at the same time, whose memory can't be
+            told apart from this one's
+    """
+
+    def __init__(self, kind, raw_bytes, features):
+        self.kind = kind
+        self.raw_bytes = int(raw_bytes)
+        self.features = features
+        self.bytes = int(raw_bytes * calibration_factor(kind))
+        self.shared = False
+
+    def __repr__(self):
+        return f"JobEstimate({self.kind}, {self.bytes / 1024 ** 2:.0f}MB)"
+
+
+def _format_mb(num_bytes):
+    return f"{num_bytes / (1024 * 1024):.0f}MB"
+
+
+def memory_budget():
+    """Return memory budget for concurrent jobs in bytes.
+
+    Uses JOB_MEMORY_BUDGET_MB when configured, otherwise 75% of physical memory.
+    """
+    budget_mb = getattr(settings, 'JOB_MEMORY_BUDGET_MB', None)
+    if budget_mb:
+        return int(budget_mb * 1024 * 1024)
+    try:
+        return int(os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * 0.75)
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def sample_trajectory_file(file_path, cell_size):
+    """Extrapolate point and cell counts of a trajectory file from its first rows.
+
+    Args:
+        file_path(str): path of uploaded trajectory file
+        cell_size(int): side length of grid cells in meters
+
+    Returns:
+        tuple: estimated number of points, number of grid cells and number of rows
+
+    Raises:
+        ValueError: if the geometries of the sampled rows can't be parsed
+    """
+    file_size = os.path.getsize(file_path)
+    if format_of(file_path) != 'csv':
+        return _sample_columnar_file(file_path, cell_size)
+
+    sampled_bytes = 0
+    values = []
+
+    csv.field_size_limit(min(file_size, 2 ** 31 - 1) or 1)
+    with open(file_path, newline='') as f:
+        reader = csv.DictReader(f)
+        for i, row in enumerate(reader):
+            if i >= SAMPLE_ROWS:
+                break
+            sampled_bytes += sum(len(value) for value in row.values() if value) + len(row)
+            values.append(row.get('geometry') or '[]')
+    rows = len(values)
+
+    # Same parser as the n-gram build, which accepts Python-style lists too
+    try:
+        trajs = parse_geometry(np.array(values, dtype=object)) if values else []
+    except (ValueError, SyntaxError):
+        raise ValueError(f"Geometry column of {os.path.basename(file_path)} is not a list of [lon, lat] points")
+    coords = [point for traj in trajs for point in traj]
+    points = len(coords)
+    if not sampled_bytes or not points:
+        return 0, 0, 0
+    min_lon, min_lat = np.min(coords, axis=0)
+    max_lon, max_lat = np.max(coords, axis=0)
+
+    est_points = int(points * file_size / sampled_bytes)
+    est_rows = int(rows * file_size / sampled_bytes)
+
+    return est_points, _estimate_cells(min_lon, min_lat, max_lon, max_lat, cell_size), max(est_rows, 1)
+
+
+def _sample_columnar_file(file_path, cell_size):
+    """Extrapolate point and cell counts of a Parquet or Feather file from its first batch."""
+    total_rows = count_rows(file_path)
+    _, coords, lengths = next(iter_trajectory_batches(file_path, SAMPLE_ROWS, columns=('geometry',)), (None, None, []))
+    if not len(lengths) or not lengths.sum():
+        return 0, 0, 0
+
+    est_points = int(lengths.sum() * total_rows / len(lengths))
+    min_lon, min_lat = coords.min(axis=0)
+    max_lon, max_lat = coords.max(axis=0)
+    return est_points, _estimate_cells(min_lon, min_lat, max_lon, max_lat, cell_size), max(total_rows, 1)
+
+
+def _estimate_cells(min_lon, min_lat, max_lon, max_lat, cell_size):
+    """Approximate number of grid cells covering an extent using an equirectangular projection."""
+    mean_lat = math.radians((min_lat + max_lat) / 2)
+    width = max(max_lon - min_lon, 0) * 111320 * math.cos(mean_lat)
+    height = max(max_lat - min_lat, 0) * 110540
+    return int(max(width / cell_size, 1) * max(height / cell_size, 1))
+
+
+def estimate_ngram_job(file_path, cell_size, chunk_rows=None):
+    """Estimate peak memory of building n-grams from an uploaded trajectory file.
+
+    Args:
+        file_path(str): path of uploaded trajectory file
+        cell_size(int): side length of grid cells in meters
+        chunk_rows(int): rows per chunk of an out-of-core build, None when the file is
+            loaded into memory at once
+    """
+    file_size = os.path.getsize(file_path)
+    try:
+        points, cells, rows = sample_trajectory_file(file_path, cell_size)
+    except (OSError, ValueError, TypeError):
+        points, cells, rows = file_size // 20, 0, 1
+    return ngram_estimate(file_size, points, cells, rows, chunk_rows)
+
+
+def ngram_estimate(file_size, points, cells, rows, chunk_rows=None):
+    """Estimate peak memory of building n-grams from the features of a trajectory file.
+
+    Args:
+        file_size(int): size of the file in bytes
+        points(int): number of points in the file
+        cells(int): number of grid cells
+        rows(int): number of trajectories in the file
+        chunk_rows(int): rows per chunk of an out-of-core build, None for an in-memory one
+    """
+    if chunk_rows is None:
+        raw = (NGRAM_BASE_BYTES + file_size * NGRAM_BYTES_PER_FILE_BYTE +
+               points * NGRAM_BYTES_PER_POINT + cells * NGRAM_BYTES_PER_CELL)
+        kind = 'ngram'
+    else:
+        # Only one chunk is materialized at a time; what grows with the data is the model
+        fraction = min(chunk_rows / rows, 1)
+        ngrams = min(points, cells * NGRAM_NGRAMS_PER_CELL)
+        raw = (NGRAM_BASE_BYTES + fraction * (file_size * NGRAM_BYTES_PER_FILE_BYTE + points * NGRAM_BYTES_PER_POINT) +
+               cells * NGRAM_BYTES_PER_CELL + ngrams * NGRAM_BYTES_PER_NGRAM)
+        kind = 'ngram_chunked'
+    return JobEstimate(kind, raw, {
+        'input_bytes': file_size,
+        'points': points,
+        'cells': cells
+    })
+
+
+def _loaded_copies(cache_path):
+    """Return 0 if the job will find its model already held by the registry, else 1."""
+    cache_file = os.path.relpath(cache_path, os.path.join(settings.MEDIA_ROOT, "cache"))
+    return 0 if REGISTRY.holds(cache_file) else 1
+
+
+def _generation_estimate(cache_path, points, num_trajs, workers):
+    cache_size = os.path.getsize(cache_path) if os.path.exists(cache_path) else 0
+
+    # Every sampling worker holds its own copy of the compiled generator, and the job
+    # loads one more unless the registry already holds it
+    copies = _loaded_copies(cache_path) + workers
+    raw = (GENERATION_BASE_BYTES + cache_size * GENERATION_BYTES_PER_CACHE_BYTE * copies +
+           points * GENERATION_BYTES_PER_POINT)
+    return JobEstimate('generation', raw, {
+        'input_bytes': cache_size,
+        'points': points,
+        'num_trajectories': num_trajs
+    })
+
+
+def estimate_generation_job(cache_path, num_trajs, traj_len=0):
+    """Estimate peak memory of generating trajectories from a cached n-gram file.
+
+    Requests of more than one chunk are sampled by a pool of up to one worker per chunk.
+    """
+    points = num_trajs * (traj_len or POINT_TO_POINT_AVG_LEN)
+    workers = min(generation_workers(), math.ceil(num_trajs / CHUNK_SIZE))
+    return _generation_estimate(cache_path, points, num_trajs, workers if workers > 1 else 0)
+
+
+def estimate_batch_generation_job(cache_path, configs, workers):
+    """Estimate peak memory of sampling several configs in parallel from one cached model.
+
+    Args:
+        cache_path(str): path of cached n-gram file
+        configs(list): tuples of (generation_method, num_trajectories, trajectory_len)
+        workers(int): number of sampling worker processes
+    """
+    points = sum(num_trajs * (traj_len or POINT_TO_POINT_AVG_LEN) for _, num_trajs, traj_len in configs)
+    num_trajs = sum(config[1] for config in configs)
+    return _generation_estimate(cache_path, points, num_trajs, workers if workers > 1 else 0)
+
+
+def estimate_imputation_job(cache_path, file_path, batch_rows, workers):
+    """Estimate peak memory of imputing the trajectories of a file against a cached model.
+
+    Only the size of the cache is read, so the estimate never unpickles it.
+
+    Args:
+        cache_path(str): path of cached n-gram file
+        file_path(str): path of uploaded file of gapped trajectories
+        batch_rows(int): trajectories imputed per task
+        workers(int): number of imputation worker processes
+    """
+    cache_size = os.path.getsize(cache_path) if os.path.exists(cache_path) else 0
+    try:
+        points, _, rows = sample_trajectory_file(file_path, 1000)
+    except (OSError, ValueError, TypeError):
+        points, rows = os.path.getsize(file_path) // 20, 1
+
+    # Every worker holds its own copy of the model, as does the job unless the registry
+    # already holds it; results are written as they arrive, so only the batches in
+    # flight hold points
+    pool = workers if workers > 1 else 0
+    in_flight = min((2 * pool + 1) * batch_rows / rows, 1)
+    copies = _loaded_copies(cache_path) + pool
+    raw = (GENERATION_BASE_BYTES + cache_size * GENERATION_BYTES_PER_CACHE_BYTE * copies +
+           max(pool, 1) * IMPUTATION_SEARCH_BYTES + in_flight * points * IMPUTATION_BYTES_PER_POINT)
+    return JobEstimate('imputation', raw, {
+        'input_bytes': os.path.getsize(file_path),
+        'points': points,
+        'cells': 0,
+        'num_trajectories': rows
+    })
+
+
+def estimate_map_matching_job(file_path, network_path, workers):
+    """Estimate peak memory of map matching the trajectories of a file.
+
+    Args:
+        file_path(str): path of generated trajectory file
+        network_path(str): path of road network file, None when matching with OSRM
+        workers(int): number of matching worker processes
+    """
+    try:
+        points, _, rows = sample_trajectory_file(file_path, 1000)
+    except (OSError, ValueError, TypeError):
+        points, rows = os.path.getsize(file_path) // 20, 1
+
+    # The whole file is read before sampling; every worker holds its own copy of the network
+    network_size = os.path.getsize(network_path) if network_path else 0
+    pool = workers if network_path and workers > 1 else 0
+    raw = (GENERATION_BASE_BYTES + network_size * MAP_MATCHING_BYTES_PER_NETWORK_BYTE * (1 + pool) +
+           points * MAP_MATCHING_BYTES_PER_POINT)
+    return JobEstimate('map_matching', raw, {
+        'input_bytes': os.path.getsize(file_path),
+        'points': points,
+        'cells': 0,
+        'num_trajectories': rows
+    })
+
+
+def calibration_factor(kind):
+    """Learn a multiplier for raw estimates from peak usage recorded by recent jobs.
+
+    The 90th percentile of actual-to-estimated ratios keeps the estimator on the
+    conservative side while still adapting to the data users actually upload.
+    """
+    from .models import JobMemoryRecord
+
+    try:
+        ratios = sorted(
+            record.peak_bytes / record.raw_bytes
+            for record in JobMemoryRecord.objects.filter(kind=kind, raw_bytes__gt=0)
+                                                 .order_by('-created_at')[:CALIBRATION_WINDOW]
+        )
+    except Exception:
+        # Table may not exist yet, e.g. before migrations are applied
+        return 1.0
+
+    if len(ratios) < CALIBRATION_MIN_JOBS:
+        return 1.0
+
+    factor = ratios[min(int(len(ratios) * 0.9), len(ratios) - 1)]
+    return min(max(factor, MIN_CALIBRATION), MAX_CALIBRATION)
+
+
+class AdmissionController:
+    """Track memory reserved by running jobs and admit new ones within a budget.
+
+    In "queue" mode jobs that don't fit wait until enough memory is released; in
+    "reject" mode they are turned away immediately.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._reserved = 0
+        self._waiting = 0
+        self._running = []
+
+    @property
+    def mode(self):
+        return getattr(settings, 'JOB_ADMISSION_MODE', 'queue')
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'budget_bytes': memory_budget(),
+                'reserved_bytes': self._reserved,
+                'waiting_jobs': self._waiting
+            }
+
+    def check(self, estimate):
+        """Reject a job up front if it can never run or should not wait.
+
+        Raises:
+            AdmissionRejected: with a message that explains the decision to the user
+        """
+        budget = memory_budget()
+        if estimate.bytes > budget:
+            raise AdmissionRejected(
+                f"Job needs about {_format_mb(estimate.bytes)} of memory, which exceeds the "
+                f"server budget of {_format_mb(budget)}. Try a larger cell size, a smaller "
+                f"file or fewer trajectories.", status_code=413)
+
+        with self._cond:
+            fits = self._reserved + estimate.bytes <= budget
+            if fits:
+                return
+            if self.mode == 'reject':
+                raise AdmissionRejected(
+                    f"Server is busy: {_format_mb(self._reserved)} of {_format_mb(budget)} is in use "
+                    f"and this job needs about {_format_mb(estimate.bytes)}. Please retry later.")
+            max_queued = getattr(settings, 'JOB_ADMISSION_MAX_QUEUED', 8)
+            if self._waiting >= max_queued:
+                raise AdmissionRejected(
+                    f"Server is busy with {self._waiting} queued jobs. Please retry later.")
+
+    def acquire(self, estimate, on_wait=None):
+        """Block until a job's estimated memory fits into the budget and reserve it.
+
+        A waiting job wakes up every WAIT_POLL_SECONDS to pass a cancellation checkpoint.
+        """
+        timeout = getattr(settings, 'JOB_ADMISSION_TIMEOUT', 600)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._reserved + estimate.bytes > memory_budget():
+                if on_wait is not None:
+                    on_wait()
+                self._waiting += 1
+                try:
+                    while self._reserved + estimate.bytes > memory_budget():
+                        checkpoint()
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise AdmissionRejected(
+                                f"Timed out after {timeout}s waiting for {_format_mb(estimate.bytes)} of memory.")
+                        self._cond.wait(min(remaining, WAIT_POLL_SECONDS))
+                finally:
+                    self._waiting -= 1
+            self._reserved += estimate.bytes
+            for other in self._running:
+                other.shared = estimate.shared = True
+            self._running.append(estimate)
+
+    def release(self, estimate):
+        with self._cond:
+            self._reserved = max(self._reserved - estimate.bytes, 0)
+            if estimate in self._running:
+                self._running.remove(estimate)
+            self._cond.notify_all()
+
+
+ADMISSION = AdmissionController()
+
+
+def record_usage(estimate, task_id, peak_bytes):
+    """Persist estimated and actual peak memory of a finished job."""
+    from .models import JobMemoryRecord
+
+    try:
+        JobMemoryRecord.objects.create(
+            task_id=task_id,
+            kind=estimate.kind,
+            input_bytes=estimate.features.get('input_bytes', 0),
+            points=estimate.features.get('points', 0),
+            cells=estimate.features.get('cells', 0),
+            num_trajectories=estimate.features.get('num_trajectories', 0),
+            raw_bytes=estimate.raw_bytes,
+            estimated_bytes=estimate.bytes,
+            peak_bytes=peak_bytes
+        )
+    except Exception as e:
+        print(f"Failed to record memory usage of job {task_id}: {e}")
+
+
+@contextmanager
+def admitted(estimate, task_id, queue=None):
+    """Hold a memory reservation for the duration of a job and record its peak usage.
+
+    The peak counts the job's pool workers too. It is only recorded for jobs that
+    finished and ran alone: failed, cancelled and timed-out jobs stop short of their
+    peak, and RSS growth of one process can't be split between concurrent jobs.
+
+    Args:
+        estimate(JobEstimate): predicted memory of the job
+        task_id(str): identifier of the job
+        queue(Queue): optional progress queue notified while the job waits for memory
+    """
+    def notify_wait():
+        if queue is not None:
+            queue.put({
+                'type': 'progress',
+                'message': f'Waiting for {_format_mb(estimate.bytes)} of memory to become available',
+                'progress': 5
+            })
+
+    ADMISSION.acquire(estimate, on_wait=notify_wait)
+    trim_heap()
+    sampler = PeakRssSampler(children=True).start()
+    baseline = sampler.peak
+    finished = False
+    try:
+        yield
+        finished = True
+    finally:
+        peak = sampler.stop()
+        ADMISSION.release(estimate)
+        if finished and not estimate.shared:
+            record_usage(estimate, task_id, max(peak - baseline, 0))
@@ -1,9 +1,50 @@
 """
     App-specific configuration
 """
+import os
+import sys
 
 from django.apps import AppConfig
+from django.conf import settings
+
+
+# Set by the WSGI and ASGI entry points, the processes that serve HTTP in production
+_ENTRY_POINT = False
+
+
+def serve_requests():
+    """Mark this process as serving HTTP; called by wsgi.py and asgi.py before Django is set up."""
+    global _ENTRY_POINT
+    _ENTRY_POINT = True
+
+
+def _serves_requests():
+    """Whether this process serves HTTP, as opposed to tests, scripts or management commands.
+
+    Serving processes are those started through wsgi.py or asgi.py, and the child of
+    runserver's autoreloader that handles requests. The autoreloader's parent only
+    watches files.
+    """
+    if _ENTRY_POINT:
+        return True
+    if len(sys.argv) < 2 or sys.argv[1] != 'runserver':
+        return False
+    return '--noreload' in sys.argv or os.environ.get('RUN_MAIN') == 'true'
+
 
 class TrajectoryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'trajectory'
+
+    def ready(self):
+        if not _serves_requests():
+            return
+
+        # Warm workers before traffic reaches them; see the readiness endpoint
+        if getattr(settings, 'STARTUP_WARMUP', False):
+            from .registry import REGISTRY
+            REGISTRY.start_warmup(getattr(settings, 'PRELOAD_NGRAM_CACHES', []))
+
+        # Keep media folders within their quotas and drop abandoned progress queues
+        from .storage import start_housekeeping
+        start_housekeeping()
@@ -0,0 +1,242 @@
+"""
+    Cooperative cancellation and wall-clock timeouts of background jobs
+"""
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+from django.conf import settings
+
+# Token of the job running in the current thread, checked by checkpoint()
+_CURRENT = threading.local()
+
+# Seconds between checkpoints while a job waits on a result of a worker process
+POLL_INTERVAL = 0.2
+
+
+class JobCancelled(Exception):
+    """Raised at a checkpoint of a job that was cancelled or ran out of time.
+
+    Attributes:
+        reason(str): "cancelled" when a client asked for it, "timeout" when the job
+            exceeded its wall-clock limit
+    """
+
+    def __init__(self, message, reason='cancelled'):
+        super().__init__(message)
+        self.reason = reason
+
+
+def job_timeout(kind):
+    """Return wall-clock limit in seconds of a kind of job, or None if it is unbounded.
+
+    Args:
+        kind(str): key of JOB_TIMEOUTS, e.g. "generate", "batch", "impute", "ngrams" or "map_match"
+    """
+    return getattr(settings, 'JOB_TIMEOUTS', {}).get(kind) or None
+
+
+class CancelToken:
+    """Cancellation state of one job, polled by the job itself at checkpoints.
+
+    Cleanup callbacks registered while the job runs are called in reverse order when it
+    stops at a checkpoint, undoing whatever it wrote up to that point.
+    """
+
+    def __init__(self, task_id, timeout=None):
+        self.task_id = task_id
+        self.timeout = timeout
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout if timeout else None
+        self.reason = None
+        self._event = threading.Event()
+        self._cleanups = []
+
+    def cancel(self, reason='cancelled'):
+        """Ask the job to stop at its next checkpoint. The first reason given wins."""
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel('timeout')
+        return self._event.is_set()
+
+    def check(self):
+        """Raise JobCancelled if the job was cancelled or has passed its deadline."""
+        if not self.cancelled:
+            return
+        if self.reason == 'timeout':
+            raise JobCancelled(f"Job exceeded its time limit of {self.timeout}s", reason='timeout')
+        raise JobCancelled("Job was cancelled", reason='cancelled')
+
+    def on_cancel(self, callback, *args):
+        """Register a callback undoing some output of the job if it doesn't finish."""
+        self._cleanups.append((callback, args))
+
+    def cleanup(self):
+        """Run cleanup callbacks, newest first, without letting one failure skip the rest."""
+        while self._cleanups:
+            callback, args = self._cleanups.pop()
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Cleanup of job {self.task_id} failed: {e}")
+
+
+class CancellationRegistry:
+    """Tokens of running jobs by task_id, so that a request can cancel another one's job."""
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def open(self, task_id, timeout=None):
+        token = CancelToken(task_id, timeout)
+        with self._lock:
+            self._tokens[task_id] = token
+        return token
+
+    def close(self, task_id):
+        with self._lock:
+            self._tokens.pop(task_id, None)
+
+    def get(self, task_id):
+        with self._lock:
+            return self._tokens.get(task_id)
+
+    def cancel(self, task_id, reason='cancelled'):
+        """Cancel a running job.
+
+        Returns:
+            bool: False if no job with this task_id is running
+        """
+        token = self.get(task_id)
+        if token is None:
+            return False
+        token.cancel(reason)
+        return True
+
+
+CANCELLATION = CancellationRegistry()
+
+
+@contextmanager
+def cancellable(task_id, timeout=None):
+    """Run a job in the current thread under a cancel token registered for task_id.
+
+    Checkpoints inside the block raise JobCancelled once the token is cancelled or its
+    timeout passes; the token's cleanup callbacks then run before the exception leaves.
+
+    Yields:
+        CancelToken: token of the job, for registering cleanup callbacks
+    """
+    token = CANCELLATION.open(task_id, timeout)
+    previous = getattr(_CURRENT, 'token', None)
+    _CURRENT.token = token
+    try:
+        yield token
+    except JobCancelled:
+        token.cleanup()
+        raise
+    finally:
+        _CURRENT.token = previous
+        CANCELLATION.close(task_id)
+
+
+def checkpoint():
+    """Stop the job running in the current thread if it was cancelled or timed out.
+
+    A no-op outside cancellable(), e.g. in management commands and worker processes.
+
+    Raises:
+        JobCancelled: if the current job should stop
+    """
+    token = getattr(_CURRENT, 'token', None)
+    if token is not None:
+        token.check()
+
+
+def on_cancel(callback, *args):
+    """Register a cleanup callback with the job running in the current thread, if any."""
+    token = getattr(_CURRENT, 'token', None)
+    if token is not None:
+        token.on_cancel(callback, *args)
+
+
+def remove_file(path):
+    """Delete a file if it exists, e.g. a partially written output of a cancelled job."""
+    if path and os.path.exists(path):
+        os.remove(path)
+
+
+def wait_result(future):
+    """Wait for the result of a worker process, stopping at checkpoints while it runs.
+
+    Worker processes can't see the job's token, so the thread waiting on them polls it.
+
+    Raises:
+        JobCancelled: if the current job should stop before the result is ready
+    """
+    while True:
+        try:
+            return future.result(timeout=POLL_INTERVAL)
+        except FutureTimeout:
+            checkpoint()
+
+
+def terminate_pool(pool):
+    """Drop queued tasks of a process pool and kill the workers still running tasks.
+
+    shutdown(wait=False) alone leaves running tasks to finish, and leaving the pool's
+    with block then waits for them however long they take.
+    """
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def ordered_results(pool, fn, tasks, window):
+    """Run fn(*task) for each task in a process pool and yield the results in task order.
+
+    At most window tasks are in flight and tasks are pulled lazily, so only a few batches
+    of a large input are in memory. If the job stops, running tasks are killed rather
+    than waited for.
+    """
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.submit(fn, *task))
+            if len(pending) >= window:
+                yield wait_result(pending.popleft())
+        while pending:
+            yield wait_result(pending.popleft())
+    except BaseException:
+        terminate_pool(pool)
+        raise
+
+
+def pool_results(stack, fn, tasks, workers, initializer, initargs=()):
+    """Start a process pool on an ExitStack and run tasks in it with ordered_results.
+
+    Two tasks per worker are in flight. The results are closed before the pool shuts
+    down, which then needn't wait for queued tasks.
+
+    Args:
+        stack(contextlib.ExitStack): stack owning the pool
+        fn(callable): module-level function run in the workers
+        tasks(iterable): argument tuples of fn
+        workers(int): number of worker processes
+        initializer(callable): called with initargs in each worker, e.g. to install a model
+    """
+    pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                                                   initargs=initargs))
+    results = ordered_results(pool, fn, tasks, 2 * workers)
+    stack.callback(results.close)
+    return results
@@ -0,0 +1,333 @@
+"""
+    File serving with an in-memory path index, conditional GET, byte ranges and compressed variants
+"""
+import os
+import re
+import uuid
+import zlib
+import threading
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+try:
+    import zstandard
+except ImportError:     # zstd variants are only offered when zstandard is installed
+    zstandard = None
+
+from .formats import CONTENT_TYPES, format_of
+
+# Media sub-folders searched for downloads, in order of precedence
+DOWNLOAD_DIRS = ("", "generated", "matched", "imputed", "cache")
+
+# Folder holding precomputed compressed variants, keyed by file name
+VARIANTS_DIR = "compressed"
+
+# Parquet and Feather files are already compressed internally
+COMPRESSIBLE_EXTENSIONS = ('.csv', '.pkl', '.json', '.geojson')
+
+# Content-Encoding tokens and the suffix of their precomputed variant, by preference
+ENCODINGS = {'zstd': '.zst', 'gzip': '.gz'}
+
+BLOCK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileIndex:
+    """Map download names to paths so that hits don't probe the file system.
+
+    Writers register files as they create them. Names that aren't indexed, e.g. files
+    copied into media by hand, are looked up in DOWNLOAD_DIRS once and then remembered.
+    """
+
+    def __init__(self):
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def register(self, path):
+        with self._lock:
+            self._paths[os.path.basename(path)] = os.path.abspath(path)
+
+    def forget(self, filename):
+        with self._lock:
+            self._paths.pop(filename, None)
+
+    def resolve(self, filename):
+        """Return absolute path of a downloadable file, or None if it doesn't exist."""
+        with self._lock:
+            path = self._paths.get(filename)
+        if path and os.path.isfile(path):
+            return path
+
+        for subdir in DOWNLOAD_DIRS:
+            candidate = os.path.join(settings.MEDIA_ROOT, subdir, filename)
+            if os.path.isfile(candidate):
+                self.register(candidate)
+                return os.path.abspath(candidate)
+
+        self.forget(filename)
+        return None
+
+
+FILE_INDEX = FileIndex()
+
+# Paths of variants currently being compressed in the background
+_PENDING = set()
+_PENDING_LOCK = threading.Lock()
+
+
+def is_safe_name(filename):
+    """Reject names that could escape media folders or reach hidden files."""
+    return bool(filename) and os.path.basename(filename) == filename and not filename.startswith('.')
+
+
+def is_compressible(path):
+    return str(path).lower().endswith(COMPRESSIBLE_EXTENSIONS) and \
+        os.path.getsize(path) >= getattr(settings, 'DOWNLOAD_COMPRESS_MIN_BYTES', 1024)
+
+
+def available_encodings():
+    return [encoding for encoding in ENCODINGS if encoding != 'zstd' or zstandard is not None]
+
+
+def negotiate_encoding(accept_encoding):
+    """Pick the preferred available content coding accepted by a client.
+
+    Args:
+        accept_encoding(str): value of Accept-Encoding header
+
+    Returns:
+        str: "zstd", "gzip" or None for the identity encoding
+    """
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+
+    for encoding in available_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def iter_file(path, start=0, length=None):
+    """Yield blocks of a file, optionally limited to a byte range."""
+    remaining = os.path.getsize(path) - start if length is None else length
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def iter_compressed(path, encoding):
+    """Yield a file compressed with the given content coding.
+
+    Compression is deterministic, so bytes streamed on the fly are identical to those of
+    a precomputed variant and both share one ETag.
+    """
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    else:
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    for block in iter_file(path):
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def variant_path(path, encoding):
+    return os.path.join(settings.MEDIA_ROOT, VARIANTS_DIR, os.path.basename(path) + ENCODINGS[encoding])
+
+
+def fresh_variant(path, encoding):
+    """Return path of an up-to-date precomputed variant of a file, if there is one."""
+    compressed = variant_path(path, encoding)
+    try:
+        if os.stat(compressed).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            return compressed
+    except OSError:
+        pass
+    return None
+
+
+def precompress(path, encoding):
+    """Write the compressed variant of a file, atomically replacing a stale one."""
+    compressed = variant_path(path, encoding)
+    os.makedirs(os.path.dirname(compressed), exist_ok=True)
+    temp_path = f"{compressed}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            for block in iter_compressed(path, encoding):
+                f.write(block)
+        os.replace(temp_path, compressed)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def schedule_precompress(path, encoding):
+    """Compress a variant in a background thread unless that is already under way."""
+    key = variant_path(path, encoding)
+    with _PENDING_LOCK:
+        if key in _PENDING:
+            return
+        _PENDING.add(key)
+
+    def run():
+        try:
+            precompress(path, encoding)
+        except Exception as e:
+            print(f"Failed to precompress {path}: {e}")
+        finally:
+            with _PENDING_LOCK:
+                _PENDING.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def register_download(path):
+    """Index a newly written file and, if enabled, precompute its compressed variants."""
+    FILE_INDEX.register(path)
+    if getattr(settings, 'DOWNLOAD_PRECOMPRESS', True) and is_compressible(path):
+        for encoding in available_encodings():
+            schedule_precompress(path, encoding)
+
+
+def make_etag(stat, encoding=None):
+    """Strong validator of a file representation.
+
+    Generated files are written once under unique names, so size and modification time
+    identify their content. Each content coding is a distinct representation.
+    """
+    suffix = f"-{encoding}" if encoding else ""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}{suffix}"'
+
+
+def not_modified(request, etag, mtime):
+    """Evaluate If-None-Match, or If-Modified-Since when no entity tags are given."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        # Weak comparison, as required for If-None-Match
+        return '*' in etags or etag in etags or etag in [tag.removeprefix('W/') for tag in etags]
+
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and int(mtime) <= since
+
+
+def parse_range(header, size):
+    """Parse a single-range Range header.
+
+    Returns:
+        tuple: (start, end) inclusive byte positions, None when the header should be
+            ignored, or False when the range can't be satisfied
+    """
+    match = RANGE_RE.match((header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or (last and int(last) < start):
+        return False
+    return start, end
+
+
+def serve_file(request, path, filename):
+    """Serve a file with validators, conditional GET, byte ranges and content coding.
+
+    Precomputed variants are served like plain files, ranges included. Without one, the
+    first compressed request streams on the fly while the variant is built in the
+    background; range requests then fall back to the identity encoding.
+
+    Args:
+        request(django.http.HttpRequest): incoming GET or HEAD request
+        path(str): absolute path of the file
+        filename(str): name sent in Content-Disposition
+
+    Returns:
+        HttpResponse: 200, 206, 304 or 416 response
+    """
+    source_stat = os.stat(path)
+    range_header = request.META.get('HTTP_RANGE')
+
+    encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING')) if is_compressible(path) else None
+    serve_path, stat = path, source_stat
+    streaming = False
+    if encoding:
+        compressed = fresh_variant(path, encoding)
+        if compressed:
+            serve_path, stat = compressed, os.stat(compressed)
+        else:
+            schedule_precompress(path, encoding)
+            if range_header:
+                encoding = None
+            else:
+                streaming = True
+
+    etag = make_etag(source_stat, encoding)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(source_stat.st_mtime),
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+        'Content-Disposition': f"attachment; filename={filename}"
+    }
+    try:
+        content_type = CONTENT_TYPES[format_of(filename)]
+    except ValueError:
+        content_type = 'application/octet-stream'
+
+    if not_modified(request, etag, source_stat.st_mtime):
+        response = HttpResponse(status=304)
+    elif streaming:
+        response = StreamingHttpResponse(iter_compressed(path, encoding), content_type=content_type)
+    else:
+        headers['Accept-Ranges'] = 'bytes'
+        byte_range = parse_range(range_header, stat.st_size) if range_header else None
+
+        # A stale If-Range validator means the client must fetch the whole file again
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if byte_range and if_range and if_range != etag:
+            byte_range = None
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            headers['Content-Range'] = f"bytes */{stat.st_size}"
+        elif byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_file(serve_path, start, end - start + 1),
+                                             status=206, content_type=content_type)
+            headers['Content-Range'] = f"bytes {start}-{end}/{stat.st_size}"
+            headers['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(serve_path, 'rb'), content_type=content_type)
+
+    if encoding and response.status_code != 416:
+        headers['Content-Encoding'] = encoding
+    for name, value in headers.items():
+        response[name] = value
+    return response
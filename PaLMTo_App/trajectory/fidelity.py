@@ -0,0 +1,152 @@
+"""
+    Distribution-level fidelity scores of generated trajectories against the original ones
+"""
+import numpy as np
+
+from .tokens import NgramModel, Sentences, pack
+
+# Bins of the trip-distance histograms, spread evenly over the range of both sides
+DISTANCE_BINS = 50
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def js_divergence(p, q):
+    """Jensen-Shannon divergence of two histograms in bits, 0 for identical and 1 for disjoint.
+
+    Args:
+        p(np.ndarray): counts or weights of the first distribution
+        q(np.ndarray): counts or weights over the same bins
+    """
+    p = np.asarray(p, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    if p.sum() == 0 or q.sum() == 0:
+        return None
+    p, q = p / p.sum(), q / q.sum()
+    m = (p + q) / 2
+
+    def kl(a):
+        nonzero = a > 0
+        return float(np.sum(a[nonzero] * np.log2(a[nonzero] / m[nonzero])))
+    return max(0.0, min(1.0, (kl(p) + kl(q)) / 2))
+
+
+def sparse_js_divergence(keys_p, counts_p, keys_q, counts_q):
+    """JS divergence of two distributions given as sorted unique keys with counts."""
+    keys = np.union1d(keys_p, keys_q)
+    p = np.zeros(len(keys))
+    q = np.zeros(len(keys))
+    p[np.searchsorted(keys, keys_p)] = counts_p
+    q[np.searchsorted(keys, keys_q)] = counts_q
+    return js_divergence(p, q)
+
+
+def collapse_repeats(sentences):
+    """Drop consecutive repeats of a cell within each trip, turning points into cell visits."""
+    tokens, trips = sentences.tokens, sentences.trip_index
+    keep = np.ones(len(tokens), dtype=bool)
+    keep[1:] = (tokens[1:] != tokens[:-1]) | (trips[1:] != trips[:-1])
+    lengths = np.bincount(trips[keep], minlength=len(sentences))
+    return Sentences(tokens[keep], np.concatenate(([0], np.cumsum(lengths))), trip_ids=sentences.trip_ids)
+
+
+def trip_distances(sentences):
+    """Length of each trip in meters, summed over consecutive points.
+
+    Hops between consecutive points are short, so the equirectangular approximation is
+    within a fraction of a percent of the great-circle distance at a third of its cost.
+    """
+    lon, lat = np.radians(sentences.coords).T
+    hops = EARTH_RADIUS_M * np.hypot(np.diff(lon) * np.cos((lat[:-1] + lat[1:]) / 2), np.diff(lat))
+
+    # Hops of trip i are those from its first point up to its last one
+    travelled = np.concatenate(([0.0], np.cumsum(hops)))
+    starts, ends = sentences.offsets[:-1], sentences.offsets[1:]
+    return travelled[np.maximum(ends - 1, starts)] - travelled[starts]
+
+
+def _od_counts(visits, num_cells):
+    """Unique origin-destination keys of trips and their counts."""
+    lengths = visits.lengths
+    nonempty = lengths > 0
+    origins = visits.tokens[visits.offsets[:-1][nonempty]]
+    destinations = visits.tokens[visits.offsets[1:][nonempty] - 1]
+    return np.unique(pack([origins, destinations], num_cells), return_counts=True)
+
+
+def _coverage(model_keys, generated_keys, generated_counts):
+    """Share of generated n-gram occurrences seen in the model, and of model n-grams generated."""
+    if not len(generated_keys) or not len(model_keys):
+        return None, None
+    observed = np.isin(generated_keys, model_keys, assume_unique=True)
+    precision = float(generated_counts[observed].sum() / generated_counts.sum())
+    recall = float(observed.sum() / len(model_keys))
+    return precision, recall
+
+
+def _summary(values):
+    if not len(values):
+        return None
+    return {'mean': float(np.mean(values)), 'median': float(np.median(values)), 'p95': float(np.percentile(values, 95))}
+
+
+def fidelity_report(original, generated, ngrams):
+    """Score how closely generated trajectories follow the distributions of the original ones.
+
+    Points are first collapsed into cell visits, so GPS sampling rates don't distort
+    comparisons with generated trajectories that step from cell to cell. Every score
+    is a vectorized pass over token arrays.
+
+    Args:
+        original(tokens.Sentences): original trajectories, or the sample kept in the cache
+        generated(tokens.Sentences): generated trajectories with coordinates
+        ngrams(tokens.NgramModel): model the trajectories were generated from
+
+    Returns:
+        dict: JS divergences (0 is identical) of cell visits, trip lengths in cells, trip
+            distances and origin-destination pairs; cosine similarity of OD matrices;
+            n-gram precision and recall; summaries of both sides' trip lengths and distances
+    """
+    num_cells = ngrams.num_cells
+    original_visits = collapse_repeats(original)
+    generated_visits = collapse_repeats(generated)
+
+    cell_jsd = js_divergence(np.bincount(original_visits.tokens, minlength=num_cells),
+                             np.bincount(generated_visits.tokens, minlength=num_cells))
+
+    original_lengths, generated_lengths = original_visits.lengths, generated_visits.lengths
+    longest = int(max(original_lengths.max(initial=0), generated_lengths.max(initial=0)))
+    length_jsd = js_divergence(np.bincount(original_lengths, minlength=longest + 1),
+                               np.bincount(generated_lengths, minlength=longest + 1))
+
+    original_distances, generated_distances = trip_distances(original), trip_distances(generated)
+    edges = np.histogram_bin_edges(np.concatenate([original_distances, generated_distances]), bins=DISTANCE_BINS)
+    distance_jsd = js_divergence(np.histogram(original_distances, edges)[0],
+                                 np.histogram(generated_distances, edges)[0])
+
+    od_p, od_p_counts = _od_counts(original_visits, num_cells)
+    od_q, od_q_counts = _od_counts(generated_visits, num_cells)
+    od_jsd = sparse_js_divergence(od_p, od_p_counts, od_q, od_q_counts)
+    _, in_p, in_q = np.intersect1d(od_p, od_q, assume_unique=True, return_indices=True)
+    norm = np.linalg.norm(od_p_counts) * np.linalg.norm(od_q_counts)
+    od_cosine = float(od_p_counts[in_p].astype(np.float64) @ od_q_counts[in_q] / norm) if norm else None
+
+    generated_model = NgramModel.from_sentences(generated, num_cells)
+    bigram_precision, bigram_recall = _coverage(ngrams.bigram_keys, generated_model.bigram_keys,
+                                                generated_model.bigram_counts)
+    trigram_precision, trigram_recall = _coverage(ngrams.trigram_keys, generated_model.trigram_keys,
+                                                  generated_model.trigram_counts)
+
+    return {
+        'cellVisitJsd': cell_jsd,
+        'tripLengthJsd': length_jsd,
+        'tripDistanceJsd': distance_jsd,
+        'odJsd': od_jsd,
+        'odCosine': od_cosine,
+        'bigramPrecision': bigram_precision,
+        'bigramRecall': bigram_recall,
+        'trigramPrecision': trigram_precision,
+        'trigramRecall': trigram_recall,
+        'tripLength': {'original': _summary(original_lengths), 'generated': _summary(generated_lengths)},
+        'tripDistance': {'original': _summary(original_distances), 'generated': _summary(generated_distances)}
+    }
@@ -0,0 +1,316 @@
+"""
+    Reading and writing trajectory datasets as CSV, Parquet or Arrow (Feather) files
+"""
+import os
+import ast
+import json
+from itertools import chain
+from importlib.util import find_spec
+
+import numpy as np
+
+# Columnar formats are optional, CSV always works. pandas and pyarrow are imported by
+# the functions that use them, which keeps them out of process startup.
+HAS_PYARROW = find_spec('pyarrow') is not None
+
+# File extension of each supported format
+EXTENSIONS = {
+    'csv': ('.csv',),
+    'parquet': ('.parquet', '.geoparquet'),
+    'feather': ('.feather', '.arrow')
+}
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'feather': 'application/vnd.apache.arrow.file'
+}
+
+# Columns of a trajectory file; only "geometry" is mandatory
+TRAJECTORY_COLUMNS = ['trip_id', 'timestamp', 'geometry']
+
+
+def format_of(path):
+    """Return format name of a trajectory file from its extension.
+
+    Raises:
+        ValueError: if the extension belongs to no supported format
+    """
+    name = str(path).lower()
+    for fmt, extensions in EXTENSIONS.items():
+        if name.endswith(extensions):
+            return fmt
+    raise ValueError(f"Unsupported trajectory file type: {os.path.basename(str(path))}")
+
+
+def check_format(fmt):
+    """Validate an output format requested by a client.
+
+    Returns:
+        str: the format, "csv" when none was requested
+
+    Raises:
+        ValueError: for unknown formats or columnar formats without pyarrow installed
+    """
+    fmt = (fmt or 'csv').lower()
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"output_format must be one of {sorted(EXTENSIONS)}")
+    if fmt != 'csv' and not HAS_PYARROW:
+        raise ValueError(f"Writing {fmt} files requires pyarrow to be installed")
+    return fmt
+
+
+def _require_pyarrow(path):
+    if not HAS_PYARROW:
+        raise ValueError(f"Reading {os.path.basename(str(path))} requires pyarrow to be installed")
+
+
+def read_errors():
+    """Return the exceptions raised by reading a malformed trajectory file.
+
+    Meant for except clauses, which only evaluate it once something was raised, so
+    pyarrow is not imported on the happy path.
+    """
+    import csv
+
+    errors = (ValueError, UnicodeDecodeError, SyntaxError, csv.Error, StopIteration)
+    if HAS_PYARROW:
+        import pyarrow as pa
+        errors += (pa.ArrowException,)
+    return errors
+
+
+def read_schema_columns(source, fmt):
+    """Return column names of a Parquet or Feather file without reading its data.
+
+    Args:
+        source(str or file-like): path or open binary file
+        fmt(str): "parquet" or "feather"
+    """
+    _require_pyarrow(source)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == 'parquet':
+        return pq.read_schema(source).names
+    if isinstance(source, str):
+        source = pa.memory_map(source)
+    return pa.ipc.open_file(source).schema.names
+
+
+def parse_geometry(values):
+    """Parse stringified coordinate lists of a CSV column in one pass.
+
+    json is several times faster than ast.literal_eval on "[[lon, lat], ...]" strings;
+    the latter is only used for files written with Python-specific syntax.
+    """
+    values = values.tolist()
+    try:
+        return json.loads('[' + ','.join(values) + ']')
+    except ValueError:
+        return [ast.literal_eval(value) for value in values]
+
+
+def geometry_arrays(column):
+    """Flatten an Arrow geometry column into coordinates and per-trip point counts.
+
+    Handles nested list<list<double>> coordinates as written by write_trajectories,
+    WKB geometries of GeoParquet files and stringified coordinate lists.
+
+    Returns:
+        tuple: (num_points, 2) float64 coordinates and (num_trips,) int64 point counts
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+
+    if pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type):
+        import shapely
+        geoms = shapely.from_wkb(column.to_numpy(zero_copy_only=False))
+        coords, index = shapely.get_coordinates(geoms, return_index=True)
+        return coords, np.bincount(index, minlength=len(geoms)).astype(np.int64)
+
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        trajs = parse_geometry(column.to_pandas())
+        lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+        coords = np.array(list(chain.from_iterable(trajs)), dtype=np.float64).reshape(-1, 2)
+        return coords, lengths
+
+    lengths = pc.list_value_length(column).fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    values = column.flatten().flatten().to_numpy(zero_copy_only=False)
+    return values.astype(np.float64, copy=False).reshape(-1, 2), lengths
+
+
+def _split(coords, lengths):
+    """Split flat coordinates back into one list of [lon, lat] pairs per trip."""
+    return [part.tolist() for part in np.split(coords, np.cumsum(lengths)[:-1])] if len(lengths) else []
+
+
+def read_trajectories(path, columns=None):
+    """Load a trajectory file with "geometry" as lists of [lon, lat] pairs.
+
+    Args:
+        path(str): path of a CSV, Parquet or Feather file
+        columns(list): columns to read, all of them by default. Columnar formats only read
+            the requested columns from disk.
+
+    Returns:
+        pd.DataFrame: one row per trajectory
+    """
+    import pandas as pd
+
+    fmt = format_of(path)
+    if fmt == 'csv':
+        usecols = None if columns is None else (lambda column: column in columns)
+        df = pd.read_csv(path, usecols=usecols)
+        df['geometry'] = parse_geometry(df['geometry'])
+        return df
+
+    _require_pyarrow(path)
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if fmt == 'parquet':
+        schema_names = pq.read_schema(path).names
+        selected = None if columns is None else [c for c in columns if c in schema_names]
+        table = pq.read_table(path, columns=selected)
+    else:
+        table = feather.read_table(path, memory_map=True)
+        if columns is not None:
+            table = table.select([c for c in columns if c in table.schema.names])
+
+    coords, lengths = geometry_arrays(table.column('geometry'))
+    df = table.drop_columns(['geometry']).to_pandas()
+    df['geometry'] = _split(coords, lengths)
+    return df
+
+
+def iter_trajectory_batches(path, rows, columns=('trip_id', 'geometry')):
+    """Yield batches of a trajectory file as flat arrays, reading only the given columns.
+
+    Args:
+        path(str): path of a CSV, Parquet or Feather file
+        rows(int): maximum number of trajectories per batch
+        columns(tuple): columns to read; "geometry" must be included
+
+    Yields:
+        tuple: DataFrame of the other requested columns, (num_points, 2) coordinates and
+            (num_trips,) point counts
+    """
+    fmt = format_of(path)
+    others = [column for column in columns if column != 'geometry']
+
+    if fmt == 'csv':
+        import pandas as pd
+
+        for chunk in pd.read_csv(path, chunksize=rows, usecols=lambda column: column in columns):
+            trajs = parse_geometry(chunk['geometry'])
+            lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+            coords = np.array(list(chain.from_iterable(trajs)), dtype=np.float64).reshape(-1, 2)
+            yield chunk.drop(columns='geometry').reset_index(drop=True), coords, lengths
+        return
+
+    _require_pyarrow(path)
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if fmt == 'parquet':
+        parquet_file = pq.ParquetFile(path)
+        selected = [column for column in columns if column in parquet_file.schema_arrow.names]
+        batches = parquet_file.iter_batches(batch_size=rows, columns=selected)
+    else:
+        table = feather.read_table(path, memory_map=True)
+        table = table.select([column for column in columns if column in table.schema.names])
+        batches = table.to_batches(max_chunksize=rows)
+
+    for batch in batches:
+        coords, lengths = geometry_arrays(batch.column('geometry'))
+        present = [column for column in others if column in batch.schema.names]
+        yield batch.select(present).to_pandas(), coords, lengths
+
+
+def count_rows(path):
+    """Return number of trajectories in a Parquet or Feather file from its metadata."""
+    _require_pyarrow(path)
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+
+    if format_of(path) == 'parquet':
+        return pq.ParquetFile(path).metadata.num_rows
+    return feather.read_table(path, memory_map=True).num_rows
+
+
+def _to_table(df):
+    """Convert trajectories to an Arrow table with list<list<double>> geometry."""
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df.drop(columns='geometry'), preserve_index=False)
+    geometry = pa.array(df['geometry'].tolist(), type=pa.list_(pa.list_(pa.float64())))
+    return table.append_column('geometry', geometry)
+
+
+def write_trajectories(df, path):
+    """Write trajectories with a list-formatted "geometry" column in the format of path.
+
+    CSV stores geometry as text as before. Parquet and Feather store it natively as
+    list<list<double>>, which avoids encoding and parsing coordinates as strings.
+
+    Args:
+        df(pd.DataFrame): trajectories, "geometry" holding lists of [lon, lat] pairs
+        path(str): output path whose extension selects the format
+    """
+    with TrajectoryWriter(path) as writer:
+        writer.write(df)
+
+
+class TrajectoryWriter:
+    """Append batches of trajectories to one file as they are produced.
+
+    Every batch must have the same columns. Parquet batches become row groups and
+    Feather batches record batches, so readers can stream the result back batch by batch.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fmt = format_of(path)
+        if self.fmt != 'csv':
+            _require_pyarrow(path)
+        self.rows = 0
+        self._writer = None
+        self._schema = None
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self.path, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = _to_table(df)
+            if self._writer is None:
+                self._schema = table.schema
+                if self.fmt == 'parquet':
+                    self._writer = pq.ParquetWriter(self.path, self._schema, compression='zstd')
+                else:
+                    options = pa.ipc.IpcWriteOptions(compression='zstd')
+                    self._writer = pa.ipc.new_file(self.path, self._schema, options=options)
+            self._writer.write_table(table.cast(self._schema))
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def output_filename(stem, fmt):
+    """Return file name for a dataset written in the given format."""
+    return f"{stem}{EXTENSIONS[fmt][0]}"
@@ -0,0 +1,518 @@
+"""
+    Trajectory sampling shared by single and batch generation jobs
+"""
+import os
+import math
+import random
+import secrets
+import threading
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from django.conf import settings
+
+from .cancellation import POLL_INTERVAL, checkpoint, pool_results, terminate_pool
+from .graph import ReachabilityIndex, TransitionGraph
+from .tokens import Sentences, merge_counts, pack, unpack
+
+# Trajectories sampled from one RNG stream. Work is always split at this granularity,
+# which is what keeps the output of a seed independent of the number of workers.
+CHUNK_SIZE = 500
+
+# Methods sampling trajectories between an origin and a destination bigram
+POINT_TO_POINT_METHODS = ("point_to_point", "bidirectional")
+
+# Attempts abandoned per requested trajectory before a chunk gives up, which bounds the
+# time spent on models where few pairs are connected or few walks reach the target length
+MAX_ABANDONED_PER_TRAJECTORY = 20
+
+# Sampling attempts between checkpoints of a chunk sampled in the job's own thread
+CHECKPOINT_ATTEMPTS = 50
+
+# Sampler installed in each pool worker by _init_worker
+_WORKER_SAMPLER = None
+
+
+class _ContextIndex:
+    """Trigrams grouped by a two-token context for weighted lookups of the third token.
+
+    Contexts are packed like bigram keys. Entries of a context are contiguous and
+    cumulative counts are kept with a leading zero, so a weighted draw is one binary
+    search over the arrays instead of a per-context Python list.
+    """
+
+    def __init__(self, contexts, tokens, counts):
+        order = np.argsort(contexts, kind='stable')
+        contexts = contexts[order]
+        self.tokens = np.asarray(tokens, dtype=np.int64)[order]
+        self.counts = np.asarray(counts, dtype=np.int64)[order]
+        self.cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        self.contexts, starts = np.unique(contexts, return_index=True)
+        self.starts = np.append(starts, len(contexts))
+
+    def span(self, context):
+        """Return (start, end) positions of the entries of a context, (0, 0) if unseen."""
+        i = self.contexts.searchsorted(context)
+        if i == len(self.contexts) or self.contexts[i] != context:
+            return 0, 0
+        return int(self.starts[i]), int(self.starts[i + 1])
+
+    def draw(self, context, rng):
+        """Draw the next token of a context with probability proportional to its count."""
+        start, end = self.span(context)
+        if start == end:
+            return None
+        base = self.cumulative[start]
+        target = base + rng.randint(1, int(self.cumulative[end] - base))
+        return int(self.tokens[int(np.searchsorted(self.cumulative, target)) - 1])
+
+
+class CompiledSampler:
+    """Array-backed sampling tables of an n-gram model for repeated seeded draws.
+
+    Mirrors the sampling rules of Palmto_gen's TrajGenerator on dense int32 cell IDs
+    but draws from an explicit random.Random instead of the global random module, so
+    concurrent jobs can't disturb each other's streams.
+    """
+
+    # Candidate tokens kept on each side, and token pairs kept, when growing a path
+    K = 3
+
+    # Folder of the shared bundle this sampler was mapped from, if any
+    bundle = None
+
+    def __init__(self, ngrams, table, max_steps=None, reachability=None):
+        num_cells = ngrams.num_cells
+        self.n_rows = table.n_rows
+        self.start_end = ngrams.start_end
+
+        # Length-constrained sentences only continue original trigrams
+        self.forward = _ContextIndex(ngrams.trigram_keys // num_cells, ngrams.trigram_keys % num_cells,
+                                     ngrams.trigram_counts)
+
+        # Point-to-point sentences grow in both directions, so reversed trigrams count too
+        first, middle, last = ngrams.trigrams()
+        keys, counts = merge_counts(ngrams.trigram_keys, ngrams.trigram_counts,
+                                    pack([last, middle, first], num_cells), ngrams.trigram_counts)
+        first, middle, last = unpack(keys, 3, num_cells)
+        self.both = _ContextIndex(keys // num_cells, last, counts)
+        # Middle tokens bridging the first and last token of a trigram
+        self.bridges = _ContextIndex(first * num_cells + last, middle, counts)
+        self.num_cells = num_cells
+
+        # Bidirectional search walks bigram transitions forward and backward
+        self.successors = TransitionGraph.from_model(ngrams)
+        self.predecessors = TransitionGraph.from_model(ngrams, reverse=True)
+        self.reachability = reachability or ReachabilityIndex.build(self.successors)
+        # Only pairs whose origin may reach their destination are worth a search
+        self.connected = np.flatnonzero(self.reachability.reachable_many(self.start_end[:, 1], self.start_end[:, 2]))
+        # A step budget rather than a time budget, so abandoned pairs don't depend on machine load
+        self.max_steps = max_steps or getattr(settings, 'POINT_TO_POINT_MAX_STEPS', 20000)
+
+    def __reduce_ex__(self, protocol):
+        # Mapped samplers travel to pool workers as the path of their bundle, not a copy
+        if self.bundle is not None:
+            from .shared_models import attach_sampler
+            return attach_sampler, (self.bundle,)
+        return super().__reduce_ex__(protocol)
+
+    def position(self, token):
+        """Return the (col, row) grid position of a cell ID."""
+        return divmod(token, self.n_rows)
+
+    def origin(self, length, rng):
+        """Sample a sentence of up to length tokens continuing a random start bigram."""
+        first, second = self.start_end[rng.randrange(len(self.start_end)), :2].tolist()
+        text = [first, second]
+
+        while len(text) < length:
+            token = self.forward.draw(text[-2] * self.num_cells + text[-1], rng)
+            if token is None:
+                break
+            text.append(token)
+        return text
+
+    def start_path(self, start, end):
+        """Arrange start and end bigrams into four tokens with the closest pair in the middle."""
+        closest_pair = min(((a, b) for a in start for b in end),
+                           key=lambda pair: math.dist(self.position(pair[0]), self.position(pair[1])))
+
+        path_start = [token for token in start + end if token not in closest_pair]
+        path_start.insert(1, closest_pair[0])
+        path_start.insert(2, closest_pair[-1])
+        return path_start
+
+    def _top_next(self, context, path_sentence):
+        """Most frequent next tokens of a context that are not yet on the path."""
+        start, end = self.both.span(context[0] * self.num_cells + context[1])
+        candidates = [(count, token) for token, count in
+                      zip(self.both.tokens[start:end].tolist(), self.both.counts[start:end].tolist())
+                      if token not in path_sentence]
+        candidates.sort(key=lambda candidate: -candidate[0])
+        return [token for _, token in candidates[:self.K]]
+
+    def find_next_tokens(self, left, right, path_sentence):
+        """Return up to K spatially closest pairs of likely next tokens on either side."""
+        pairs = [(a, b) for a in self._top_next(left, path_sentence) for b in self._top_next(right, path_sentence)]
+        pairs.sort(key=lambda pair: math.dist(self.position(pair[0]), self.position(pair[1])))
+        return pairs[:self.K]
+
+    def origin_destination(self, rng):
+        """Sample a sentence growing from both ends of a random origin-destination pair.
+
+        Returns an empty list when the two ends don't meet within three attempts.
+        """
+        row = self.start_end[rng.randrange(len(self.start_end))].tolist()
+        start, end = row[:2], row[2:]
+
+        for _ in range(3):
+            path_sentence = self.start_path(start, end)
+            left = path_sentence[:2]
+            right = path_sentence[-2:]
+
+            for i in range(40):
+                points = self.find_next_tokens(left, right, path_sentence)
+                if not points:
+                    # Nothing changed, so later iterations would find no tokens either
+                    break
+                j = rng.randint(0, len(points) - 1)
+
+                left = [left[-1], points[j][0]]
+                right = [right[-1], points[j][1]]
+                path_sentence.insert(i + 2, left[-1])
+                path_sentence.insert(i + 3, right[-1])
+
+                # Ends are joined once a trigram bridges the left and right tokens
+                fill_start, fill_end = self.bridges.span(left[-1] * self.num_cells + right[-1])
+                if fill_end - fill_start > 1:
+                    best = fill_start + int(np.argmax(self.bridges.counts[fill_start:fill_end]))
+                    path_sentence.insert(i + 3, int(self.bridges.tokens[best]))
+                    return path_sentence
+        return []
+
+    def _expand(self, graph, frontier, parents, others, blocked, goal, reverse, rng):
+        """Expand one breadth-first level of a search, steering toward its goal cell.
+
+        Neighbours that can't reach the goal (or, walking backward, can't be reached from
+        it) are pruned. The rest are visited by increasing landmark bound on their hop
+        distance to the goal, ties broken in favour of likelier transitions.
+
+        Returns:
+            tuple: next frontier, the cell where the search met the opposite one (or None)
+                and the number of cells expanded
+        """
+        reachability = self.reachability
+        next_frontier = []
+        for cell in frontier:
+            start, end = graph.indptr[cell], graph.indptr[cell + 1]
+            if start == end:
+                continue
+            neighbors = graph.indices[start:end]
+            if reverse:
+                viable = reachability.reachable_many(goal, neighbors)
+                bounds = reachability.hop_bounds(goal, neighbors)
+            else:
+                viable = reachability.reachable_many(neighbors, goal)
+                bounds = reachability.hop_bounds(neighbors, goal)
+            counts = graph.counts[start:end].tolist()
+            # Weighted random order: a key of u ** (1 / count) favours frequent transitions
+            keys = [-rng.random() ** (1 / count) for count in counts]
+            order = sorted(np.flatnonzero(viable).tolist(), key=lambda i: (bounds[i], keys[i]))
+            for i in order:
+                neighbor = int(neighbors[i])
+                if neighbor in parents or neighbor in blocked:
+                    continue
+                parents[neighbor] = cell
+                if neighbor in others:
+                    return next_frontier, neighbor, len(frontier)
+                next_frontier.append(neighbor)
+        return next_frontier, None, len(frontier)
+
+    def bidirectional(self, rng):
+        """Sample a sentence joining a random origin and destination bigram.
+
+        Pairs are drawn among those the reachability index doesn't rule out. Searches
+        run breadth-first forward from the origin over bigram transitions and backward
+        from the destination over reversed ones, always expanding the smaller frontier,
+        until they meet. A pair is abandoned when the searches exhaust either side or
+        expand more than max_steps cells.
+
+        Returns:
+            list: the sentence, or an empty list when the pair was abandoned
+        """
+        if not len(self.connected):
+            return []
+        row = self.connected[rng.randrange(len(self.connected))]
+        first, second, last_but_one, last = self.start_end[row].tolist()
+        if len({first, second, last_but_one, last}) < 4:
+            return [first, second, last] if second == last_but_one and first != last else []
+
+        forward, backward = {second: None}, {last_but_one: None}
+        forward_frontier, backward_frontier = [second], [last_but_one]
+        blocked = {first, last}
+        steps = 0
+        meeting = None
+
+        while forward_frontier and backward_frontier and meeting is None:
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meeting, expanded = self._expand(
+                    self.successors, forward_frontier, forward, backward, blocked, last_but_one, False, rng)
+            else:
+                backward_frontier, meeting, expanded = self._expand(
+                    self.predecessors, backward_frontier, backward, forward, blocked, second, True, rng)
+            steps += expanded
+            if steps > self.max_steps:
+                return []
+
+        if meeting is None:
+            return []
+
+        head, cell = [], meeting
+        while cell is not None:
+            head.append(cell)
+            cell = forward[cell]
+        tail, cell = [], backward[meeting]
+        while cell is not None:
+            tail.append(cell)
+            cell = backward[cell]
+        return [first] + head[::-1] + tail + [last]
+
+    def sample(self, gen_method, num_trajs, traj_len, rng):
+        """Sample sentences with the same acceptance rules as Palmto_gen.
+
+        Sampling gives up after MAX_ABANDONED_PER_TRAJECTORY failed attempts per requested
+        sentence, so a chunk may return fewer sentences than requested. An attempt fails
+        when a point-to-point search abandons its pair or a length-constrained walk ends
+        well before the target length.
+
+        Args:
+            gen_method(str): "length_constrained", "point_to_point" or "bidirectional"
+            num_trajs(int): number of sentences to sample
+            traj_len(int): target length of length-constrained sentences
+            rng(random.Random): source of randomness
+
+        Returns:
+            tuple: sentences, each a list of cell IDs, and the number of abandoned
+                attempts
+        """
+        sentences = []
+        abandoned = 0
+        attempts = 0
+        while len(sentences) < num_trajs:
+            attempts += 1
+            if attempts % CHECKPOINT_ATTEMPTS == 0:
+                checkpoint()
+
+            if gen_method == "length_constrained":
+                sentence = self.origin(traj_len, rng)
+                # Sentences that hit a dead end well before the target length are dropped
+                if len(sentence) <= (traj_len - 5):
+                    sentence = []
+            elif gen_method == "bidirectional":
+                sentence = self.bidirectional(rng)
+            else:
+                sentence = self.origin_destination(rng)
+            if sentence:
+                sentences.append(sentence)
+            else:
+                abandoned += 1
+                if abandoned > MAX_ABANDONED_PER_TRAJECTORY * num_trajs:
+                    break
+        return sentences, abandoned
+
+
+class LoadedModel:
+    """An n-gram cache loaded once together with its compiled sampling state.
+
+    Compiling the sampler sorts every trigram into context indexes, which costs about
+    as much as loading the cache itself. The sampler is built on first use and reused
+    by every configuration sampled from the same model.
+    """
+
+    def __init__(self, cached_data, sampler=None):
+        self.cached_data = cached_data
+        self._sampler = sampler
+        self._lock = threading.Lock()
+
+    @property
+    def sampler(self):
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = CompiledSampler(self.cached_data['ngrams'], self.cached_data['tokens'],
+                                                reachability=self.cached_data.get('reachability'))
+        return self._sampler
+
+
+def generation_workers():
+    """Return number of worker processes used for sampling trajectories."""
+    return getattr(settings, 'GENERATION_WORKERS', None) or os.cpu_count() or 1
+
+
+def new_seed():
+    """Draw a fresh seed so that unseeded runs can still be reproduced later."""
+    return secrets.randbits(63)
+
+
+def derive_seed(seed, *key):
+    """Derive an independent child seed from a root seed and a spawn key.
+
+    Children are computed with numpy's SeedSequence, so each (seed, key) pair maps to a
+    well-mixed, statistically independent stream regardless of how many are derived.
+    """
+    state = np.random.SeedSequence(int(seed), spawn_key=key).generate_state(2, np.uint64)
+    return (int(state[0]) << 64) | int(state[1])
+
+
+def chunk_tasks(gen_method, num_trajs, traj_len, seed, key=()):
+    """Split a generation request into fixed-size chunks with their own RNG seeds."""
+    return [
+        (gen_method, min(CHUNK_SIZE, num_trajs - start), traj_len, derive_seed(seed, *key, i))
+        for i, start in enumerate(range(0, num_trajs, CHUNK_SIZE))
+    ]
+
+
+def sentences_to_trajs(sentences, table):
+    """Convert sampled token sentences to trajectories through cell centroids.
+
+    Args:
+        sentences(list): sentences of cell IDs
+        table(tokens.TokenTable): centroids of the model's cells
+
+    Returns:
+        tokens.Sentences: generated trajectories numbered from 1
+    """
+    return Sentences.from_token_lists(sentences, table)
+
+
+def _init_worker(sampler):
+    """Install a model's sampler in a pool worker."""
+    global _WORKER_SAMPLER
+    _WORKER_SAMPLER = sampler
+
+
+def _sample_chunk(sampler, gen_method, num_trajs, traj_len, chunk_seed):
+    return sampler.sample(gen_method, num_trajs, traj_len, random.Random(chunk_seed))
+
+
+def _sample_chunk_in_worker(gen_method, num_trajs, traj_len, chunk_seed):
+    return _sample_chunk(_WORKER_SAMPLER, gen_method, num_trajs, traj_len, chunk_seed)
+
+
+def run_chunks(model, tasks, on_progress=None, workers=None):
+    """Sample chunk tasks, in parallel worker processes when there is more than one.
+
+    Workers receive the compiled sampler once at start-up. Results are placed by task
+    index, so their order never depends on which worker finished first. A cancelled
+    job drops queued chunks and kills the workers still sampling.
+
+    Args:
+        model(LoadedModel): model shared by every task
+        tasks(list): tuples of (generation_method, num_trajectories, trajectory_len, seed)
+        on_progress(callable): called with the number of sentences sampled so far
+        workers(int): worker processes to use, defaults to generation_workers()
+
+    Returns:
+        list: tuples of sentences and abandoned attempts of each task, in the order of tasks
+    """
+    workers = min(workers or generation_workers(), len(tasks))
+    results = [None] * len(tasks)
+    sampled = 0
+
+    if workers <= 1:
+        for i, task in enumerate(tasks):
+            checkpoint()
+            results[i] = _sample_chunk(model.sampler, *task)
+            sampled += len(results[i][0])
+            if on_progress is not None:
+                on_progress(sampled)
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(model.sampler,)) as pool:
+        futures = {pool.submit(_sample_chunk_in_worker, *task): i for i, task in enumerate(tasks)}
+        pending = set(futures)
+        try:
+            while pending:
+                # Workers can't see the job's token, so it is polled while they sample
+                done, pending = wait(pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[futures[future]] = future.result()
+                    sampled += len(results[futures[future]][0])
+                    if on_progress is not None:
+                        on_progress(sampled)
+                checkpoint()
+        except BaseException:
+            # Kill running chunks instead of waiting for them on the way out
+            terminate_pool(pool)
+            raise
+    return results
+
+
+def stream_chunks(model, tasks, workers=None):
+    """Sample chunk tasks and yield their results in task order as soon as they are ready.
+
+    Unlike run_chunks, at most a few chunks per worker are in flight or waiting to be
+    consumed, so arbitrarily many trajectories can be streamed to disk.
+
+    Yields:
+        tuple: sentences and abandoned attempts of each task, in the order of tasks
+    """
+    workers = min(workers or generation_workers(), len(tasks))
+    if workers <= 1:
+        for task in tasks:
+            checkpoint()
+            yield _sample_chunk(model.sampler, *task)
+        return
+
+    with ExitStack() as stack:
+        for result in pool_results(stack, _sample_chunk_in_worker, tasks, workers, _init_worker, (model.sampler,)):
+            checkpoint()
+            yield result
+
+
+def generate_sentences(model, gen_method, num_trajs, traj_len=0, seed=None, on_progress=None, workers=None):
+    """Sample sentences for one generation request, reproducibly for a given seed.
+
+    The same seed yields the same sentences in the same order for any worker count.
+
+    Returns:
+        tuple: list of sentences, the seed they were sampled with and the number of
+            sampling attempts abandoned on the way
+    """
+    seed = new_seed() if seed is None else int(seed)
+    tasks = chunk_tasks(gen_method, num_trajs, traj_len, seed)
+    chunks = run_chunks(model, tasks, on_progress, workers)
+    sentences = [sentence for chunk, _ in chunks for sentence in chunk]
+    return sentences, seed, sum(abandoned for _, abandoned in chunks)
+
+
+def run_batch(model, configs, seeds, on_progress=None, workers=None):
+    """Sample sentences for many generation configs against one loaded model.
+
+    Chunks of all configs share one worker pool, which keeps every core busy even when
+    configs differ widely in size.
+
+    Args:
+        model(LoadedModel): model shared by every config
+        configs(list): tuples of (generation_method, num_trajectories, trajectory_len)
+        seeds(list): seed of each config
+        on_progress(callable): called with the number of sentences sampled so far
+        workers(int): worker processes to use, defaults to generation_workers()
+
+    Returns:
+        tuple: list of sentences of each config, in the order of configs, and list of
+            sampling attempts abandoned by each config
+    """
+    tasks, owners = [], []
+    for i, ((gen_method, num_trajs, traj_len), seed) in enumerate(zip(configs, seeds)):
+        config_tasks = chunk_tasks(gen_method, num_trajs, traj_len, seed)
+        tasks.extend(config_tasks)
+        owners.extend([i] * len(config_tasks))
+
+    results = [[] for _ in configs]
+    abandoned = [0] * len(configs)
+    for owner, (chunk, chunk_abandoned) in zip(owners, run_chunks(model, tasks, on_progress, workers)):
+        results[owner].extend(chunk)
+        abandoned[owner] += chunk_abandoned
+    return results, abandoned
@@ -1,14 +1,12 @@
 """
     Auxiliary functions for backend logic in views
 """
-import pandas as pd
-import geopandas as gpd
 import numpy as np
-from shapely.geometry import Polygon, mapping
-from Palmto_gen import ConvertToToken, DisplayTrajs
-from timezonefinder import TimezoneFinder
 from datetime import datetime
 from zoneinfo import ZoneInfo
+from django.conf import settings
+
+from .tokens import GridIndex
 
 def extract_boundary(df):
     """
@@ -34,11 +32,26 @@ def extract_boundary(df):
             if lat > ne['lat']:
                 ne['lat'] = lat
 
+    return boundary_from_bounds(sw['log'], sw['lat'], ne['log'], ne['lat'])
+
+def boundary_from_bounds(min_lon, min_lat, max_lon, max_lat):
+    """
+        Build the GeoDataFrame returned by extract_boundary from precomputed bounds.
+
+        min_lon, min_lat: coordinates of the bottom left point of an area
+        max_lon, max_lat: coordinates of the top right point of an area
+
+        Return a GeoDataFrame with a rectangle-shaped polygon delimiting the area
+    """
     # Construct a rectangle-shaped polygon delimiting its boundary
-    sw_coords = [sw['log'], sw['lat']]
-    ne_coords = [ne['log'], ne['lat']]
-    nw_coords = [sw['log'], ne['lat']]
-    se_coords = [ne['log'], sw['lat']]
+    sw_coords = [min_lon, min_lat]
+    ne_coords = [max_lon, max_lat]
+    nw_coords = [min_lon, max_lat]
+    se_coords = [max_lon, min_lat]
+
+    import pandas as pd
+    import geopandas as gpd
+    from shapely.geometry import Polygon
 
     boundary = [sw_coords, nw_coords, ne_coords, se_coords, sw_coords]
     poly = Polygon(boundary)
@@ -56,27 +69,77 @@ def extract_area_center(gdf):
     centroid = gdf.geometry[0].centroid
     return [float(centroid.y), float(centroid.x)]
 
-def traj_to_geojson(trajectory):
+class VisualizationSample:
     """
-        Convert a list of Shapely points to a GeoJSON feature collection for frontend visualization
+        Streaming reservoir of trajectories bounded by a feature and a total point budget.
+
+        Every trajectory gets a random priority and the reservoir keeps those with the
+        smallest priorities whose point counts, in priority order, add up to at most
+        max_points, and no more than max_features of them. That is a uniform sample of
+        the input however it is split into chunks, and memory never exceeds the budgets.
+        Trajectories longer than max_points on their own are never kept.
+
+        max_features: most trajectories kept, VISUALIZATION_MAX_FEATURES by default
+        max_points: most points kept in total, VISUALIZATION_MAX_POINTS by default
+        seed: seed of the priorities, fixed so that the same input gives the same picture
+    """
+    def __init__(self, max_features=None, max_points=None, seed=404):
+        self.max_features = int(max_features or getattr(settings, 'VISUALIZATION_MAX_FEATURES', 2000))
+        self.max_points = int(max_points or getattr(settings, 'VISUALIZATION_MAX_POINTS', 100_000))
+        self.sentences = None
+        self._priority = np.empty(0)
+        self._rng = np.random.default_rng(seed)
+
+    def add(self, sentences):
+        """
+            Offer a chunk of trajectories (tokens.Sentences) to the reservoir
+        """
+        priority = self._rng.random(len(sentences))
+        fits = np.flatnonzero(sentences.lengths <= self.max_points)
+        pool = sentences.take(fits)
+        priority = priority[fits]
+        if self.sentences is not None:
+            pool = type(sentences).concat([self.sentences, pool])
+            priority = np.concatenate([self._priority, priority])
+
+        # Later chunks only insert before kept items, so anything past the budget now stays out
+        order = np.argsort(priority, kind='stable')[:self.max_features]
+        count = np.searchsorted(np.cumsum(pool.lengths[order]), self.max_points, side='right')
+        keep = np.sort(order[:count])
+        self.sentences, self._priority = pool.take(keep), priority[keep]
+        return self
+
+def visualization_sample(sentences, max_features=None, max_points=None, seed=404):
+    """
+        Draw trajectories for display within a feature and a point budget
+
+        sentences: tokens.Sentences to draw from
+
+        Return tokens.Sentences with the drawn trajectories in their original order
+    """
+    return VisualizationSample(max_features, max_points, seed).add(sentences).sentences
+
+def traj_to_geojson(sentences, max_features=None, max_points=None):
+    """
+        Convert trajectories to a GeoJSON feature collection for frontend visualization
+
+        sentences: tokens.Sentences holding the coordinates of each trajectory
+        max_features, max_points: budgets of the displayed sample, see VisualizationSample
 
-        trajectory: Pandas dataframe containing trajectory data. One of its columns must be 
-              'geometry', with each of its row being a list of coordinate pairs.
         Return a dictionary in geojson feature collection format
     """
     features = []
 
     # Randomly select a subset of trajectories
-    sample = trajectory['geometry'].sample(frac=0.5, random_state=404).to_list() 
+    sample = visualization_sample(sentences, max_features, max_points)
 
-    for traj in sample:
-        # GeoJSON coordinate format [lon, lat]
-        coords = [[point.x, point.y] for point in traj]
+    for i in range(len(sample)):
         features.append({
             'type': 'Feature',
             'geometry': {
                 'type': 'LineString',
-                'coordinates': coords
+                # GeoJSON coordinate format [lon, lat]
+                'coordinates': sample.coords_of(i).tolist()
             }
         })
 
@@ -85,42 +148,40 @@ def traj_to_geojson(trajectory):
         'features': features
     }
 
-def heatmap_geojson(df, area, cell_size=200):
+def heatmap_geojson(sentences, area, cell_size=200, max_trajectories=None):
     """
         Prepare heatmap data in a GeoJSON format for frontend visualization
 
-        df: dataframe containing trajectories in list of coordinate pairs
+        sentences: tokens.Sentences holding the coordinates of trajectories
         area: a GeoDataFrame defining the boundary of a geographical area
         cell_size: size of cells in meters
+        max_trajectories: most trajectories counted; points are capped by HEATMAP_MAX_POINTS
 
         Return a GeoJSON feature collection with data necessary for plotting a heatmap in frontend
     """
-    # Initialize a TokenCreator instance
-    TokenCreator = ConvertToToken(df, area, cell_size)
-    grid, _, num_cells = TokenCreator.create_grid()
+    from shapely.geometry import mapping
 
-    # Merge grid with Shapely points in df
-    display_traj_tmp = DisplayTrajs([], [])
-    merged_df = display_traj_tmp.merge_grid_with_points(grid, df, num_cells)
+    sentences = visualization_sample(sentences, max_trajectories or len(sentences) or 1,
+                                     getattr(settings, 'HEATMAP_MAX_POINTS', 1_000_000))
 
-    # Get point counts in each region
-    valid_df = merged_df[merged_df['point_region'] != 'nan']
-    polygon_counts = valid_df['point_region'].value_counts()
+    # Count points in each cell of the heatmap grid, ignoring those outside of it
+    grid_index = GridIndex(area, cell_size)
+    cells = grid_index.lookup(sentences.coords)
+    counts = np.bincount(cells[cells >= 0], minlength=grid_index.num_cells)
 
     # Normalize counts using a approach similar to matplotlib
-    if len(polygon_counts) > 0:
-        max_count = polygon_counts.max()
-        min_count = polygon_counts.min()
+    nonzero = counts[counts > 0]
+    if len(nonzero) > 0:
+        max_count = nonzero.max()
+        min_count = nonzero.min()
     else:
         max_count = 1
         min_count = 0
 
-    # Construct feature array
+    # Construct feature array, cells in the column-major order of their IDs
     features = []
-    for _, region in grid.iterrows():
-        count = polygon_counts.get(region['geometry'], 0)
-
-        normalized = (count - min_count) / (max_count - min_count)
+    for cell, count in zip(grid_index.cells, counts.tolist()):
+        normalized = (count - min_count) / (max_count - min_count) if max_count != min_count else 0.0
 
         feature = {
             'type': 'Feature',
@@ -128,7 +189,7 @@ def heatmap_geojson(df, area, cell_size=200):
                 'count': int(count),
                 'normalized': float(normalized),
             },
-            'geometry': mapping(region['geometry'])
+            'geometry': mapping(cell)
         }
         features.append(feature)
 
@@ -149,6 +210,8 @@ def convert_time(df, lon, lat):
 
         Returns modified dataframe with timestamp column represented by a 24-hour formatted time 
     """
+    from timezonefinder import TimezoneFinder
+
     # Obtain timezone from coords
     tz = TimezoneFinder()
     timezone = tz.timezone_at(lng=lon, lat=lat)
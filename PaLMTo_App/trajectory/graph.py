@@ -0,0 +1,276 @@
+"""
+    Bigram transition graph of an n-gram model in compressed sparse row form and its reachability index
+"""
+from collections import deque
+
+import numpy as np
+from django.conf import settings
+
+from .tokens import unpack
+
+# Added to every edge cost so that certain transitions (probability 1) remain edges
+MIN_EDGE_COST = 1e-6
+
+# Condensations up to this many components keep their full transitive closure as
+# bitsets, at most 2MB
+MAX_CLOSURE_COMPONENTS = 4096
+
+# Hop distance stored for cells a landmark search never reached
+UNREACHED = np.iinfo(np.int32).max
+
+
+class TransitionGraph:
+    """Cells of a model as nodes and observed bigrams as weighted directed edges.
+
+    Successors of cell a are indices[indptr[a]:indptr[a + 1]], sorted, with the bigram
+    counts in the aligned slice of counts. Self-transitions, i.e. consecutive points in
+    the same cell, carry no movement and are left out.
+    """
+
+    def __init__(self, num_cells, indptr, indices, counts):
+        self.num_cells = int(num_cells)
+        self.indptr = np.ascontiguousarray(indptr, dtype=np.int64)
+        self.indices = np.ascontiguousarray(indices, dtype=np.int32)
+        self.counts = np.ascontiguousarray(counts, dtype=np.int64)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    @classmethod
+    def from_model(cls, ngrams, reverse=False):
+        """Build the graph of a model's bigrams.
+
+        Args:
+            ngrams(tokens.NgramModel): model whose bigram counts become edge weights
+            reverse(bool): point edges from the second token of each bigram to the first,
+                which lets searches walk backward from a destination
+        """
+        num_cells = ngrams.num_cells
+        first, second = unpack(ngrams.bigram_keys, 2, num_cells)
+        counts = ngrams.bigram_counts
+        moves = first != second
+        first, second, counts = first[moves], second[moves], counts[moves]
+
+        if reverse:
+            first, second = second, first
+            # Forward keys are sorted by (first, second); reversed ones must be re-sorted
+            order = np.lexsort((second, first))
+            first, second, counts = first[order], second[order], counts[order]
+
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(first, minlength=num_cells))))
+        return cls(num_cells, indptr, second, counts)
+
+    def successors(self, token):
+        """Return successor cells of a cell and the counts of those transitions."""
+        start, end = self.indptr[token], self.indptr[token + 1]
+        return self.indices[start:end], self.counts[start:end]
+
+    def out_degree(self):
+        return np.diff(self.indptr)
+
+    def probabilities(self):
+        """Return the probability of each edge given that its source cell is left."""
+        sources = self.sources()
+        totals = np.bincount(sources, weights=self.counts, minlength=self.num_cells)
+        return self.counts / totals[sources]
+
+    def sources(self):
+        """Return the source cell of each edge."""
+        return np.repeat(np.arange(self.num_cells, dtype=np.int32), self.out_degree())
+
+    def costs(self):
+        """Return negative log-probabilities of edges, so that shortest paths are most likely."""
+        return -np.log(self.probabilities()) + MIN_EDGE_COST
+
+    def to_csgraph(self, weights=None):
+        """Return the graph as a SciPy sparse matrix for scipy.sparse.csgraph routines.
+
+        Args:
+            weights(np.ndarray): positive weight of each edge, costs() by default
+        """
+        from scipy.sparse import csr_matrix
+
+        weights = self.costs() if weights is None else weights
+        return csr_matrix((weights, self.indices, self.indptr), shape=(self.num_cells, self.num_cells))
+
+
+class ReachabilityIndex:
+    """Precomputed reachability between cells of a transition graph.
+
+    Cells are grouped into strongly connected components, which are ordered
+    topologically in their condensation. For up to MAX_CLOSURE_COMPONENTS components
+    the transitive closure of the condensation is kept as bitsets, which answers
+    reachability exactly in O(1). Beyond that, the topological order and landmark
+    distances rule out most unreachable pairs, and the remaining answers are "maybe".
+
+    Hop distances from and to a few landmarks also give ALT lower bounds on the number
+    of hops between any two cells, which searches use to steer toward their target.
+    """
+
+    def __init__(self, components, rank, closure, landmarks, from_landmarks, to_landmarks):
+        self.components = np.ascontiguousarray(components, dtype=np.int32)
+        self.rank = np.ascontiguousarray(rank, dtype=np.int32)
+        self.closure = closure
+        self.landmarks = np.asarray(landmarks, dtype=np.int32)
+        self.from_landmarks = from_landmarks
+        self.to_landmarks = to_landmarks
+
+    @property
+    def num_components(self):
+        return len(self.rank)
+
+    @classmethod
+    def build(cls, graph, num_landmarks=None):
+        """Compute components, their order and closure, and landmark distances of a graph.
+
+        Args:
+            graph(TransitionGraph): forward transition graph of a model
+            num_landmarks(int): number of landmarks, GRAPH_LANDMARKS by default
+        """
+        from scipy.sparse.csgraph import connected_components
+
+        if num_landmarks is None:
+            num_landmarks = getattr(settings, 'GRAPH_LANDMARKS', 8)
+        matrix = graph.to_csgraph(np.ones(graph.num_edges))
+        num_components, components = connected_components(matrix, directed=True, connection='strong')
+
+        # Edges of the condensation, without duplicates and self-loops
+        sources = components[graph.sources()]
+        targets = components[graph.indices]
+        between = sources != targets
+        keys = np.unique(sources[between].astype(np.int64) * num_components + targets[between])
+        dag_sources, dag_targets = keys // num_components, keys % num_components
+
+        order = _topological_order(num_components, dag_sources, dag_targets)
+        rank = np.empty(num_components, dtype=np.int32)
+        rank[order] = np.arange(num_components, dtype=np.int32)
+
+        closure = None
+        if num_components <= MAX_CLOSURE_COMPONENTS:
+            closure = _closure_bitsets(num_components, order, dag_sources, dag_targets)
+
+        landmarks = _pick_landmarks(matrix, graph, num_landmarks)
+        from_landmarks = _hop_distances(matrix, landmarks)
+        to_landmarks = _hop_distances(matrix.T.tocsr(), landmarks)
+        return cls(components, rank, closure, landmarks, from_landmarks, to_landmarks)
+
+    def reachable(self, source, target):
+        """Whether target may be reached from source; False is always exact."""
+        a, b = self.components[source], self.components[target]
+        if a == b:
+            return True
+        if self.rank[a] > self.rank[b]:
+            return False
+        if self.closure is not None:
+            return bool(self.closure[a, b >> 3] & (1 << (b & 7)))
+        return not self._landmarks_exclude(source, target)
+
+    def reachable_many(self, sources, targets):
+        """Vectorized reachable() over cells, broadcasting sources against targets."""
+        sources, targets = np.broadcast_arrays(np.asarray(sources), np.asarray(targets))
+        a, b = self.components[sources], self.components[targets]
+        result = (a == b) | (self.rank[a] < self.rank[b])
+        if self.closure is not None:
+            result &= (a == b) | ((self.closure[a, b >> 3] >> (b & 7)) & 1).astype(bool)
+        elif len(self.landmarks):
+            result &= ~self._landmarks_exclude(sources, targets)
+        return result
+
+    def _landmarks_exclude(self, source, target):
+        # A landmark reaching source but not target, or reached from target but not
+        # from source, proves that target can't be reached from source
+        from_s, from_t = self.from_landmarks[:, source], self.from_landmarks[:, target]
+        to_s, to_t = self.to_landmarks[:, source], self.to_landmarks[:, target]
+        excluded = ((from_s < UNREACHED) & (from_t == UNREACHED)) | ((to_s == UNREACHED) & (to_t < UNREACHED))
+        return excluded.any(axis=0)
+
+    def hop_bounds(self, sources, targets):
+        """Lower bounds on the number of hops between cells, broadcasting sources against targets.
+
+        Uses the triangle inequality over landmarks L: d(u, v) >= d(L, v) - d(L, u) and
+        d(u, v) >= d(u, L) - d(v, L), counting only finite distances.
+        """
+        sources, targets = np.broadcast_arrays(np.asarray(sources), np.asarray(targets))
+        if not len(self.landmarks):
+            return np.zeros(sources.shape, dtype=np.int64)
+        from_s = self.from_landmarks[:, sources].astype(np.int64)
+        from_t = self.from_landmarks[:, targets].astype(np.int64)
+        to_s = self.to_landmarks[:, sources].astype(np.int64)
+        to_t = self.to_landmarks[:, targets].astype(np.int64)
+        forward = np.where((from_s < UNREACHED) & (from_t < UNREACHED), from_t - from_s, 0)
+        backward = np.where((to_s < UNREACHED) & (to_t < UNREACHED), to_s - to_t, 0)
+        return np.maximum(np.maximum(forward, backward).max(axis=0), 0)
+
+
+def _topological_order(num_nodes, sources, targets):
+    """Order nodes of a DAG so that every edge points forward (Kahn's algorithm)."""
+    indegree = np.bincount(targets, minlength=num_nodes)
+    order_by_source = np.argsort(sources, kind='stable')
+    successors = targets[order_by_source]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=num_nodes))))
+
+    ready = deque(np.flatnonzero(indegree == 0).tolist())
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        for successor in successors[indptr[node]:indptr[node + 1]].tolist():
+            indegree[successor] -= 1
+            if indegree[successor] == 0:
+                ready.append(successor)
+    return np.array(order, dtype=np.int64)
+
+
+def _closure_bitsets(num_nodes, order, sources, targets):
+    """Return a bitset per DAG node of every node it reaches, itself included."""
+    closure = np.zeros((num_nodes, (num_nodes + 7) // 8), dtype=np.uint8)
+    nodes = np.arange(num_nodes)
+    closure[nodes, nodes >> 3] = (1 << (nodes & 7)).astype(np.uint8)
+
+    order_by_source = np.argsort(sources, kind='stable')
+    successors = targets[order_by_source]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=num_nodes))))
+    # Successors come later in topological order, so their closures are complete first
+    for node in order[::-1].tolist():
+        children = successors[indptr[node]:indptr[node + 1]]
+        if len(children):
+            closure[node] |= np.bitwise_or.reduce(closure[children], axis=0)
+    return closure
+
+
+def _hop_distances(matrix, landmarks):
+    """Breadth-first hop counts from each landmark, UNREACHED where there is no path."""
+    from scipy.sparse.csgraph import shortest_path
+
+    if not len(landmarks):
+        return np.empty((0, matrix.shape[0]), dtype=np.int32)
+    distances = shortest_path(matrix, directed=True, unweighted=True, indices=landmarks)
+    return np.where(np.isinf(distances), UNREACHED, distances).astype(np.int32)
+
+
+def _pick_landmarks(matrix, graph, count):
+    """Spread landmarks over the graph by farthest-point selection on undirected hops.
+
+    The first landmark is the cell with most transitions; each next one is the cell
+    farthest from all landmarks picked so far.
+    """
+    from scipy.sparse.csgraph import shortest_path
+
+    degree = graph.out_degree() + np.bincount(graph.indices, minlength=graph.num_cells)
+    count = min(count, int(np.count_nonzero(degree)))
+    if count == 0:
+        return np.empty(0, dtype=np.int32)
+
+    undirected = matrix + matrix.T
+    landmarks = [int(np.argmax(degree))]
+    nearest = shortest_path(undirected, directed=False, unweighted=True, indices=landmarks[0])
+    while len(landmarks) < count:
+        # Unreached cells of other components are the farthest of all
+        candidates = np.where(degree > 0, np.where(np.isinf(nearest), np.finfo(float).max, nearest), -1)
+        candidate = int(np.argmax(candidates))
+        if candidates[candidate] <= 0:
+            break
+        landmarks.append(candidate)
+        nearest = np.minimum(nearest, shortest_path(undirected, directed=False, unweighted=True, indices=candidate))
+    return np.array(landmarks, dtype=np.int32)
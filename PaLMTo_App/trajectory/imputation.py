@@ -0,0 +1,214 @@
+"""
+    Filling gaps of sparse trajectories with token paths of a cached n-gram model
+"""
+from itertools import chain
+from contextlib import ExitStack
+
+import numpy as np
+from django.conf import settings
+
+from .cancellation import checkpoint, pool_results
+from .formats import TrajectoryWriter, iter_trajectory_batches
+from .generation import derive_seed, generation_workers
+from .graph import MIN_EDGE_COST, TransitionGraph
+from .tokens import GridIndex
+
+IMPUTATION_MODES = ('likely', 'sampled')
+
+# Shortest-path rows computed per call are bounded by sources x cells entries
+MAX_SEARCH_ENTRIES = 2 ** 22
+
+# Imputer installed in each pool worker by _init_worker
+_WORKER_IMPUTER = None
+
+
+def batch_rows():
+    """Return number of trajectories imputed per task."""
+    return getattr(settings, 'IMPUTATION_BATCH_ROWS', 2000)
+
+
+def max_hops():
+    """Return the longest token path inserted into a single gap."""
+    return getattr(settings, 'IMPUTATION_MAX_HOPS', 100)
+
+
+class Imputer:
+    """Find gaps between consecutive points of trajectories and bridge them with cell paths.
+
+    A gap lies between two known points whose cells are neither equal nor adjacent.
+    In "likely" mode it is filled with the most probable path of the model's bigram
+    transition graph, i.e. the shortest path under negative log-probabilities. In
+    "sampled" mode each edge cost is a random delay Exp(1) / p, so likelier transitions
+    are taken more often but any observed path can be drawn.
+
+    Args:
+        grid_index(tokens.GridIndex): grid the model was built on
+        graph(graph.TransitionGraph): bigram transitions of the model
+        mode(str): "likely" or "sampled"
+        hops(int): longest path inserted into one gap; longer gaps are left unfilled
+    """
+
+    def __init__(self, grid_index, graph, mode='likely', hops=None):
+        if mode not in IMPUTATION_MODES:
+            raise ValueError(f"mode must be one of {list(IMPUTATION_MODES)}")
+        self.grid_index = grid_index
+        self.graph = graph
+        self.mode = mode
+        self.hops = hops or max_hops()
+        self.probabilities = graph.probabilities()
+        self.costs = graph.costs()
+
+    @classmethod
+    def from_cache(cls, cached_data, mode='likely', hops=None):
+        """Build an imputer from a loaded n-gram cache."""
+        grid_index = GridIndex(cached_data['study_area'], cached_data['cell_size'])
+        return cls(grid_index, TransitionGraph.from_model(cached_data['ngrams']), mode, hops)
+
+    def find_gaps(self, tokens, lengths):
+        """Locate gaps between consecutive points of the same trajectory.
+
+        Args:
+            tokens(np.ndarray): cell ID of every point, -1 outside the grid
+            lengths(np.ndarray): number of points of each trajectory
+
+        Returns:
+            np.ndarray: positions of points that are followed by a gap
+        """
+        n_rows = self.grid_index.n_rows
+        same_trip = np.ones(max(len(tokens) - 1, 0), dtype=bool)
+        ends = np.cumsum(lengths)[:-1]
+        same_trip[ends[(ends > 0) & (ends < len(tokens))] - 1] = False
+
+        first, second = tokens[:-1], tokens[1:]
+        col_step = np.abs(first // n_rows - second // n_rows)
+        row_step = np.abs(first % n_rows - second % n_rows)
+        return np.flatnonzero(same_trip & (first >= 0) & (second >= 0) & (np.maximum(col_step, row_step) > 1))
+
+    def shortest_paths(self, sources, targets, rng):
+        """Find cell paths for pairs of cells, grouping searches by source cell.
+
+        Returns:
+            list: interior cells of the path of each pair, empty when the model moves
+                between them directly and None where no path with at most self.hops interior
+                cells exists
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        graph = self.graph
+        csgraph = graph.to_csgraph(self.costs)
+        paths = [None] * len(sources)
+        unique_sources, inverse = np.unique(sources, return_inverse=True)
+        block = max(1, MAX_SEARCH_ENTRIES // max(graph.num_cells, 1))
+
+        for start in range(0, len(unique_sources), block):
+            block_sources = unique_sources[start:start + block]
+            if self.mode == 'sampled':
+                # Paths from sources of one block share a draw of edge delays
+                csgraph = graph.to_csgraph(rng.exponential(size=graph.num_edges) / self.probabilities + MIN_EDGE_COST)
+            _, predecessors = dijkstra(csgraph, directed=True,
+                                       indices=block_sources, return_predecessors=True)
+
+            for i in np.flatnonzero((inverse >= start) & (inverse < start + len(block_sources))):
+                row = predecessors[inverse[i] - start]
+                source, cell = int(sources[i]), int(targets[i])
+                interior = []
+                while len(interior) <= self.hops:
+                    cell = int(row[cell])
+                    if cell < 0 or cell == source:
+                        break
+                    interior.append(cell)
+                if cell == source and len(interior) <= self.hops:
+                    paths[i] = interior[::-1]
+        return paths
+
+    def impute(self, others, coords, lengths, seed=None):
+        """Fill the gaps of a batch of trajectories.
+
+        Args:
+            others(pd.DataFrame): columns other than geometry, one row per trajectory
+            coords(np.ndarray): (num_points, 2) coordinates of all trajectories
+            lengths(np.ndarray): number of points of each trajectory
+            seed(int): seed of the edge delays drawn in "sampled" mode
+
+        Returns:
+            tuple: DataFrame of imputed trajectories with an "imputed_points" column and a
+                dictionary of gap statistics
+        """
+        tokens = self.grid_index.lookup(coords)
+        gaps = self.find_gaps(tokens, lengths)
+        paths = self.shortest_paths(tokens[gaps], tokens[gaps + 1], np.random.default_rng(seed))
+
+        # Insert centroids of interior cells right after the point that opens each gap
+        filled = [(gap, path) for gap, path in zip(gaps.tolist(), paths) if path is not None]
+        opening = np.array([gap for gap, _ in filled], dtype=np.int64)
+        inserted = np.array([len(path) for _, path in filled], dtype=np.int64)
+        cells = np.fromiter(chain.from_iterable(path for _, path in filled), dtype=np.int64, count=int(inserted.sum()))
+        new_coords = np.insert(coords, np.repeat(opening + 1, inserted), self.grid_index.tokens.centroids[cells], axis=0)
+
+        trip_of_point = np.repeat(np.arange(len(lengths)), lengths)
+        imputed = np.bincount(trip_of_point[opening], weights=inserted, minlength=len(lengths)).astype(np.int64)
+        new_lengths = lengths + imputed
+        splits = np.cumsum(new_lengths)[:-1]
+
+        df = others.reset_index(drop=True).copy()
+        df['geometry'] = [part.tolist() for part in np.split(new_coords, splits)] if len(lengths) else []
+        df['imputed_points'] = imputed
+
+        stats = {
+            'trajectories': len(lengths),
+            'points': int(lengths.sum()),
+            'gaps': len(gaps),
+            'filledGaps': len(filled),
+            'unfilledGaps': len(gaps) - len(filled),
+            'imputedPoints': int(inserted.sum())
+        }
+        return df, stats
+
+
+def _init_worker(imputer):
+    """Install an imputer in a pool worker."""
+    global _WORKER_IMPUTER
+    _WORKER_IMPUTER = imputer
+
+
+def _impute_in_worker(others, coords, lengths, seed):
+    return _WORKER_IMPUTER.impute(others, coords, lengths, seed)
+
+
+def run_imputation(imputer, input_path, output_path, seed, on_progress=None, workers=None):
+    """Impute every trajectory of a file and stream the results to another file.
+
+    Batches are imputed in worker processes and written in input order as soon as
+    they are ready. Each batch draws from its own seed derived from seed, so results
+    don't depend on the number of workers.
+
+    Args:
+        imputer(Imputer): imputer shared by every batch
+        input_path(str): CSV, Parquet or Feather file of gapped trajectories
+        output_path(str): file the imputed trajectories are written to
+        seed(int): root seed of "sampled" mode
+        on_progress(callable): called with the statistics accumulated so far
+        workers(int): worker processes to use, defaults to generation_workers()
+
+    Returns:
+        dict: gap statistics of the whole file
+    """
+    workers = workers or generation_workers()
+    tasks = ((others, coords, lengths, derive_seed(seed, i)) for i, (others, coords, lengths) in enumerate(
+        iter_trajectory_batches(input_path, batch_rows(), columns=('trip_id', 'timestamp', 'geometry'))))
+
+    totals = dict.fromkeys(['trajectories', 'points', 'gaps', 'filledGaps', 'unfilledGaps', 'imputedPoints'], 0)
+    with TrajectoryWriter(output_path) as writer, ExitStack() as stack:
+        if workers <= 1:
+            results = (imputer.impute(*task) for task in tasks)
+        else:
+            results = pool_results(stack, _impute_in_worker, tasks, workers, _init_worker, (imputer,))
+
+        for df, stats in results:
+            writer.write(df)
+            for key, value in stats.items():
+                totals[key] += value
+            if on_progress is not None:
+                on_progress(totals)
+            checkpoint()
+    return totals
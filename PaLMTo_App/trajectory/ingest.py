@@ -0,0 +1,215 @@
+"""
+    Out-of-core ingest building n-gram models chunk by chunk from trajectory files
+"""
+import os
+
+import numpy as np
+from django.conf import settings
+
+from .cancellation import checkpoint
+from .formats import iter_trajectory_batches
+from .geo_process import boundary_from_bounds
+from .tokens import GridIndex, NgramModel, Sentences
+
+# Original trajectories kept in the cache for visualization and heatmaps
+SAMPLE_TRIPS = 5000
+
+# Start/end bigram pairs kept for origin sampling. A uniform reservoir of this size
+# preserves their distribution without growing with the dataset.
+MAX_START_END_POINTS = 200_000
+
+
+def use_chunked_ingest(data, file_path):
+    """Decide whether an upload is ingested in chunks.
+
+    Args:
+        data(QueryDict): request data with an optional "ingest_mode" of "chunked" or "memory"
+        file_path(str): path of uploaded trajectory file
+
+    Returns:
+        bool: True for explicit chunked mode or files above INGEST_CHUNKED_THRESHOLD_MB
+    """
+    mode = data.get('ingest_mode')
+    if mode in ('chunked', 'memory'):
+        return mode == 'chunked'
+    threshold = getattr(settings, 'INGEST_CHUNKED_THRESHOLD_MB', 512) * 1024 * 1024
+    return os.path.getsize(file_path) >= threshold
+
+
+def chunk_rows():
+    """Return number of trajectories parsed per chunk."""
+    return getattr(settings, 'INGEST_CHUNK_ROWS', 20000)
+
+
+def iter_chunks(file_path, rows=None):
+    """Yield trip ids, flat (lon, lat) coordinates and per-trip point counts of each chunk.
+
+    Only the "trip_id" and "geometry" columns are read. A cancelled job stops at the
+    next chunk.
+    """
+    start = 0
+    for chunk, coords, lengths in iter_trajectory_batches(file_path, rows or chunk_rows()):
+        checkpoint()
+        if 'trip_id' in chunk:
+            trip_ids = chunk['trip_id'].tolist()
+        else:
+            trip_ids = list(range(start, start + len(lengths)))
+        start += len(lengths)
+
+        yield trip_ids, coords, lengths
+
+
+def stream_bounds(file_path, rows=None):
+    """First pass over a file computing the study-area bounds.
+
+    Returns:
+        tuple: (min_lon, min_lat, max_lon, max_lat), number of trajectories and number of points
+    """
+    bounds = [np.inf, np.inf, -np.inf, -np.inf]
+    num_trips = num_points = 0
+
+    for _, coords, lengths in iter_chunks(file_path, rows):
+        num_trips += len(lengths)
+        num_points += len(coords)
+        if len(coords):
+            bounds[0] = min(bounds[0], coords[:, 0].min())
+            bounds[1] = min(bounds[1], coords[:, 1].min())
+            bounds[2] = max(bounds[2], coords[:, 0].max())
+            bounds[3] = max(bounds[3], coords[:, 1].max())
+
+    if not num_points:
+        raise ValueError("Trajectory file contains no points.")
+    return tuple(float(bound) for bound in bounds), num_trips, num_points
+
+
+def tokenize_frame(df, grid_index, rows=None):
+    """Tokenize the trajectories of a DataFrame chunk by chunk, stopping at checkpoints.
+
+    Points outside the grid are dropped, and so are trajectories left without any, as
+    the spatial join of ConvertToToken.create_tokens does. Each row is treated as one trip.
+
+    Args:
+        df(pd.DataFrame): trajectories with "geometry" lists of [lon, lat] and an optional "trip_id"
+        grid_index(tokens.GridIndex): grid laid over the study area
+        rows(int): trajectories per chunk, defaults to INGEST_CHUNK_ROWS
+
+    Returns:
+        tokens.Sentences: tokenized trajectories with their recorded points
+    """
+    rows = rows or chunk_rows()
+    geometry = df['geometry'].tolist()
+    trip_ids = df['trip_id'].to_numpy() if 'trip_id' in df else np.arange(len(df))
+    parts = []
+    for start in range(0, len(geometry), rows):
+        checkpoint()
+        trajs = geometry[start:start + rows]
+        lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+        coords = np.array([point for traj in trajs for point in traj], dtype=np.float64).reshape(-1, 2)
+        tokens = grid_index.lookup(coords)
+        valid = tokens >= 0
+        counts = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[valid], minlength=len(lengths))
+        sentences = Sentences(tokens[valid], np.concatenate(([0], np.cumsum(counts))), coords[valid],
+                              trip_ids[start:start + rows])
+        parts.append(sentences.take(np.flatnonzero(counts)))
+    if not parts:
+        raise ValueError("Trajectory file contains no points.")
+    return Sentences.concat(parts)
+
+
+def _keep_smallest(priorities, size):
+    """Positions of the size smallest priorities, i.e. a uniform sample without replacement."""
+    if len(priorities) <= size:
+        return np.arange(len(priorities))
+    return np.argpartition(priorities, size)[:size]
+
+
+class NgramAccumulator:
+    """Accumulate n-gram counts, start/end bigrams and sample trips chunk by chunk.
+
+    Memory is bounded by the number of distinct n-grams plus two fixed-size samples,
+    independent of how many trajectories pass through. Both samples keep the items
+    with the smallest random priorities, which is uniform over the whole file.
+    """
+
+    def __init__(self, num_cells, seed=404):
+        self.model = NgramModel.empty(num_cells)
+        self.samples = None
+        self._rng = np.random.default_rng(seed)
+        self._start_end_priority = np.empty(0)
+        self._sample_priority = np.empty(0)
+
+    def add_chunk(self, trip_ids, coords, tokens, lengths):
+        """Add tokenized trajectories of one chunk.
+
+        Args:
+            trip_ids(list): identifier of each trajectory
+            coords(np.ndarray): (num_points, 2) coordinates of all trajectories
+            tokens(np.ndarray): cell ID of each point, -1 outside the grid
+            lengths(np.ndarray): number of points of each trajectory
+        """
+        # Points outside the grid are dropped, as the spatial join of an in-memory build does
+        valid = tokens >= 0
+        counts = np.bincount(np.repeat(np.arange(len(lengths)), lengths)[valid], minlength=len(lengths))
+        sentences = Sentences(tokens[valid], np.concatenate(([0], np.cumsum(counts))), coords[valid],
+                              np.asarray(trip_ids))
+
+        chunk = NgramModel.from_sentences(sentences, self.model.num_cells)
+        self.model.merge(chunk)
+        priority = np.concatenate([self._start_end_priority, self._rng.random(len(chunk.start_end))])
+        keep = _keep_smallest(priority, MAX_START_END_POINTS)
+        self.model.start_end, self._start_end_priority = self.model.start_end[keep], priority[keep]
+
+        trips = sentences.take(np.flatnonzero(counts))
+        if self.samples is not None:
+            trips = Sentences.concat([self.samples, trips])
+        priority = np.concatenate([self._sample_priority, self._rng.random(len(trips) - len(self._sample_priority))])
+        keep = _keep_smallest(priority, SAMPLE_TRIPS)
+        self.samples, self._sample_priority = trips.take(keep), priority[keep]
+
+
+def build_ngrams_chunked(file_path, cell_size, recorder, rows=None):
+    """Build an n-gram model in two streaming passes over a trajectory file.
+
+    The first pass computes the study-area bounds; the second tokenizes each chunk and
+    accumulates n-gram counts. Peak memory depends on the chunk size and the model,
+    not on the size of the dataset. Each row of the file is treated as one trip.
+
+    Args:
+        file_path(str): path of trajectory file with "trip_id" and "geometry" columns
+        cell_size(int): side length of grid cells in meters
+        recorder(metrics.StageRecorder): stage timer factory bound to a progress queue
+        rows(int): trajectories per chunk, defaults to INGEST_CHUNK_ROWS
+
+    Returns:
+        tuple: NgramModel, TokenTable, sampled Sentences, study_area and a stats dictionary
+    """
+    with recorder.stage('ingest', 'Scanning trajectory file for study area bounds', 20) as stage:
+        bounds, num_trips, num_points = stream_bounds(file_path, rows)
+        study_area = boundary_from_bounds(*bounds)
+        grid_index = GridIndex(study_area, cell_size)
+        stage.rows = num_trips
+        stage.points = num_points
+
+    accumulator = NgramAccumulator(grid_index.num_cells)
+    with recorder.stage('tokenize', 'Tokenizing trajectories in chunks', 40) as stage:
+        done = 0
+        for trip_ids, coords, lengths in iter_chunks(file_path, rows):
+            accumulator.add_chunk(trip_ids, coords, grid_index.lookup(coords), lengths)
+            done += len(lengths)
+            if recorder.queue is not None:
+                recorder.queue.put({
+                    'type': 'progress',
+                    'message': f'Tokenized {done} of {num_trips} trajectories',
+                    'progress': 40 + int(30 * done / max(num_trips, 1))
+                })
+        stage.rows = done
+        stage.points = num_points
+
+    model = accumulator.model
+    stats = {
+        'cellsCreated': grid_index.num_cells,
+        'totalPairs': num_points,
+        'uniqueBigrams': model.num_bigrams,
+        'uniqueTrigrams': model.num_trigrams
+    }
+    return model, grid_index.tokens, accumulator.samples, study_area, stats
@@ -0,0 +1,150 @@
+"""
+    Progress queues of background jobs and a durable store of their status and results
+"""
+import time
+import threading
+from queue import Queue
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cancellation import CANCELLATION
+from .models import JobResult
+
+# A global queue for holding progress messages of each task
+PROGRESS_QUEUES = {}
+_QUEUES_LOCK = threading.Lock()
+
+# Events that end a job; the last one is kept in the store and replayed to late clients
+TERMINAL_EVENTS = ('complete', 'error', 'cancelled')
+
+# Seconds between two writes of plain progress events of a job to the store
+PROGRESS_WRITE_INTERVAL = 1.0
+
+
+def result_ttl():
+    """Return how long records of jobs are kept after their last update."""
+    return timedelta(seconds=getattr(settings, 'JOB_RESULT_TTL_SECONDS', 24 * 3600))
+
+
+def create_job(task_id, kind):
+    """Record a newly accepted job as queued and drop records that have expired.
+
+    Args:
+        task_id(str): identifier handed to the client
+        kind(str): "ngram", "generation", "batch_generation", "imputation" or "map_matching"
+    """
+    now = timezone.now()
+    try:
+        JobResult.objects.filter(expires_at__lt=now).delete()
+        JobResult.objects.create(task_id=task_id, kind=kind, expires_at=now + result_ttl())
+    except Exception as e:
+        print(f"Failed to record job {task_id}: {e}")
+
+
+def record_event(task_id, event):
+    """Write a progress event of a job to its record, keeping terminal events in full."""
+    now = timezone.now()
+    terminal = event.get('type') in TERMINAL_EVENTS
+    fields = {
+        'status': event['type'] if terminal else 'running',
+        'message': event.get('message') or '',
+        'updated_at': now,
+        'expires_at': now + result_ttl()
+    }
+    if event.get('progress') is not None:
+        fields['progress'] = event['progress']
+    if terminal:
+        fields['event'] = event
+    try:
+        JobResult.objects.filter(task_id=task_id).update(**fields)
+    except Exception as e:
+        print(f"Failed to record progress of job {task_id}: {e}")
+
+
+def job_status(task_id):
+    """Return status of a job that hasn't expired, or None if it is unknown.
+
+    Returns:
+        dict: task id, kind, status, progress, latest message, timestamps and the final
+            progress event once the job has ended, exactly as the progress stream sent it
+    """
+    record = JobResult.objects.filter(task_id=task_id, expires_at__gte=timezone.now()).first()
+    if record is None:
+        return None
+    return {
+        'task_id': record.task_id,
+        'kind': record.kind,
+        'status': record.status,
+        'progress': record.progress,
+        'message': record.message,
+        'created_at': record.created_at.isoformat(),
+        'updated_at': record.updated_at.isoformat(),
+        'expires_at': record.expires_at.isoformat(),
+        'event': record.event
+    }
+
+
+class JobQueue(Queue):
+    """Progress queue of a job that mirrors its events into the job store.
+
+    Terminal events are stored before clients can see them, so a client that gets a
+    "complete" event can always fetch it again. Plain progress events are written at
+    most every PROGRESS_WRITE_INTERVAL seconds.
+    """
+
+    def __init__(self, task_id):
+        super().__init__()
+        self.task_id = task_id
+        self._written = 0.0
+        self.last_active = time.monotonic()
+
+    def put(self, item, block=True, timeout=None):
+        now = self.last_active = time.monotonic()
+        if item.get('type') in TERMINAL_EVENTS or now - self._written >= PROGRESS_WRITE_INTERVAL:
+            self._written = now
+            record_event(self.task_id, item)
+        super().put(item, block, timeout)
+
+    def get(self, block=True, timeout=None):
+        # A client waiting on the queue keeps it alive
+        self.last_active = time.monotonic()
+        return super().get(block, timeout)
+
+
+def progress_queue(task_id):
+    """Return progress queue of a task, creating it for whichever of job and client comes first."""
+    with _QUEUES_LOCK:
+        queue = PROGRESS_QUEUES.get(task_id)
+        if queue is None:
+            queue = PROGRESS_QUEUES[task_id] = JobQueue(task_id)
+        return queue
+
+
+def sweep_progress_queues(max_idle=None):
+    """Drop progress queues that nobody used for a while and whose job isn't running.
+
+    These belong to clients that never connected or went away; their final events are
+    kept in the store, so nothing is lost.
+
+    Args:
+        max_idle(float): seconds without a put or get, defaults to PROGRESS_QUEUE_IDLE_SECONDS
+
+    Returns:
+        list: task ids of dropped queues
+    """
+    max_idle = getattr(settings, 'PROGRESS_QUEUE_IDLE_SECONDS', 600) if max_idle is None else max_idle
+    now = time.monotonic()
+    with _QUEUES_LOCK:
+        stale = [task_id for task_id, queue in PROGRESS_QUEUES.items()
+                 if now - queue.last_active > max_idle and CANCELLATION.get(task_id) is None]
+        for task_id in stale:
+            del PROGRESS_QUEUES[task_id]
+    return stale
+
+
+def finished_event(task_id):
+    """Return the stored final event of a job that has ended, or None."""
+    status = job_status(task_id)
+    return status['event'] if status is not None else None
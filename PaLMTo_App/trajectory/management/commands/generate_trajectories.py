@@ -0,0 +1,141 @@
+"""
+    Headless bulk generation of trajectories from a cached n-gram model
+"""
+import os
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from trajectory.downloads import register_download
+from trajectory.formats import EXTENSIONS, TrajectoryWriter, check_format, format_of, output_filename
+from trajectory.generation import LoadedModel, chunk_tasks, generation_workers, new_seed, stream_chunks
+from trajectory.models import GeneratedTrajectory, GenerationConfig
+from trajectory.registry import cache_path, read_cache
+from trajectory.spatial_store import index_saved_file
+from trajectory.tokens import Sentences
+
+# Seconds between two refreshes of the progress line
+PROGRESS_INTERVAL = 0.5
+
+
+class Command(BaseCommand):
+    help = ("Generate trajectories from an n-gram cache on all cores, streaming them to a CSV, "
+            "Parquet or Feather file, and record the run like the generate/ endpoint does.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('cache', help="Cache file name in MEDIA_ROOT/cache, or a path to one")
+        parser.add_argument('-n', '--num-trajectories', type=int, required=True)
+        parser.add_argument('-m', '--method', default='length_constrained',
+                            choices=[choice for choice, _ in GenerationConfig._meta.get_field('generation_method').choices])
+        parser.add_argument('-l', '--length', type=int, default=0,
+                            help="Target length of length-constrained trajectories")
+        parser.add_argument('--seed', type=int, help="Root seed; a fresh one is drawn and printed by default")
+        parser.add_argument('--workers', type=int, help="Worker processes, all cores by default")
+        parser.add_argument('-o', '--output', help="Output path whose extension selects the format; "
+                                                   "a new file in MEDIA_ROOT/generated by default")
+        parser.add_argument('-f', '--format', choices=sorted(EXTENSIONS),
+                            help="Format of the default output file, csv by default")
+        parser.add_argument('--no-index', action='store_true',
+                            help="Don't add the output to the trajectory search index")
+        parser.add_argument('--no-record', action='store_true',
+                            help="Don't record a GenerationConfig and GeneratedTrajectory")
+
+    def handle(self, *args, **options):
+        num_trajs = options['num_trajectories']
+        method = options['method']
+        traj_len = options['length']
+        if num_trajs <= 0:
+            raise CommandError("--num-trajectories must be positive.")
+        if method == 'length_constrained' and traj_len <= 0:
+            raise CommandError("--length is required for length_constrained generation.")
+
+        path = options['cache'] if os.path.isfile(options['cache']) else cache_path(options['cache'])
+        if not os.path.isfile(path):
+            raise CommandError(f"Ngram file {options['cache']} not found.")
+
+        try:
+            output = options['output'] or os.path.join(
+                settings.MEDIA_ROOT, 'generated',
+                output_filename(f'generated_trajectories_{uuid.uuid4()}', check_format(options['format'])))
+            check_format(format_of(output))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"Loading {path}")
+        model = LoadedModel(read_cache(path))
+        table = model.cached_data['tokens']
+        # Compile before the clock starts, so that throughput only counts sampling
+        model.sampler
+
+        seed = new_seed() if options['seed'] is None else options['seed']
+        workers = options['workers'] or generation_workers()
+        tasks = chunk_tasks(method, num_trajs, traj_len, seed)
+        self.stdout.write(f"Generating {num_trajs} trajectories ({method}) with seed {seed} on {workers} workers")
+
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        progress = Progress(num_trajs, self.stderr)
+        generated = abandoned = 0
+        with TrajectoryWriter(output) as writer:
+            for sentences, chunk_abandoned in stream_chunks(model, tasks, workers):
+                if sentences:
+                    trajs = Sentences.from_token_lists(sentences, table)
+                    trajs.trip_ids = np.arange(generated + 1, generated + len(trajs) + 1)
+                    writer.write(trajs.to_frame())
+                generated += len(sentences)
+                abandoned += chunk_abandoned
+                progress.update(generated)
+        progress.finish(generated)
+
+        if not generated:
+            os.remove(output)
+            raise CommandError(f"No trajectories could be generated; {abandoned} origin-destination pairs "
+                               f"were abandoned within the search budget.")
+
+        register_download(output)
+        if not options['no_index']:
+            index_saved_file(output, 'generated')
+        if not options['no_record']:
+            config = GenerationConfig.objects.create(
+                cell_size=model.cached_data['cell_size'], num_trajectories=num_trajs,
+                trajectory_length=traj_len if method == 'length_constrained' else None,
+                generation_method=method, seed=seed)
+            GeneratedTrajectory.objects.create(config=config, generated_file=os.path.abspath(output))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {generated} trajectories to {output} ({abandoned} origin-destination pairs abandoned)"))
+
+
+class Progress:
+    """Single-line terminal progress with throughput and estimated time left.
+
+    Output that isn't a terminal, e.g. a log file of a cron job, gets one line per update.
+    """
+
+    def __init__(self, total, stream):
+        self.total = total
+        self.stream = stream
+        self.started = self.shown = time.perf_counter()
+        self.tty = stream.isatty()
+
+    def line(self, done):
+        elapsed = time.perf_counter() - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = time.strftime('%H:%M:%S', time.gmtime((self.total - done) / rate)) if rate > 0 else '--:--:--'
+        return f"{done}/{self.total} ({100 * done / self.total:.1f}%) {rate:,.0f} traj/s, ETA {eta}"
+
+    def update(self, done):
+        now = time.perf_counter()
+        if now - self.shown >= PROGRESS_INTERVAL:
+            self.shown = now
+            if self.tty:
+                self.stream.write('\r' + self.line(done), ending='')
+                self.stream.flush()
+            else:
+                self.stream.write(self.line(done))
+
+    def finish(self, done):
+        self.stream.write(('\r' if self.tty else '') + self.line(done))
+        self.stream.write(f"Finished in {time.perf_counter() - self.started:.1f}s")
@@ -0,0 +1,368 @@
+"""
+    Concurrent load test of the trajectory API, replaying user flows against a local server
+"""
+import os
+import json
+import math
+import time
+import shutil
+import tempfile
+import threading
+from contextlib import ExitStack
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from trajectory.formats import format_of
+from trajectory.map_matching import network_dir
+
+# Distinct failure messages listed below the report
+SHOWN_FAILURES = 5
+
+
+class FlowFailed(Exception):
+    """A step of a user flow failed, so the rest of the flow can't run."""
+
+
+class Recorder:
+    """Latencies and outcomes of requests of all virtual users, keyed by endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.failures = Counter()
+        self.flows = []
+
+    def record(self, endpoint, seconds, ok, failure=None):
+        with self._lock:
+            self.samples[endpoint].append((seconds, ok))
+            if not ok:
+                self.failures[f"{endpoint}: {failure}"] += 1
+
+    def record_flow(self, seconds, ok):
+        with self._lock:
+            self.flows.append((seconds, ok))
+
+    def report(self, wall_seconds):
+        """Return request count, error rate, latency percentiles and throughput of each endpoint.
+
+        Latencies include reading the whole body, so those of progress/ are the time from
+        subscribing to a job until its final event.
+        """
+        rows = []
+        for endpoint, samples in sorted(self.samples.items()) + [('flow', self.flows)]:
+            if not samples:
+                continue
+            latencies = np.array([seconds for seconds, _ in samples]) * 1000
+            errors = sum(not ok for _, ok in samples)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            rows.append({
+                'endpoint': endpoint,
+                'requests': len(samples),
+                'errors': errors,
+                'errorRate': round(errors / len(samples), 4),
+                'p50Ms': round(float(p50), 1),
+                'p95Ms': round(float(p95), 1),
+                'p99Ms': round(float(p99), 1),
+                'throughput': round(len(samples) / wall_seconds, 3) if wall_seconds > 0 else 0.0
+            })
+        return rows
+
+
+class VirtualUser:
+    """One client walking through upload, build, generate, progress, download and match.
+
+    Args:
+        base_url(str): root URL of the server, e.g. http://127.0.0.1:8000
+        recorder(Recorder): collector of request measurements
+        options(dict): command options
+    """
+
+    def __init__(self, base_url, recorder, options):
+        import requests
+
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.options = options
+        self.session = requests.Session()
+
+    def request(self, endpoint, method, path, **kwargs):
+        """Send a request, read its whole body and record its latency under an endpoint.
+
+        Raises:
+            FlowFailed: if the request failed or was answered with an error status
+        """
+        started = time.perf_counter()
+        try:
+            # Bodies are read before returning, so latencies cover whole downloads
+            response = self.session.request(method, f"{self.base_url}/{path}",
+                                            timeout=self.options['timeout'], **kwargs)
+        except Exception as e:
+            self.recorder.record(endpoint, time.perf_counter() - started, False, type(e).__name__)
+            raise FlowFailed(f"{endpoint}: {e}")
+        ok = response.status_code < 400
+        self.recorder.record(endpoint, time.perf_counter() - started, ok, f"HTTP {response.status_code}")
+        if not ok:
+            raise FlowFailed(f"{endpoint}: HTTP {response.status_code}")
+        return response
+
+    def stream(self, task_id):
+        """Follow the progress stream of a job until its final event and return that event.
+
+        Raises:
+            FlowFailed: if the stream broke or the job didn't complete
+        """
+        started = time.perf_counter()
+        event = None
+        try:
+            with self.session.get(f"{self.base_url}/trajectory/progress/", params={'task_id': task_id},
+                                  stream=True, timeout=self.options['timeout']) as response:
+                for line in response.iter_lines(decode_unicode=True):
+                    if line and line.startswith('data: '):
+                        event = json.loads(line[len('data: '):])
+                        if event.get('type') in ('complete', 'error', 'cancelled'):
+                            break
+        except Exception as e:
+            self.recorder.record('GET progress/', time.perf_counter() - started, False, type(e).__name__)
+            raise FlowFailed(f"progress/: {e}")
+        ok = event is not None and event.get('type') == 'complete'
+        failure = f"{event.get('type')} event: {event.get('message')}" if event is not None else "stream ended early"
+        self.recorder.record('GET progress/', time.perf_counter() - started, ok, failure)
+        if not ok:
+            raise FlowFailed(f"progress/: {failure}")
+        return event
+
+    def build(self):
+        """Upload the trajectory file, build its n-gram model and return the cache file name."""
+        with open(self.options['data'], 'rb') as f:
+            response = self.request('POST generate/ngrams', 'POST', 'trajectory/generate/ngrams',
+                                    files={'file': (os.path.basename(self.options['data']), f)},
+                                    data={'cell_size': self.options['cell_size']})
+        return self.stream(response.json()['task_id'])['cache_file']
+
+    def generate(self, cache_file):
+        response = self.request('POST generate/', 'POST', 'trajectory/generate/', data={
+            'cache_file': cache_file,
+            'num_trajectories': self.options['trajectories'],
+            'generation_method': 'length_constrained',
+            'trajectory_len': self.options['length']
+        })
+        return self.stream(response.json()['task_id'])['result']['generated_file']
+
+    def match(self, generated_file):
+        payload = {'filename': generated_file, 'percentage': self.options['match_percentage']}
+        if self.options['network']:
+            payload['network'] = self.options['network']
+        response = self.request('POST map-match/', 'POST', 'trajectory/map-match/', json=payload)
+        return self.stream(response.json()['task_id'])['result']['output_file']
+
+    def download(self, filename):
+        self.request('GET download/', 'GET', f'trajectory/download/{filename}')
+
+    def run_flow(self, cache_file=None):
+        """Walk through one user flow, building a model unless a shared one is given."""
+        started = time.perf_counter()
+        try:
+            cache_file = cache_file or self.build()
+            generated_file = self.generate(cache_file)
+            self.download(generated_file)
+            self.download(self.match(generated_file))
+        except FlowFailed:
+            self.recorder.record_flow(time.perf_counter() - started, False)
+            return
+        self.recorder.record_flow(time.perf_counter() - started, True)
+
+
+class StubOsrmHandler(BaseHTTPRequestHandler):
+    """Answer OSRM match requests with the input points as the matched line."""
+
+    def do_GET(self):
+        try:
+            pairs = unquote(urlparse(self.path).path.rsplit('/', 1)[-1]).split(';')
+            coords = [[float(value) for value in pair.split(',')] for pair in pairs]
+        except ValueError:
+            self.send_error(400)
+            return
+        time.sleep(self.server.latency)
+
+        distance = 0.0
+        for (lon_a, lat_a), (lon_b, lat_b) in zip(coords[:-1], coords[1:]):
+            dx = (lon_b - lon_a) * 111_320 * math.cos(math.radians((lat_a + lat_b) / 2))
+            distance += math.hypot(dx, (lat_b - lat_a) * 111_320)
+        body = json.dumps({'code': 'Ok', 'matchings': [{
+            'confidence': 1.0,
+            'distance': round(distance, 1),
+            'duration': round(distance / 10, 1),
+            'geometry': {'type': 'LineString', 'coordinates': coords}
+        }]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_osrm(latency):
+    """Serve a stub OSRM on a free local port in a daemon thread and return the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubOsrmHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_app_server():
+    """Serve the project with Django's threaded development server on a free local port."""
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Command(BaseCommand):
+    help = ("Replay user flows (upload and build, generate, stream progress, download, map match) "
+            "with concurrent virtual users and report latency percentiles, throughput and error "
+            "rates per endpoint. Runs an in-process server with a stub OSRM unless --url is given.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('data', help="Trajectory file (CSV, Parquet or Feather) users upload")
+        parser.add_argument('-u', '--users', type=int, default=4, help="Concurrent virtual users")
+        parser.add_argument('-i', '--iterations', type=int, default=1, help="Flows run by each user")
+        parser.add_argument('-d', '--duration', type=float,
+                            help="Keep starting flows for this many seconds instead of --iterations")
+        parser.add_argument('--ramp-up', type=float, default=0.0,
+                            help="Seconds over which user starts are spread evenly")
+        parser.add_argument('--build-once', action='store_true',
+                            help="Build one model before the clock starts and share it, "
+                                 "leaving uploads and builds out of the flows")
+        parser.add_argument('--cell-size', type=int, default=500)
+        parser.add_argument('-n', '--trajectories', type=int, default=100,
+                            help="Trajectories generated per flow")
+        parser.add_argument('-l', '--length', type=int, default=20, help="Length of generated trajectories")
+        parser.add_argument('--match-percentage', type=float, default=10.0,
+                            help="Share of generated trajectories map matched per flow")
+        parser.add_argument('--network', help="Road network in MEDIA_ROOT/networks matched against "
+                                              "instead of the stub OSRM")
+        parser.add_argument('--osrm-latency', type=float, default=20.0,
+                            help="Milliseconds the stub OSRM takes per match request")
+        parser.add_argument('--url', help="Load test a running server at this URL instead; it must "
+                                          "set MAP_MATCHING_OSRM_URL to the stub printed at start")
+        parser.add_argument('--keep-media', action='store_true',
+                            help="Let the in-process server write to MEDIA_ROOT instead of a "
+                                 "temporary folder removed afterwards")
+        parser.add_argument('--timeout', type=float, default=600.0, help="Seconds each request may take")
+        parser.add_argument('--json', help="Also write the report to this JSON file")
+
+    def handle(self, *args, **options):
+        if not os.path.isfile(options['data']):
+            raise CommandError(f"Trajectory file {options['data']} not found.")
+        try:
+            format_of(options['data'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['users'] <= 0 or options['iterations'] <= 0:
+            raise CommandError("--users and --iterations must be positive.")
+        network_path = os.path.join(network_dir(), options['network'] or '')
+        if options['network'] and not options['url'] and not os.path.isfile(network_path):
+            raise CommandError(f"Road network {options['network']} not found in {network_dir()}.")
+
+        with ExitStack() as stack:
+            osrm = start_stub_osrm(options['osrm_latency'] / 1000)
+            stack.callback(osrm.server_close)
+            stack.callback(osrm.shutdown)
+            osrm_url = f"http://127.0.0.1:{osrm.server_port}"
+
+            if options['url']:
+                base_url = options['url']
+                self.stdout.write(f"Stub OSRM listening at {osrm_url}")
+            else:
+                # Settings are overridden with signals, so storages pick up the new MEDIA_ROOT
+                overrides = {'MAP_MATCHING_OSRM_URL': osrm_url}
+                if settings.ALLOWED_HOSTS and '127.0.0.1' not in settings.ALLOWED_HOSTS:
+                    overrides['ALLOWED_HOSTS'] = [*settings.ALLOWED_HOSTS, '127.0.0.1']
+                if not options['keep_media']:
+                    media_root = tempfile.mkdtemp(prefix='loadtest_')
+                    stack.callback(shutil.rmtree, media_root, ignore_errors=True)
+                    if options['network']:
+                        os.makedirs(os.path.join(media_root, 'networks'))
+                        shutil.copy(network_path, os.path.join(media_root, 'networks', options['network']))
+                    overrides['MEDIA_ROOT'] = media_root
+                stack.enter_context(override_settings(**overrides))
+
+                server = start_app_server()
+                stack.callback(server.server_close)
+                stack.callback(server.shutdown)
+                base_url = f"http://127.0.0.1:{server.server_port}"
+
+            recorder, wall_seconds = self.run(base_url, options)
+
+        report = recorder.report(wall_seconds)
+        self.print_report(report, recorder.failures, wall_seconds)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'options': {key: options[key] for key in (
+                    'users', 'iterations', 'duration', 'ramp_up', 'build_once', 'cell_size',
+                    'trajectories', 'length', 'match_percentage', 'network', 'osrm_latency')},
+                    'wallSeconds': round(wall_seconds, 3), 'endpoints': report,
+                    'failures': dict(recorder.failures)}, f, indent=2)
+
+    def run(self, base_url, options):
+        """Run every virtual user to completion and return their measurements with the wall time."""
+        recorder = Recorder()
+        cache_file = None
+        if options['build_once']:
+            self.stdout.write(f"Building a shared model from {options['data']}")
+            try:
+                cache_file = VirtualUser(base_url, Recorder(), options).build()
+            except FlowFailed as e:
+                raise CommandError(f"Building the shared model failed: {e}")
+
+        users = options['users']
+        self.stdout.write(f"Running {users} users against {base_url}")
+        started = time.perf_counter()
+        deadline = started + options['duration'] if options['duration'] else None
+
+        def run_user(index):
+            time.sleep(options['ramp_up'] * index / users)
+            user = VirtualUser(base_url, recorder, options)
+            runs = 0
+            while (time.perf_counter() < deadline) if deadline else runs < options['iterations']:
+                user.run_flow(cache_file)
+                runs += 1
+
+        threads = [threading.Thread(target=run_user, args=(i,), daemon=True) for i in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return recorder, time.perf_counter() - started
+
+    def print_report(self, rows, failures, wall_seconds):
+        self.stdout.write(f"\nFinished in {wall_seconds:.1f}s")
+        header = f"{'endpoint':<22}{'requests':>10}{'errors':>8}{'error %':>9}" \
+                 f"{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'req/s':>9}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in rows:
+            self.stdout.write(f"{row['endpoint']:<22}{row['requests']:>10}{row['errors']:>8}"
+                              f"{100 * row['errorRate']:>9.1f}{row['p50Ms']:>11.1f}{row['p95Ms']:>11.1f}"
+                              f"{row['p99Ms']:>11.1f}{row['throughput']:>9.2f}")
+        if failures:
+            self.stdout.write("\nMost frequent failures:")
+            for failure, count in failures.most_common(SHOWN_FAILURES):
+                self.stdout.write(f"  {count} x {failure}")
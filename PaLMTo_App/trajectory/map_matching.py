@@ -0,0 +1,607 @@
+"""
+    Offline HMM map matching of trajectories onto a road network loaded from GeoJSON or OSM XML
+"""
+import os
+import re
+import json
+import math
+import heapq
+import threading
+from collections import OrderedDict
+from contextlib import ExitStack
+
+import numpy as np
+from django.conf import settings
+
+from .cancellation import checkpoint, pool_results
+from .generation import generation_workers
+
+# File extensions of each supported road network format
+NETWORK_EXTENSIONS = {
+    'geojson': ('.geojson', '.json'),
+    'osm': ('.osm', '.xml')
+}
+
+# Free-flow speeds in km/h of OSM highway classes, for roads without a maxspeed tag
+HIGHWAY_SPEEDS = {
+    'motorway': 100, 'motorway_link': 60, 'trunk': 80, 'trunk_link': 50,
+    'primary': 60, 'primary_link': 40, 'secondary': 50, 'secondary_link': 40,
+    'tertiary': 40, 'tertiary_link': 30, 'unclassified': 30, 'residential': 30,
+    'living_street': 10, 'service': 20, 'road': 40
+}
+DEFAULT_SPEED_KMH = 40
+
+# OSM ways that cars can't use are left out of networks read from OSM extracts
+NON_DRIVABLE = {'footway', 'cycleway', 'path', 'steps', 'pedestrian', 'bridleway', 'corridor',
+                'platform', 'proposed', 'construction', 'elevator', 'bus_stop', 'track'}
+
+METERS_PER_DEGREE = 111_320.0
+
+# Routes between consecutive points longer than this many times their straight-line
+# distance, plus twice the search radius, are not searched
+MAX_ROUTE_FACTOR = 3.0
+
+# Networks kept loaded per process, least recently used dropped first
+CACHED_NETWORKS = 2
+_NETWORKS = OrderedDict()
+_NETWORKS_LOCK = threading.Lock()
+
+# Matcher installed in each pool worker by _init_worker
+_WORKER_MATCHER = None
+
+
+def network_dir():
+    """Return media folder holding road network files."""
+    return os.path.join(settings.MEDIA_ROOT, 'networks')
+
+
+def network_format(path):
+    """Return format name of a road network file from its extension.
+
+    Raises:
+        ValueError: if the extension belongs to no supported format
+    """
+    name = str(path).lower()
+    for fmt, extensions in NETWORK_EXTENSIONS.items():
+        if name.endswith(extensions):
+            return fmt
+    if name.endswith('.pbf'):
+        raise ValueError("OSM PBF extracts aren't supported; convert them to OSM XML first, "
+                         "e.g. with osmium cat extract.osm.pbf -o extract.osm")
+    raise ValueError(f"Unsupported road network file type: {os.path.basename(str(path))}")
+
+
+def parse_speed(value, highway=None):
+    """Return speed in m/s of a maxspeed tag such as "50" or "30 mph", else of the road class."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(mph)?', str(value)) if value is not None else None
+    if match:
+        kmh = float(match.group(1)) * (1.609344 if match.group(2) else 1)
+    else:
+        if isinstance(highway, (list, tuple)):
+            highway = highway[0] if highway else None
+        kmh = HIGHWAY_SPEEDS.get(highway, DEFAULT_SPEED_KMH)
+    return max(kmh, 5) / 3.6
+
+
+def parse_oneway(value, junction=None):
+    """Return 1 for roads open in their drawing direction only, -1 for the reverse, else 0."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    value = str(value).lower() if value is not None else ''
+    if value in ('yes', 'true', '1'):
+        return 1
+    if value in ('-1', 'reverse'):
+        return -1
+    return 1 if junction == 'roundabout' and value != 'no' else 0
+
+
+class RoadNetwork:
+    """Directed road graph with a spatial index of its edges.
+
+    Coordinates are projected to meters on a plane tangent at the network's center,
+    which is accurate to well under a meter across a city. Each straight piece of a
+    road becomes one edge per direction of travel. Edge pieces sampled every search
+    radius are indexed in a k-d tree for batched candidate lookup.
+
+    Args:
+        lonlat(np.ndarray): (num_nodes, 2) node coordinates
+        edge_from(np.ndarray): start node of each edge
+        edge_to(np.ndarray): end node of each edge
+        edge_speed(np.ndarray): free-flow speed of each edge in m/s
+    """
+
+    def __init__(self, lonlat, edge_from, edge_to, edge_speed):
+        if not len(edge_from):
+            raise ValueError("Road network contains no drivable roads.")
+        self.lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+        self.lon0, self.lat0 = self.lonlat.mean(axis=0)
+        self.xy = self.project(self.lonlat)
+        self.edge_from = np.asarray(edge_from, dtype=np.int64)
+        self.edge_to = np.asarray(edge_to, dtype=np.int64)
+        self.edge_speed = np.asarray(edge_speed, dtype=np.float64)
+        self.edge_length = np.hypot(*(self.xy[self.edge_to] - self.xy[self.edge_from]).T)
+        self.edge_time = self.edge_length / self.edge_speed
+        self._adjacency = None
+        self._tree = None
+        self._tree_step = None
+        self._sample_edges = None
+
+    @property
+    def num_nodes(self):
+        return len(self.lonlat)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_from)
+
+    def project(self, lonlat):
+        """Project (lon, lat) pairs to planar meters around the network's center."""
+        lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+        return np.column_stack([(lonlat[:, 0] - self.lon0) * METERS_PER_DEGREE * math.cos(math.radians(self.lat0)),
+                                (lonlat[:, 1] - self.lat0) * METERS_PER_DEGREE])
+
+    def unproject(self, xy):
+        xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+        return np.column_stack([xy[:, 0] / (METERS_PER_DEGREE * math.cos(math.radians(self.lat0))) + self.lon0,
+                                xy[:, 1] / METERS_PER_DEGREE + self.lat0])
+
+    @classmethod
+    def from_roads(cls, roads):
+        """Build a network from roads given as node coordinates with attributes.
+
+        Args:
+            roads(iterable): tuples of a list of (lon, lat) pairs or node keys, oneway
+                flag as returned by parse_oneway and speed in m/s
+        """
+        nodes = {}
+        edge_from, edge_to, edge_speed = [], [], []
+        for points, oneway, speed in roads:
+            ids = [nodes.setdefault(point, len(nodes)) for point in points]
+            for u, v in zip(ids[:-1], ids[1:]):
+                if u == v:
+                    continue
+                if oneway >= 0:
+                    edge_from.append(u)
+                    edge_to.append(v)
+                    edge_speed.append(speed)
+                if oneway <= 0:
+                    edge_from.append(v)
+                    edge_to.append(u)
+                    edge_speed.append(speed)
+        lonlat = np.empty((len(nodes), 2))
+        for point, i in nodes.items():
+            lonlat[i] = point
+        return cls(lonlat, edge_from, edge_to, edge_speed)
+
+    @classmethod
+    def from_geojson(cls, path):
+        """Read LineString and MultiLineString features of a GeoJSON file.
+
+        Roads meet where they share a vertex. The "oneway", "junction", "maxspeed" and
+        "highway" properties are read as in OSM when present.
+        """
+        with open(path) as f:
+            collection = json.load(f)
+
+        def roads():
+            for feature in collection.get('features', []):
+                geometry = feature.get('geometry') or {}
+                props = feature.get('properties') or {}
+                if geometry.get('type') == 'LineString':
+                    lines = [geometry['coordinates']]
+                elif geometry.get('type') == 'MultiLineString':
+                    lines = geometry['coordinates']
+                else:
+                    continue
+                oneway = parse_oneway(props.get('oneway'), props.get('junction'))
+                speed = parse_speed(props.get('maxspeed'), props.get('highway'))
+                for line in lines:
+                    yield [(round(lon, 7), round(lat, 7)) for lon, lat, *_ in line], oneway, speed
+        return cls.from_roads(roads())
+
+    @classmethod
+    def from_osm(cls, path):
+        """Read drivable highway ways of an OSM XML extract."""
+        import xml.etree.ElementTree as ET
+
+        coords, ways = {}, []
+        for _, element in ET.iterparse(path, events=('end',)):
+            if element.tag == 'node':
+                coords[element.get('id')] = (float(element.get('lon')), float(element.get('lat')))
+                element.clear()
+            elif element.tag == 'way':
+                tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                highway = tags.get('highway')
+                if highway and highway not in NON_DRIVABLE and tags.get('area') != 'yes':
+                    refs = [nd.get('ref') for nd in element.iter('nd')]
+                    ways.append((refs, parse_oneway(tags.get('oneway'), tags.get('junction')),
+                                 parse_speed(tags.get('maxspeed'), highway)))
+                element.clear()
+
+        return cls.from_roads(([coords[ref] for ref in refs if ref in coords], oneway, speed)
+                              for refs, oneway, speed in ways)
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_geojson(path) if network_format(path) == 'geojson' else cls.from_osm(path)
+
+    @property
+    def adjacency(self):
+        """Outgoing (node, edge, length) triples of each node, as lists for fast searches."""
+        if self._adjacency is None:
+            adjacency = [[] for _ in range(self.num_nodes)]
+            for edge, (u, v, length) in enumerate(zip(self.edge_from.tolist(), self.edge_to.tolist(),
+                                                      self.edge_length.tolist())):
+                adjacency[u].append((v, edge, length))
+            self._adjacency = adjacency
+        return self._adjacency
+
+    def index(self, step):
+        """Build the k-d tree over points sampled every step meters along each edge."""
+        from scipy.spatial import cKDTree
+
+        if self._tree is not None and self._tree_step == step:
+            return
+        pieces = np.maximum(np.ceil(self.edge_length / step), 1).astype(np.int64)
+        edges = np.repeat(np.arange(self.num_edges), pieces)
+        offsets = np.concatenate(([0], np.cumsum(pieces)))
+        fractions = (np.arange(len(edges)) - offsets[edges] + 0.5) / pieces[edges]
+        start, end = self.xy[self.edge_from[edges]], self.xy[self.edge_to[edges]]
+        self._tree = cKDTree(start + (end - start) * fractions[:, None])
+        self._tree_step = step
+        self._sample_edges = edges
+
+    def candidates(self, xy, radius, k):
+        """Find the nearest edges within radius of each point, all points at once.
+
+        Args:
+            xy(np.ndarray): (num_points, 2) projected points
+            radius(float): search radius in meters
+            k(int): most candidates kept per point
+
+        Returns:
+            tuple: arrays of point index, edge, fraction along the edge, distance and
+                projected position of each candidate, sorted by point then distance
+        """
+        self.index(radius)
+        hits = self._tree.query_ball_point(xy, r=radius * 1.5)
+        counts = np.fromiter((len(hit) for hit in hits), dtype=np.int64, count=len(hits))
+        points = np.repeat(np.arange(len(xy)), counts)
+        samples = np.fromiter((sample for hit in hits for sample in hit), dtype=np.int64, count=int(counts.sum()))
+
+        # Several samples of one edge may be near a point
+        keys = np.unique(points * self.num_edges + self._sample_edges[samples])
+        points, edges = np.divmod(keys, self.num_edges)
+
+        start, end = self.xy[self.edge_from[edges]], self.xy[self.edge_to[edges]]
+        direction = end - start
+        length_sq = np.maximum(np.einsum('ij,ij->i', direction, direction), 1e-12)
+        fractions = np.clip(np.einsum('ij,ij->i', xy[points] - start, direction) / length_sq, 0, 1)
+        projected = start + direction * fractions[:, None]
+        distances = np.hypot(*(xy[points] - projected).T)
+
+        within = distances <= radius
+        points, edges, fractions, distances, projected = (
+            points[within], edges[within], fractions[within], distances[within], projected[within])
+        order = np.lexsort((distances, points))
+        points, edges, fractions, distances, projected = (
+            points[order], edges[order], fractions[order], distances[order], projected[order])
+        first = np.searchsorted(points, points)
+        keep = np.arange(len(points)) - first < k
+        return points[keep], edges[keep], fractions[keep], distances[keep], projected[keep]
+
+    def search(self, source, targets, limit):
+        """Shortest distances from a node to target nodes, not searching beyond limit meters.
+
+        Returns:
+            tuple: distance of each reached target and the edge each settled node was
+                reached by, for tracing routes back
+        """
+        adjacency = self.adjacency
+        dist = {source: 0.0}
+        via = {}
+        remaining = set(targets)
+        settled = set()
+        heap = [(0.0, source)]
+        while heap and remaining:
+            d, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            remaining.discard(u)
+            for v, edge, length in adjacency[u]:
+                nd = d + length
+                if nd <= limit and nd < dist.get(v, math.inf):
+                    dist[v] = nd
+                    via[v] = edge
+                    heapq.heappush(heap, (nd, v))
+        return {target: dist[target] for target in targets if target in settled}, via
+
+    def trace(self, via, source, target):
+        """Return edges of the route a search found from source to target, in order."""
+        edges = []
+        node = target
+        while node != source:
+            edge = via[node]
+            edges.append(edge)
+            node = int(self.edge_from[edge])
+        return edges[::-1]
+
+
+class MapMatcher:
+    """Snap trajectories to a road network with a hidden Markov model (Newson and Krumm, 2009).
+
+    Hidden states are candidate positions on edges near each point. Emission scores fall
+    with the squared distance of a point from its candidate, transition scores with the
+    difference between the route distance of two candidates and the straight-line
+    distance of their points. Viterbi decoding picks the likeliest sequence of
+    candidates; where no route connects consecutive points the match is split.
+
+    Args:
+        network(RoadNetwork): road graph
+        radius(float): search radius of candidates in meters
+        sigma(float): standard deviation of position noise in meters
+        beta(float): scale of route-to-straight-line differences in meters
+        k(int): most candidates per point
+    """
+
+    def __init__(self, network, radius=None, sigma=None, beta=None, k=None):
+        self.network = network
+        self.radius = radius or getattr(settings, 'MAP_MATCHING_SEARCH_RADIUS_M', 100)
+        self.sigma = sigma or getattr(settings, 'MAP_MATCHING_GPS_SIGMA_M', 25)
+        self.beta = beta or getattr(settings, 'MAP_MATCHING_BETA_M', 50)
+        self.k = k or getattr(settings, 'MAP_MATCHING_CANDIDATES', 8)
+
+    def thin(self, xy):
+        """Keep points at least 2 sigma from the previous kept one, and always the last.
+
+        Closer points add no information beyond noise, as Newson and Krumm observe.
+        """
+        keep = [0]
+        for i in range(1, len(xy)):
+            if np.hypot(*(xy[i] - xy[keep[-1]])) >= 2 * self.sigma:
+                keep.append(i)
+        if len(xy) > 1 and keep[-1] != len(xy) - 1:
+            keep.append(len(xy) - 1)
+        return np.asarray(keep)
+
+    def match_batch(self, trips):
+        """Match a batch of trajectories, looking up candidates of all their points at once.
+
+        Args:
+            trips(list): (trip_id, list of [lon, lat] pairs) of each trajectory
+
+        Returns:
+            list: GeoJSON features of matched trajectories, in input order, with trip_id,
+                confidence, distance in meters and duration in seconds; trajectories
+                that match nowhere are left out
+        """
+        network = self.network
+        kept = []
+        for _, coords in trips:
+            xy = network.project(coords) if len(coords) else np.empty((0, 2))
+            kept.append(xy[self.thin(xy)] if len(xy) else xy)
+        lengths = np.array([len(xy) for xy in kept], dtype=np.int64)
+        all_xy = np.concatenate(kept) if len(kept) else np.empty((0, 2))
+        points, edges, fractions, distances, projected = network.candidates(all_xy, self.radius, self.k)
+        bounds = np.searchsorted(points, np.arange(len(all_xy) + 1))
+
+        features = []
+        offset = 0
+        for (trip_id, _), xy, length in zip(trips, kept, lengths):
+            steps = []
+            for i in range(offset, offset + length):
+                lo, hi = bounds[i], bounds[i + 1]
+                steps.append((xy[i - offset], edges[lo:hi], fractions[lo:hi], distances[lo:hi], projected[lo:hi]))
+            offset += length
+            feature = self.match(trip_id, steps)
+            if feature is not None:
+                features.append(feature)
+        return features
+
+    def _transitions(self, prev, step, gap):
+        """Log-probabilities of moving between candidates of consecutive points, -inf if no route."""
+        network = self.network
+        _, prev_edges, prev_fractions, _, _ = prev
+        _, edges, fractions, _, _ = step
+        limit = gap * MAX_ROUTE_FACTOR + 2 * self.radius
+        scores = np.full((len(prev_edges), len(edges)), -np.inf)
+        tails = network.edge_from[edges]
+        searches = {}
+        for a, (edge_a, fraction_a) in enumerate(zip(prev_edges.tolist(), prev_fractions.tolist())):
+            head = int(network.edge_to[edge_a])
+            if head not in searches:
+                searches[head] = network.search(head, set(tails.tolist()), limit)[0]
+            reached = searches[head]
+            leave = (1 - fraction_a) * network.edge_length[edge_a]
+            for b, (edge_b, fraction_b) in enumerate(zip(edges.tolist(), fractions.tolist())):
+                if edge_a == edge_b and fraction_b >= fraction_a:
+                    route = (fraction_b - fraction_a) * network.edge_length[edge_a]
+                elif int(tails[b]) in reached:
+                    route = leave + reached[int(tails[b])] + fraction_b * network.edge_length[edge_b]
+                else:
+                    continue
+                scores[a, b] = -abs(route - gap) / self.beta
+        return scores
+
+    def _decode(self, steps):
+        """Run Viterbi over points with candidates, splitting wherever no route connects.
+
+        Returns:
+            list: pieces, each a list of (step index, candidate index) and the transition
+                probability between each consecutive pair of them
+        """
+        pieces = []
+        scores, back, path_steps = None, [], []
+
+        def close():
+            if path_steps:
+                state = int(np.argmax(scores))
+                chosen, probabilities = [state], []
+                for pointers, log_t in reversed(back):
+                    previous = int(pointers[state])
+                    probabilities.append(math.exp(log_t[previous, state]))
+                    state = previous
+                    chosen.append(state)
+                pieces.append((list(zip(path_steps, chosen[::-1])), probabilities[::-1]))
+
+        for t, step in enumerate(steps):
+            emission = -0.5 * (step[3] / self.sigma) ** 2
+            if not len(emission):
+                continue
+            if scores is not None:
+                gap = float(np.hypot(*(step[0] - steps[path_steps[-1]][0])))
+                log_t = self._transitions(steps[path_steps[-1]], step, gap)
+                total = scores[:, None] + log_t
+                best = total.max(axis=0)
+                if np.isfinite(best).any():
+                    scores = best + emission
+                    back.append((total.argmax(axis=0), log_t))
+                    path_steps.append(t)
+                    continue
+                close()
+            scores, back, path_steps = emission, [], [t]
+        close()
+        return pieces
+
+    def _route(self, step_a, a, step_b, b):
+        """Return traversed planar points, length and travel time between two candidates."""
+        network = self.network
+        edge_a, fraction_a = int(step_a[1][a]), float(step_a[2][a])
+        edge_b, fraction_b = int(step_b[1][b]), float(step_b[2][b])
+        time_of = network.edge_time
+        if edge_a == edge_b and fraction_b >= fraction_a:
+            share = fraction_b - fraction_a
+            return [step_b[4][b]], share * network.edge_length[edge_a], share * time_of[edge_a]
+
+        head, tail = int(network.edge_to[edge_a]), int(network.edge_from[edge_b])
+        reached, via = network.search(head, {tail}, math.inf)
+        path = network.trace(via, head, tail) if tail in reached else []
+        points = [network.xy[head]] + [network.xy[network.edge_to[edge]] for edge in path] + [step_b[4][b]]
+        length = ((1 - fraction_a) * network.edge_length[edge_a] + network.edge_length[path].sum() +
+                  fraction_b * network.edge_length[edge_b])
+        duration = ((1 - fraction_a) * time_of[edge_a] + time_of[path].sum() + fraction_b * time_of[edge_b])
+        return points, length, duration
+
+    def match(self, trip_id, steps):
+        """Decode one trajectory and build its GeoJSON feature, None if nothing matched.
+
+        Pieces split by breaks are joined into one line, so features keep the shape of OSRM ones.
+        """
+        pieces = self._decode(steps)
+        if not pieces:
+            return None
+
+        coordinates, length, duration, probabilities = [], 0.0, 0.0, []
+        for i, (chosen, piece_probabilities) in enumerate(pieces):
+            t, state = chosen[0]
+            points = [steps[t][4][state]]
+            for (t_a, a), (t_b, b) in zip(chosen[:-1], chosen[1:]):
+                route_points, route_length, route_duration = self._route(steps[t_a], a, steps[t_b], b)
+                points.extend(route_points)
+                length += route_length
+                duration += route_duration
+            lonlat = self.network.unproject(np.array(points))
+            coordinates.extend([round(lon, 6), round(lat, 6)] for lon, lat in lonlat.tolist())
+            # A break between pieces counts as a transition of probability zero
+            probabilities.extend(([0.0] if i else []) + piece_probabilities)
+
+        # Consecutive duplicates arise where a route ends at the node the next one starts from
+        coordinates = [point for i, point in enumerate(coordinates) if i == 0 or point != coordinates[i - 1]]
+        if len(coordinates) < 2:
+            coordinates = coordinates * 2
+
+        matched = sum(len(chosen) for chosen, _ in pieces)
+        confidence = matched / len(steps) * (float(np.mean(probabilities)) if probabilities else 0.0)
+        return {
+            'type': 'Feature',
+            'properties': {
+                'trip_id': trip_id,
+                'confidence': round(confidence, 4),
+                'distance': round(float(length), 1),
+                'duration': round(float(duration), 1)
+            },
+            'geometry': {'type': 'LineString', 'coordinates': coordinates}
+        }
+
+
+def batch_rows():
+    """Return number of trajectories matched per task."""
+    return getattr(settings, 'MAP_MATCHING_BATCH_ROWS', 100)
+
+
+def load_network(name):
+    """Return the road network of a file in the networks media folder, loading it once per process.
+
+    Networks are reloaded when their file changes.
+
+    Raises:
+        FileNotFoundError: if there is no such network file
+        ValueError: if the file isn't a readable road network
+    """
+    path = os.path.join(network_dir(), name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Road network {name} not found.")
+    key = (path, os.path.getmtime(path))
+    with _NETWORKS_LOCK:
+        network = _NETWORKS.get(key)
+        if network is not None:
+            _NETWORKS.move_to_end(key)
+            return network
+
+    network = RoadNetwork.load(path)
+    with _NETWORKS_LOCK:
+        _NETWORKS[key] = network
+        while len(_NETWORKS) > CACHED_NETWORKS:
+            _NETWORKS.popitem(last=False)
+    return network
+
+
+def _init_worker(matcher):
+    """Install a matcher in a pool worker."""
+    global _WORKER_MATCHER
+    _WORKER_MATCHER = matcher
+
+
+def _match_in_worker(trips):
+    return _WORKER_MATCHER.match_batch(trips)
+
+
+def iter_matches(matcher, trips, workers=None):
+    """Match trajectories in batches and yield the features of each batch in input order.
+
+    Batches are matched in worker processes, at most two per worker in flight. A
+    cancelled job kills the batches in flight.
+
+    Args:
+        matcher(MapMatcher): matcher shared by every batch
+        trips(list): (trip_id, list of [lon, lat] pairs) of each trajectory
+        workers(int): worker processes to use, defaults to generation_workers()
+
+    Yields:
+        tuple: number of trajectories in the batch and the features matched from it
+    """
+    rows = batch_rows()
+    batches = [trips[i:i + rows] for i in range(0, len(trips), rows)]
+    workers = min(workers or generation_workers(), len(batches))
+
+    with ExitStack() as stack:
+        if workers <= 1:
+            results = (matcher.match_batch(batch) for batch in batches)
+        else:
+            # Built once here rather than in every worker
+            matcher.network.adjacency
+            matcher.network.index(matcher.radius)
+            results = pool_results(stack, _match_in_worker, ((batch,) for batch in batches), workers,
+                                   _init_worker, (matcher,))
+
+        for batch, features in zip(batches, results):
+            yield len(batch), features
+            checkpoint()
+
+
+def match_trajectories(matcher, trips, workers=None):
+    """Match trajectories and return their features in input order."""
+    return [feature for _, features in iter_matches(matcher, trips, workers) for feature in features]
@@ -0,0 +1,263 @@
+"""
+    Stage-level instrumentation of background jobs and a Prometheus text exporter
+"""
+import gc
+import os
+import sys
+import time
+import ctypes
+import threading
+
+from .cancellation import checkpoint
+
+try:
+    import resource
+except ImportError:     # Not available on Windows
+    resource = None
+
+# Bucket boundaries shared by all stage histograms
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+BYTES_BUCKETS = tuple(2 ** exp for exp in range(26, 36))   # 64MB up to 32GB
+COUNT_BUCKETS = tuple(10 ** exp for exp in range(1, 9))
+
+
+def current_rss():
+    """Return resident set size of current process in bytes.
+
+    Reads /proc/self/statm where available and falls back to the peak RSS
+    reported by getrusage, which is the best approximation on other platforms.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return peak_rss()
+
+
+def peak_rss():
+    """Return peak resident set size of current process in bytes, or 0 if unknown."""
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+def children_rss():
+    """Return total resident set size of the current process's children in bytes.
+
+    Walks /proc for processes whose parent is this one, e.g. the workers of a process
+    pool. Returns 0 on platforms without /proc.
+    """
+    pid = str(os.getpid())
+    total = 0
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return 0
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Fields after the parenthesised command name, starting at the state
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if fields[1] == pid:
+            total += int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return total
+
+
+def trim_heap():
+    """Hand memory freed by earlier jobs back to the OS, so that RSS growth measures a new one.
+
+    glibc keeps freed memory in the process and reuses it, in which case a job that only
+    reuses it would appear to need no memory at all. A no-op with other allocators.
+    """
+    gc.collect()
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class Histogram:
+    """A minimal thread-safe Prometheus histogram keyed by a single label."""
+
+    def __init__(self, name, documentation, buckets, label='stage'):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.setdefault(label_value, {
+                'buckets': [0] * len(self.buckets),
+                'sum': 0.0,
+                'count': 0
+            })
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        """Return lines of this histogram in Prometheus text exposition format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{label}}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{label}}} {series["count"]}')
+        return lines
+
+
+STAGE_WALL_SECONDS = Histogram('palmto_stage_wall_seconds', 'Wall-clock time spent in a job stage.',
+                               SECONDS_BUCKETS)
+STAGE_CPU_SECONDS = Histogram('palmto_stage_cpu_seconds', 'CPU time of the job thread spent in a stage.',
+                              SECONDS_BUCKETS)
+STAGE_PEAK_RSS_BYTES = Histogram('palmto_stage_peak_rss_bytes', 'Peak resident set size observed during a stage.',
+                                 BYTES_BUCKETS)
+STAGE_ROWS = Histogram('palmto_stage_rows', 'Number of trajectories handled by a stage.', COUNT_BUCKETS)
+STAGE_POINTS = Histogram('palmto_stage_points', 'Number of coordinate points handled by a stage.', COUNT_BUCKETS)
+
+REGISTRY = [STAGE_WALL_SECONDS, STAGE_CPU_SECONDS, STAGE_PEAK_RSS_BYTES, STAGE_ROWS, STAGE_POINTS]
+
+
+def render_metrics():
+    """Render every registered histogram in Prometheus text format."""
+    lines = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+class PeakRssSampler:
+    """Poll RSS from a daemon thread and keep the highest value seen.
+
+    getrusage only reports the lifetime peak of a process, which hides the footprint
+    of any stage that runs after a bigger one, hence the explicit sampling.
+
+    Args:
+        interval(float): seconds between two samples
+        children(bool): add the RSS of child processes, e.g. pool workers, to each sample
+    """
+
+    def __init__(self, interval=0.1, children=False):
+        self.interval = interval
+        self.children = children
+        self.peak = self.rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def rss(self):
+        return current_rss() + children_rss() if self.children else current_rss()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+        return self.peak
+
+
+class StageTimer:
+    """Context manager measuring one stage of a background job.
+
+    Usage:
+        with recorder.stage('generate', 'Generating trajectories', 40) as stage:
+            ...
+            stage.rows = len(trajs)
+
+    Entering a stage is a cancellation checkpoint of the job running it.
+    """
+
+    def __init__(self, name, queue=None, message=None, progress=None):
+        self.name = name
+        self.queue = queue
+        self.message = message or name
+        self.progress = progress
+        self.rows = None
+        self.points = None
+        self.result = None
+
+    def __enter__(self):
+        checkpoint()
+        if self.queue is not None:
+            self.queue.put({
+                'type': 'progress',
+                'message': self.message,
+                'progress': self.progress
+            })
+        self._sampler = PeakRssSampler().start()
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        peak = self._sampler.stop()
+
+        self.result = {
+            'name': self.name,
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'peak_rss_mb': round(peak / (1024 * 1024), 1),
+            'rows': self.rows,
+            'points': self.points
+        }
+
+        # Failed stages are left out of histograms so they don't skew latency figures
+        if exc_type is not None:
+            return False
+
+        STAGE_WALL_SECONDS.observe(self.name, wall)
+        STAGE_CPU_SECONDS.observe(self.name, cpu)
+        STAGE_PEAK_RSS_BYTES.observe(self.name, peak)
+        if self.rows is not None:
+            STAGE_ROWS.observe(self.name, self.rows)
+        if self.points is not None:
+            STAGE_POINTS.observe(self.name, self.points)
+
+        if self.queue is not None:
+            self.queue.put({
+                'type': 'progress',
+                'message': f"{self.message} ({wall:.2f}s)",
+                'progress': self.progress,
+                'stage': self.result
+            })
+        return False
+
+
+class StageRecorder:
+    """Create stage timers bound to a progress queue and collect their results."""
+
+    def __init__(self, queue=None):
+        self.queue = queue
+        self.stages = []
+
+    def stage(self, name, message=None, progress=None):
+        timer = StageTimer(name, self.queue, message, progress)
+        self.stages.append(timer)
+        return timer
+
+    def summary(self):
+        """Return measurements of all completed stages in execution order."""
+        return [timer.result for timer in self.stages if timer.result is not None]
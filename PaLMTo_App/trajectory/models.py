@@ -13,8 +13,13 @@ class GenerationConfig(models.Model):
     )
     generation_method = models.CharField(max_length=50, choices=[
         ('length_constrained', 'Length-Constrained from Start Point'),
-        ('point_to_point', 'Between Two Points')
+        ('point_to_point', 'Between Two Points'),
+        ('bidirectional', 'Between Two Points, Bidirectional Search')
     ])
+    seed = models.BigIntegerField(
+        blank=True, null=True,
+        help_text="Root seed of the random streams used for generation."
+    )
 
     def __str__(self):
         return f"Configuration set for trajectory generation {self.id}"
@@ -28,4 +33,59 @@ class GeneratedTrajectory(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self) -> str:
-        return f"GeneratedTrajectory {self.id} from Upload {self.config.id}"
\ No newline at end of file
+        return f"GeneratedTrajectory {self.id} from Upload {self.config.id}"
+
+
+# Table for estimated and actual peak memory of background jobs
+class JobMemoryRecord(models.Model):
+    task_id = models.CharField(max_length=64)
+    kind = models.CharField(max_length=20, choices=[
+        ('ngram', 'N-gram Building'),
+        ('ngram_chunked', 'Chunked N-gram Building'),
+        ('generation', 'Trajectory Generation'),
+        ('imputation', 'Trajectory Imputation'),
+        ('map_matching', 'Map Matching')
+    ])
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # Features the estimate was derived from
+    input_bytes = models.BigIntegerField(default=0, help_text="Size of uploaded or cached file in bytes")
+    points = models.BigIntegerField(default=0, help_text="Number of input or generated points")
+    cells = models.BigIntegerField(default=0, help_text="Number of grid cells")
+    num_trajectories = models.PositiveIntegerField(default=0)
+
+    raw_bytes = models.BigIntegerField(help_text="Estimate before calibration")
+    estimated_bytes = models.BigIntegerField(help_text="Calibrated estimate used for admission")
+    peak_bytes = models.BigIntegerField(help_text="Peak RSS increase observed while the job ran")
+
+    def __str__(self) -> str:
+        return f"JobMemoryRecord {self.kind} {self.task_id}"
+
+
+# Table for status and final event of background jobs, kept for clients that reconnect or poll
+class JobResult(models.Model):
+    task_id = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=20, choices=[
+        ('ngram', 'N-gram Building'),
+        ('generation', 'Trajectory Generation'),
+        ('batch_generation', 'Batch Trajectory Generation'),
+        ('imputation', 'Trajectory Imputation'),
+        ('map_matching', 'Map Matching')
+    ])
+    status = models.CharField(max_length=20, default='queued', choices=[
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('complete', 'Complete'),
+        ('error', 'Error'),
+        ('cancelled', 'Cancelled')
+    ])
+    progress = models.PositiveIntegerField(default=0)
+    message = models.TextField(blank=True, default='')
+    event = models.JSONField(blank=True, null=True, help_text="Final progress event, replayed to clients")
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField(db_index=True, help_text="Time after which the record is dropped")
+
+    def __str__(self) -> str:
+        return f"JobResult {self.kind} {self.task_id} ({self.status})"
@@ -0,0 +1,153 @@
+"""
+    Process-wide registry of loaded n-gram caches and startup warm-up of workers
+"""
+import os
+import pickle
+import importlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .generation import LoadedModel
+from .storage import touch
+from .tokens import upgrade_cache
+
+# Modules imported during warm-up besides the URLconf, which pulls in every view
+WARM_MODULES = ('pandas', 'geopandas', 'shapely', 'scipy.sparse.csgraph', 'Palmto_gen')
+
+
+def cache_path(cache_file):
+    """Return path of a cache file in the cache subdir of MEDIA_ROOT."""
+    return os.path.join(settings.MEDIA_ROOT, "cache", cache_file)
+
+
+def load_cache(cache_file):
+    """Unpickle a cache file and convert it to the current cache layout.
+
+    Raises:
+        FileNotFoundError: if there is no such cache file
+    """
+    full_path = cache_path(cache_file)
+    if not os.path.exists(full_path):
+        raise FileNotFoundError(f"Ngram file {cache_file} not found.")
+    return read_cache(full_path)
+
+
+def read_cache(path):
+    """Unpickle a cache file at any path and convert it to the current cache layout."""
+    with open(path, 'rb') as f:
+        cached_data = pickle.load(f)
+
+    # Caches written before token interning still hold Palmto_gen objects
+    return upgrade_cache(cached_data)
+
+
+class ModelRegistry:
+    """Keep loaded models of recently used caches so that requests skip unpickling them.
+
+    Models are keyed by cache file name and reloaded when the file's modification time
+    changes. Besides preloaded caches, which stay pinned, at most MODEL_REGISTRY_SIZE
+    models are kept and the least recently used one is dropped first.
+
+    Warm-up imports the heavy dependencies and loads the preloaded caches with their
+    compiled samplers in a background thread; the worker is ready once it finishes.
+    """
+
+    def __init__(self):
+        self._models = OrderedDict()
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.state = 'ready'
+        self.errors = {}
+
+    def capacity(self):
+        return getattr(settings, 'MODEL_REGISTRY_SIZE', 2)
+
+    def get(self, cache_file):
+        """Return the loaded model of a cache file, loading it on first use.
+
+        Concurrent requests for the same cache wait for a single load. Every call counts as
+        a use of the cache file for storage eviction.
+        """
+        mtime = os.path.getmtime(cache_path(cache_file)) if os.path.exists(cache_path(cache_file)) else None
+        touch(cache_path(cache_file))
+        with self._lock:
+            entry = self._models.get(cache_file)
+            if entry is not None and entry[0] == mtime:
+                self._models.move_to_end(cache_file)
+                return entry[1]
+            loading = self._loading.get(cache_file)
+            if loading is None:
+                loading = self._loading[cache_file] = threading.Lock()
+
+        with loading:
+            with self._lock:
+                entry = self._models.get(cache_file)
+                if entry is not None and entry[0] == mtime:
+                    return entry[1]
+            model = self._load(cache_file)
+            with self._lock:
+                self._models[cache_file] = (mtime, model)
+                self._evict()
+                self._loading.pop(cache_file, None)
+        return model
+
+    def _load(self, cache_file):
+        """Load a model privately, or map it from a bundle shared with other processes."""
+        if getattr(settings, 'MODEL_SHARING', False):
+            from .shared_models import SHARED_MODELS
+            return SHARED_MODELS.load(cache_file)
+        return LoadedModel(load_cache(cache_file))
+
+    def _evict(self):
+        unpinned = [name for name in self._models if name not in self._pinned]
+        for name in unpinned[:max(len(unpinned) - self.capacity(), 0)]:
+            del self._models[name]
+
+    def holds(self, cache_file):
+        """Return True if the current version of a cache file is loaded, without loading it."""
+        mtime = os.path.getmtime(cache_path(cache_file)) if os.path.exists(cache_path(cache_file)) else None
+        with self._lock:
+            entry = self._models.get(cache_file)
+            return entry is not None and entry[0] == mtime
+
+    def loaded(self):
+        """Return names of the caches currently held, least recently used first."""
+        with self._lock:
+            return list(self._models)
+
+    def warm(self, cache_files):
+        """Import heavy modules, then load and compile the samplers of cache files.
+
+        A cache that fails to load is recorded in errors and leaves the registry failed,
+        so that a misconfigured worker never reports ready.
+        """
+        for module in WARM_MODULES + (settings.ROOT_URLCONF,):
+            importlib.import_module(module)
+
+        for cache_file in cache_files:
+            try:
+                with self._lock:
+                    self._pinned.add(cache_file)
+                self.get(cache_file).sampler
+            except Exception as e:
+                self.errors[cache_file] = str(e)
+        self.state = 'failed' if self.errors else 'ready'
+
+    def start_warmup(self, cache_files):
+        """Run warm() in a daemon thread, reporting "warming" until it ends."""
+        self.state = 'warming'
+
+        def run():
+            try:
+                self.warm(cache_files)
+            except Exception as e:
+                self.errors['warmup'] = str(e)
+                self.state = 'failed'
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+REGISTRY = ModelRegistry()
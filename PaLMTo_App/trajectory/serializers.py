@@ -6,6 +6,7 @@ import csv
 import io
 from rest_framework import serializers
 from .models import GeneratedTrajectory, GenerationConfig
+from .formats import TRAJECTORY_COLUMNS, format_of, read_schema_columns
 
 class GenerationConfigSerializer(serializers.ModelSerializer):
     class Meta:
@@ -14,32 +15,39 @@ class GenerationConfigSerializer(serializers.ModelSerializer):
 
     def validate_file(self, file):
         """
-            Check if uploaded file is a csv file with three columns:
+            Check if uploaded file is a csv, parquet or feather file with columns among:
             ['trip_id', 'timestamp', 'geometry']
         """
         if file is None:
             return None
         
-        if not file.name.endswith('.csv'):
-            raise serializers.ValidationError("File must be a .csv")
+        try:
+            fmt = format_of(file.name)
+        except ValueError:
+            raise serializers.ValidationError("File must be a .csv, .parquet or .feather")
         
         try:
-            content = file.read().decode('utf-8')
-            file.seek(0)
-
-            # Convert string to a file object and pass it to reader
-            csv_reader = csv.reader(io.StringIO(content))
-            header = next(csv_reader)
-
-            expected = ['trip_id', 'timestamp', 'geometry']
+            if fmt == 'csv':
+                content = file.read().decode('utf-8')
+                file.seek(0)
+
+                # Convert string to a file object and pass it to reader
+                csv_reader = csv.reader(io.StringIO(content))
+                header = next(csv_reader)
+            else:
+                # Columnar files carry their schema, so no data has to be read
+                header = read_schema_columns(file, fmt)
+                file.seek(0)
+
+            expected = TRAJECTORY_COLUMNS
             
-            # Geometry is a mandatory column in CSV file
+            # Geometry is a mandatory column in trajectory file
             if 'geometry' not in header:
-                raise serializers.ValidationError("CSV file must have a 'geometry' column.")
+                raise serializers.ValidationError("Trajectory file must have a 'geometry' column.")
             
             # Check if other columns are allowed
             if not all(item in expected for item in header):
-                raise serializers.ValidationError(f"CSV header must be exactly {expected}.")
+                raise serializers.ValidationError(f"File columns must be among {expected}.")
         except Exception as e:
             raise serializers.ValidationError(f"Failed to read file: {str(e)}")
         
@@ -0,0 +1,235 @@
+"""
+    N-gram models published once as memory-mapped bundles and shared by every worker process
+"""
+import os
+import uuid
+import pickle
+import shutil
+import weakref
+import threading
+
+import numpy as np
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:     # Not available on Windows, where concurrent publishers only waste work
+    fcntl = None
+
+# Arrays below this size are pickled inline; mapping them isn't worth a file each
+MIN_SHARED_BYTES = 64 * 1024
+
+# Pickles of a bundle. Workers only read the sampler, so they never unpickle the study area
+CACHE_FILE = 'cache.pkl'
+SAMPLER_FILE = 'sampler.pkl'
+ARRAYS_DIR = 'arrays'
+LEASES_DIR = 'leases'
+
+
+def shared_dir():
+    """Return folder holding published bundles, MODEL_SHARED_DIR or cache/shared in MEDIA_ROOT."""
+    return str(getattr(settings, 'MODEL_SHARED_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'cache', 'shared'))
+
+
+def bundle_path(cache_file, mtime_ns):
+    """Return folder of the bundle of one version of a cache file."""
+    return os.path.join(shared_dir(), f"{cache_file}.{mtime_ns}")
+
+
+class _ArrayPickler(pickle.Pickler):
+    """Pickler writing large numeric arrays to .npy files and keeping references to them."""
+
+    def __init__(self, file, arrays_dir, names):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.arrays_dir = arrays_dir
+        # Names by array id, shared by the pickles of a bundle so arrays are written once
+        self.names = names
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes < MIN_SHARED_BYTES:
+            return None
+        key = id(obj)
+        if key not in self.names:
+            self.names[key] = (f"{len(self.names)}.npy", obj)
+            np.save(os.path.join(self.arrays_dir, self.names[key][0]), obj, allow_pickle=False)
+        return self.names[key][0]
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    """Unpickler mapping arrays of a bundle read-only instead of reading them into memory."""
+
+    def __init__(self, file, arrays_dir, mapped):
+        super().__init__(file)
+        self.arrays_dir = arrays_dir
+        self.mapped = mapped
+
+    def persistent_load(self, name):
+        if name not in self.mapped:
+            # A plain ndarray view keeps the mapping alive without np.memmap's subclass overhead
+            self.mapped[name] = np.asarray(np.load(os.path.join(self.arrays_dir, name), mmap_mode='r'))
+        return self.mapped[name]
+
+
+def publish(directory, cached_data, sampler):
+    """Write a loaded cache and its compiled sampler as a bundle.
+
+    The bundle is assembled in a temporary folder and renamed into place, so readers
+    never see a partial one.
+    """
+    temp_dir = f"{directory}.{uuid.uuid4().hex}.tmp"
+    arrays_dir = os.path.join(temp_dir, ARRAYS_DIR)
+    os.makedirs(arrays_dir)
+    os.makedirs(os.path.join(temp_dir, LEASES_DIR))
+    try:
+        names = {}
+        for filename, obj in ((CACHE_FILE, cached_data), (SAMPLER_FILE, sampler)):
+            with open(os.path.join(temp_dir, filename), 'wb') as f:
+                _ArrayPickler(f, arrays_dir, names).dump(obj)
+        os.rename(temp_dir, directory)
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _load(directory, filename, mapped=None):
+    with open(os.path.join(directory, filename), 'rb') as f:
+        return _ArrayUnpickler(f, os.path.join(directory, ARRAYS_DIR),
+                               {} if mapped is None else mapped).load()
+
+
+def attach_sampler(directory):
+    """Map the compiled sampler of a bundle, e.g. in a generation worker process."""
+    sampler = _load(directory, SAMPLER_FILE)
+    sampler.bundle = directory
+    return sampler
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+def live_leases(directory):
+    """Return ids of living processes holding a lease on a bundle, dropping leases of dead ones."""
+    pids = []
+    leases_dir = os.path.join(directory, LEASES_DIR)
+    for name in os.listdir(leases_dir) if os.path.isdir(leases_dir) else []:
+        if name.isdigit() and _pid_alive(int(name)):
+            pids.append(int(name))
+        else:
+            try:
+                os.remove(os.path.join(leases_dir, name))
+            except OSError:
+                pass
+    return pids
+
+
+class SharedModelStore:
+    """Publish n-gram caches as bundles once and map them in every process that serves them.
+
+    The first process to need a version of a cache file unpickles it, compiles its sampler
+    and publishes both under an exclusive file lock; the others map the published arrays,
+    so the OS keeps a single copy in its page cache. Pool workers receive samplers as
+    the path of their bundle.
+
+    A process holds a lease, a file named after its pid, on every bundle it maps, until
+    the last model it loaded from it is garbage collected. Bundles of replaced or deleted
+    cache files are removed once no living process holds a lease.
+    """
+
+    def __init__(self):
+        # Reentrant, since a garbage collection inside a locked section may release a model
+        self._lock = threading.RLock()
+        self._refs = {}
+
+    def load(self, cache_file):
+        """Return a LoadedModel of a cache file mapped from its bundle, publishing it if needed.
+
+        Raises:
+            FileNotFoundError: if there is no such cache file
+        """
+        from .generation import LoadedModel
+        from .registry import cache_path
+
+        path = cache_path(cache_file)
+        directory = bundle_path(cache_file, os.stat(path).st_mtime_ns)
+        os.makedirs(shared_dir(), exist_ok=True)
+
+        with open(os.path.join(shared_dir(), f"{cache_file}.lock"), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.isdir(directory):
+                self._publish(path, directory)
+            self._acquire(directory)
+
+        mapped = {}
+        sampler = _load(directory, SAMPLER_FILE, mapped)
+        sampler.bundle = directory
+        model = LoadedModel(_load(directory, CACHE_FILE, mapped), sampler)
+        weakref.finalize(model, self._release, directory)
+        self.sweep(cache_file)
+        return model
+
+    def _publish(self, path, directory):
+        from .generation import CompiledSampler
+        from .registry import read_cache
+
+        cached_data = read_cache(path)
+        sampler = CompiledSampler(cached_data['ngrams'], cached_data['tokens'],
+                                  reachability=cached_data.get('reachability'))
+        publish(directory, cached_data, sampler)
+
+    def _acquire(self, directory):
+        with self._lock:
+            self._refs[directory] = self._refs.get(directory, 0) + 1
+            open(os.path.join(directory, LEASES_DIR, str(os.getpid())), 'a').close()
+
+    def _release(self, directory):
+        with self._lock:
+            self._refs[directory] -= 1
+            if self._refs[directory] > 0:
+                return
+            del self._refs[directory]
+            try:
+                os.remove(os.path.join(directory, LEASES_DIR, str(os.getpid())))
+            except OSError:
+                pass
+        self.sweep()
+
+    def sweep(self, cache_file=None):
+        """Remove bundles of cache versions that no longer exist and that nobody holds.
+
+        Args:
+            cache_file(str): only look at bundles of this cache file
+
+        Returns:
+            list: removed bundle folders
+        """
+        from .registry import cache_path
+
+        removed = []
+        if not os.path.isdir(shared_dir()):
+            return removed
+        for name in os.listdir(shared_dir()):
+            directory = os.path.join(shared_dir(), name)
+            source, _, version = name.rpartition('.')
+            if not version.isdigit() or not os.path.isdir(directory):
+                continue
+            if cache_file is not None and source != cache_file:
+                continue
+            try:
+                current = os.stat(cache_path(source)).st_mtime_ns == int(version)
+            except OSError:
+                current = False
+            if not current and not live_leases(directory):
+                shutil.rmtree(directory, ignore_errors=True)
+                removed.append(directory)
+        return removed
+
+
+SHARED_MODELS = SharedModelStore()
@@ -0,0 +1,423 @@
+"""
+    Dry runs predicting the n-gram model of candidate cell sizes from a sample of an upload
+"""
+import os
+import csv
+import json
+import math
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .admission import memory_budget, ngram_estimate
+from .cancellation import job_timeout
+from .formats import HAS_PYARROW, format_of, geometry_arrays, parse_geometry
+from .ingest import MAX_START_END_POINTS, SAMPLE_TRIPS, chunk_rows, stream_bounds
+from .tokens import MAX_CELLS, NgramModel, Sentences
+
+# Runs of trajectories read from evenly spaced positions of a file. Files are often
+# ordered by time or vehicle, so a sample of their first rows would be skewed.
+SAMPLE_STRATA = 20
+
+# Per-unit costs in seconds of build steps the dry run skips. Parsing and counting are
+# timed on the sample itself.
+GRID_SECONDS_PER_CELL = 30e-6               # Palmto_gen grid polygons, IDs and centroids
+SPATIAL_JOIN_SECONDS_PER_POINT = 11e-6      # Point GeoDataFrame and spatial join of an in-memory build
+GRAPH_SECONDS_PER_BIGRAM = 2e-6             # Reachability index of the transition graph
+
+# Bytes of a cache per unit: packed key and count of an n-gram, centroid and reachability
+# data of a cell, token and coordinates of a kept original point, one start/end row
+MODEL_BYTES_PER_NGRAM = 16
+MODEL_BYTES_PER_CELL = 96
+MODEL_BYTES_PER_POINT = 20
+MODEL_BYTES_PER_START_END = 16
+
+
+class TripSample:
+    """Trajectories sampled from a file, in random order, with the size of the whole file.
+
+    Attributes:
+        sentences(tokens.Sentences): sampled trajectories with coordinates and no tokens yet
+        total_trips(int): trajectories in the file, estimated unless the sample is complete
+        complete(bool): whether the sample holds every trajectory of the file
+        parse_seconds(float): time spent reading and parsing the sample
+        bounds(tuple): (min_lon, min_lat, max_lon, max_lat) the grid is laid over
+        bounds_exact(bool): whether bounds are those of the whole file rather than the sample
+    """
+
+    def __init__(self, coords, lengths, total_trips, complete, parse_seconds, seed=0):
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        sentences = Sentences(np.zeros(len(coords), dtype=np.int32), offsets, coords)
+        self.sentences = sentences.take(np.random.default_rng(seed).permutation(len(sentences)))
+        self.total_trips = len(sentences) if complete else max(int(total_trips), len(sentences))
+        self.complete = complete
+        self.parse_seconds = parse_seconds
+        self.bounds = (*coords.min(axis=0), *coords.max(axis=0))
+        self.bounds_exact = complete
+
+    @property
+    def num_trips(self):
+        return len(self.sentences)
+
+    @property
+    def num_points(self):
+        return len(self.sentences.tokens)
+
+    @property
+    def total_points(self):
+        return int(round(self.num_points * self.total_trips / max(self.num_trips, 1)))
+
+
+def sample_trips(file_path, num_trips, strata=SAMPLE_STRATA):
+    """Read about num_trips trajectories spread evenly over a trajectory file.
+
+    CSV files are sampled from equal byte ranges, Parquet files from row groups and
+    Feather files from record batches, so nothing but the sample is parsed.
+
+    Raises:
+        ValueError: if the file has no "geometry" column or no points
+    """
+    started = time.perf_counter()
+    if format_of(file_path) == 'csv':
+        coords, lengths, total_trips, complete = _sample_csv(file_path, num_trips, strata)
+    else:
+        coords, lengths, total_trips, complete = _sample_blocks(file_path, num_trips, strata)
+    if not len(coords):
+        raise ValueError("Trajectory file contains no points.")
+    return TripSample(coords, lengths, total_trips, complete, time.perf_counter() - started)
+
+
+def _sample_csv(file_path, num_trips, strata):
+    """Read the first rows of each of strata equal byte ranges of a CSV file.
+
+    A range that holds fewer rows than asked for is read entirely, so small files are
+    read in full and their sample is complete.
+    """
+    file_size = os.path.getsize(file_path)
+    per_stratum = max(math.ceil(num_trips / strata), 1)
+    values, sampled_bytes, complete = [], 0, True
+
+    with open(file_path, 'rb') as f:
+        header = next(csv.reader([f.readline().decode('utf-8-sig')]), [])
+        if 'geometry' not in header:
+            raise ValueError("Trajectory file has no geometry column.")
+        column = header.index('geometry')
+        body = f.tell()
+
+        for i in range(strata):
+            start = body + (file_size - body) * i // strata
+            end = body + (file_size - body) * (i + 1) // strata
+            f.seek(start)
+            if start > body:
+                # Rest of a row cut by the seek, read by the previous range
+                f.readline()
+            lines = []
+            while f.tell() < end:
+                if len(lines) == per_stratum:
+                    complete = False
+                    break
+                line = f.readline()
+                if not line:
+                    break
+                lines.append(line)
+            sampled_bytes += sum(len(line) for line in lines)
+            values.extend(row[column] for row in csv.reader(line.decode() for line in lines) if len(row) > column)
+
+    trajs = parse_geometry(np.array(values, dtype=object)) if values else []
+    lengths = np.fromiter((len(traj) for traj in trajs), dtype=np.int64, count=len(trajs))
+    coords = np.array([point for traj in trajs for point in traj], dtype=np.float64).reshape(-1, 2)
+    total_trips = (file_size - body) * len(values) / sampled_bytes if sampled_bytes else 0
+    return coords, lengths, total_trips, complete
+
+
+def _sample_blocks(file_path, num_trips, strata):
+    """Read the first rows of evenly spaced row groups or record batches of a columnar file."""
+    if not HAS_PYARROW:
+        raise ValueError(f"Reading {os.path.basename(file_path)} requires pyarrow to be installed")
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if format_of(file_path) == 'parquet':
+        parquet_file = pq.ParquetFile(file_path)
+        num_blocks = parquet_file.num_row_groups
+
+        def read(i, rows):
+            # Empty row groups yield no batch
+            batch = next(parquet_file.iter_batches(batch_size=rows, row_groups=[i], columns=['geometry']), None)
+            return batch, parquet_file.metadata.row_group(i).num_rows
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(file_path))
+        num_blocks = reader.num_record_batches
+
+        def read(i, rows):
+            batch = reader.get_batch(i)
+            return batch.select(['geometry']).slice(0, rows), batch.num_rows
+
+    chosen = np.unique(np.linspace(0, num_blocks - 1, min(strata, num_blocks)).round().astype(int))
+    per_block = max(math.ceil(num_trips / max(len(chosen), 1)), 1)
+    coords, lengths, block_rows = [np.empty((0, 2))], [np.empty(0, dtype=np.int64)], []
+    for i in chosen:
+        batch, rows = read(int(i), per_block)
+        block_rows.append(rows)
+        if batch is None:
+            continue
+        block_coords, block_lengths = geometry_arrays(batch.column('geometry'))
+        coords.append(block_coords)
+        lengths.append(block_lengths)
+
+    if format_of(file_path) == 'parquet':
+        total_trips = parquet_file.metadata.num_rows
+    else:
+        # Record batches of one file are written with about the same number of rows
+        total_trips = num_blocks * np.mean(block_rows) if block_rows else 0
+    lengths = np.concatenate(lengths)
+    return np.concatenate(coords), lengths, total_trips, bool(len(lengths) >= total_trips)
+
+
+def _geoparquet_bbox(file_path):
+    """Return the bounding box GeoParquet metadata records for the geometry column, if any."""
+    import pyarrow.parquet as pq
+
+    metadata = pq.read_schema(file_path).metadata or {}
+    try:
+        bbox = json.loads(metadata[b'geo'])['columns']['geometry']['bbox']
+    except (KeyError, TypeError, ValueError):
+        return None
+    # 3D boxes list (xmin, ymin, zmin, xmax, ymax, zmax)
+    if len(bbox) == 6:
+        bbox = [bbox[0], bbox[1], bbox[3], bbox[4]]
+    return tuple(float(bound) for bound in bbox) if len(bbox) == 4 else None
+
+
+def scan_bounds(sample, file_path, max_bytes=None):
+    """Replace the bounds of a sample with those of the whole file where that is cheap.
+
+    A build lays its grid over every point of the file, so a sample that misses outlying
+    points underestimates the grid. GeoParquet files record their bounding box; other
+    files up to CELL_SIZE_BOUNDS_SCAN_MB are scanned in full, which also counts their
+    trajectories exactly. Larger files keep the bounds of the sample, and the grid
+    sizes predicted from them are lower bounds.
+
+    Args:
+        sample(TripSample): trajectories sampled from the file, updated in place
+        file_path(str): path of trajectory file
+        max_bytes(int): largest file scanned in full
+    """
+    if sample.bounds_exact:
+        return
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'CELL_SIZE_BOUNDS_SCAN_MB', 256) * 1024 * 1024
+
+    bbox = _geoparquet_bbox(file_path) if format_of(file_path) == 'parquet' else None
+    if bbox is not None:
+        sample.bounds, sample.bounds_exact = bbox, True
+    elif os.path.getsize(file_path) <= max_bytes:
+        sample.bounds, sample.total_trips, _ = stream_bounds(file_path)
+        sample.bounds_exact = True
+
+
+def grid_shape(bounds, cell_size):
+    """Return the grid ConvertToToken.create_grid lays over bounds, without building its cells.
+
+    Returns:
+        tuple: lower-left corner, cell width and height in degrees, number of columns and rows
+    """
+    from geopy.distance import geodesic
+
+    xmin, ymin, xmax, ymax = bounds
+    height = geodesic((ymin, xmax), (ymax, xmax)).m
+    width = geodesic((ymin, xmin), (ymin, xmax)).m
+    if not width or not height:
+        raise ValueError("Trajectory points span no area to lay a grid over.")
+    cell_w = (xmax - xmin) * cell_size / width
+    cell_h = (ymax - ymin) * cell_size / height
+    return (xmin, ymin), (cell_w, cell_h), math.ceil(width / cell_size), math.ceil(height / cell_size)
+
+
+def _tokenize(sample, origin, cell, n_cols, n_rows):
+    """Return the sample as sentences of dense, column-major cell IDs."""
+    coords = sample.sentences.coords
+    cols = np.minimum(((coords[:, 0] - origin[0]) / cell[0]).astype(np.int64), n_cols - 1)
+    rows = np.minimum(((coords[:, 1] - origin[1]) / cell[1]).astype(np.int64), n_rows - 1)
+    return Sentences(cols * n_rows + rows, sample.sentences.offsets)
+
+
+def _prefix(sentences, n):
+    return Sentences(sentences.tokens[:sentences.offsets[n]], sentences.offsets[:n + 1])
+
+
+def extrapolate(counts, half_distinct, growth, scale):
+    """Predict how many distinct items a corpus scale times the size of a sample holds.
+
+    Two classic estimators bracket the answer. Heaps' law through the sample and a
+    prefix of it overshoots, since vocabularies grow ever slower; Chao1 extrapolation
+    (Chao et al., 2014) from items seen once and twice undershoots, since points of a
+    trip are far from independent draws. The prediction is their geometric mean.
+
+    Args:
+        counts(np.ndarray): occurrences of each distinct item of the sample
+        half_distinct(int): distinct items of a prefix of the sample
+        growth(float): size of the sample relative to the prefix
+        scale(float): size of the corpus relative to the sample
+    """
+    observed = len(counts)
+    if scale <= 1 or not observed:
+        return float(observed)
+
+    exponent = math.log(observed / half_distinct, growth) if half_distinct and growth > 1 else 1.0
+    upper = observed * scale ** min(max(exponent, 0.0), 1.0)
+
+    n = float(counts.sum())
+    f1, f2 = int(np.sum(counts == 1)), int(np.sum(counts == 2))
+    unseen = (n - 1) / n * (f1 * f1 / (2 * f2) if f2 else f1 * (f1 - 1) / 2)
+    lower = observed + unseen * (1 - (1 - f1 / (n * unseen + f1)) ** (n * (scale - 1))) if unseen else observed
+    return math.sqrt(lower * upper)
+
+
+def predict(sample, cell_size, file_size, chunked):
+    """Predict the model and the build of one cell size over the whole file.
+
+    Args:
+        sample(TripSample): trajectories sampled from the file
+        cell_size(int): side length of grid cells in meters
+        file_size(int): size of the file in bytes
+        chunked(bool): whether the file would be ingested in chunks
+
+    Returns:
+        dict: grid and occupied cells, distinct n-grams, their mean support and sparsity,
+            cache size, peak build memory and build time
+    """
+    origin, cell, n_cols, n_rows = grid_shape(sample.bounds, cell_size)
+    grid_cells = n_cols * n_rows
+    prediction = {'cellSize': cell_size, 'gridCells': grid_cells}
+    if grid_cells >= MAX_CELLS:
+        prediction['feasible'] = False
+        prediction['reason'] = f"Grid of {grid_cells} cells is too fine"
+        return prediction
+
+    sentences = _tokenize(sample, origin, cell, n_cols, n_rows)
+    started = time.perf_counter()
+    model = NgramModel.from_sentences(sentences, grid_cells)
+    count_seconds = time.perf_counter() - started
+
+    half_trips = max(sample.num_trips // 2, 1)
+    half = _prefix(sentences, half_trips)
+    half_model = NgramModel.from_sentences(half, grid_cells)
+    growth = sample.num_trips / half_trips
+    scale = sample.total_trips / sample.num_trips
+    cells = extrapolate(np.unique(sentences.tokens, return_counts=True)[1], len(np.unique(half.tokens)), growth, scale)
+    bigrams = extrapolate(model.bigram_counts, half_model.num_bigrams, growth, scale)
+    trigrams = extrapolate(model.trigram_counts, half_model.num_trigrams, growth, scale)
+
+    lengths = sentences.lengths
+    bigram_total = float(np.maximum(lengths - 1, 0).sum() * scale)
+    trigram_total = float(np.maximum(lengths - 2, 0).sum() * scale)
+    cells = min(cells, grid_cells)
+    bigrams = min(bigrams, bigram_total)
+    trigrams = min(trigrams, trigram_total)
+
+    start_end = len(model.start_end) * scale
+    if chunked:
+        start_end = min(start_end, MAX_START_END_POINTS)
+        kept_points = sample.total_points * min(SAMPLE_TRIPS / sample.total_trips, 1)
+    else:
+        kept_points = sample.total_points
+
+    build_seconds = (sample.parse_seconds * scale * (2 if chunked else 1) + count_seconds * scale +
+                     grid_cells * GRID_SECONDS_PER_CELL + bigrams * GRAPH_SECONDS_PER_BIGRAM)
+    if not chunked:
+        build_seconds += sample.total_points * SPATIAL_JOIN_SECONDS_PER_POINT
+    estimate = ngram_estimate(file_size, sample.total_points, grid_cells, sample.total_trips,
+                              chunk_rows() if chunked else None)
+
+    prediction.update({
+        'occupiedCells': int(round(cells)),
+        'uniqueBigrams': int(round(bigrams)),
+        'uniqueTrigrams': int(round(trigrams)),
+        'trigramSupport': round(trigram_total / trigrams, 2) if trigrams else None,
+        'sparsity': round(trigrams / trigram_total, 4) if trigram_total else None,
+        'modelBytes': int((bigrams + trigrams) * MODEL_BYTES_PER_NGRAM + grid_cells * MODEL_BYTES_PER_CELL +
+                          kept_points * MODEL_BYTES_PER_POINT + start_end * MODEL_BYTES_PER_START_END),
+        'buildPeakBytes': estimate.bytes,
+        'buildSeconds': round(build_seconds, 1),
+        'feasible': True
+    })
+    time_limit = job_timeout('ngrams')
+    if estimate.bytes > memory_budget():
+        prediction.update(feasible=False, reason="Build would exceed the server memory budget")
+    elif time_limit is not None and build_seconds > time_limit:
+        prediction.update(feasible=False, reason=f"Build would exceed the time limit of {time_limit}s")
+    return prediction
+
+
+def recommend(predictions, min_support=None):
+    """Pick the finest feasible cell size whose trigrams are observed often enough.
+
+    Finer cells keep more spatial detail, but each trigram is seen fewer times and the
+    generator has less evidence to follow. When no size reaches min_support, the
+    best supported feasible one is picked.
+
+    Returns:
+        tuple: recommended cell size, None if no candidate is feasible, and the reason
+    """
+    if min_support is None:
+        min_support = getattr(settings, 'CELL_SIZE_MIN_TRIGRAM_SUPPORT', 5)
+    feasible = [p for p in predictions if p['feasible'] and p['trigramSupport'] is not None]
+    if not feasible:
+        return None, "No candidate cell size can be built within the server limits."
+    supported = [p for p in feasible if p['trigramSupport'] >= min_support]
+    if supported:
+        best = min(supported, key=lambda p: p['cellSize'])
+        return best['cellSize'], (f"Finest cell size whose trigrams are seen {best['trigramSupport']} "
+                                  f"times on average, at least {min_support}.")
+    best = max(feasible, key=lambda p: (p['trigramSupport'], -p['cellSize']))
+    return best['cellSize'], (f"No cell size reaches a trigram support of {min_support}; "
+                              f"this one comes closest with {best['trigramSupport']}.")
+
+
+def dry_run(file_path, candidates=None, num_trips=None, chunked=False):
+    """Sample a trajectory file once and predict the model of each candidate cell size.
+
+    Args:
+        file_path(str): path of trajectory file
+        candidates(list): cell sizes in meters, CELL_SIZE_CANDIDATES by default
+        num_trips(int): trajectories to sample, CELL_SIZE_SAMPLE_TRIPS by default
+        chunked(bool): whether the file would be ingested in chunks
+
+    Returns:
+        dict: the sample, predictions by cell size, the recommended size and why. Grid
+            sizes are lower bounds unless the dataset's "boundsExact" is true.
+    """
+    started = time.perf_counter()
+    if candidates is None:
+        candidates = getattr(settings, 'CELL_SIZE_CANDIDATES', [100, 200, 300, 500, 750, 1000, 1500, 2000])
+    if num_trips is None:
+        num_trips = getattr(settings, 'CELL_SIZE_SAMPLE_TRIPS', 2000)
+
+    file_size = os.path.getsize(file_path)
+    sample = sample_trips(file_path, num_trips)
+    scan_bounds(sample, file_path)
+    predictions = [predict(sample, cell_size, file_size, chunked) for cell_size in sorted(set(candidates))]
+    recommended, reason = recommend(predictions)
+    if not sample.bounds_exact:
+        reason += " Grid sizes are lower bounds, as the sample may miss outlying points."
+    return {
+        'sample': {
+            'trajectories': sample.num_trips,
+            'points': sample.num_points,
+            'complete': sample.complete
+        },
+        'dataset': {
+            'bytes': file_size,
+            'trajectories': sample.total_trips,
+            'points': sample.total_points,
+            'bounds': [float(bound) for bound in sample.bounds],
+            'boundsExact': sample.bounds_exact,
+            'ingestMode': 'chunked' if chunked else 'memory'
+        },
+        'candidates': predictions,
+        'recommended': recommended,
+        'reason': reason,
+        'seconds': round(time.perf_counter() - started, 3)
+    }
@@ -0,0 +1,297 @@
+"""
+    SQLite store of generated and map-matched trajectories with an R*Tree index of their bounding boxes
+"""
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+
+from .formats import iter_trajectory_batches
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    num_trajectories INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trajectories (
+    id INTEGER PRIMARY KEY,
+    dataset_id INTEGER NOT NULL REFERENCES datasets(id) ON DELETE CASCADE,
+    trip_id TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    num_points INTEGER NOT NULL,
+    coords BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS trajectories_dataset ON trajectories(dataset_id);
+CREATE INDEX IF NOT EXISTS trajectories_time ON trajectories(start_time, end_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS trajectory_bbox USING rtree(id, min_lon, max_lon, min_lat, max_lat);
+"""
+
+# Rows written per transaction while indexing a file
+BATCH_ROWS = 5000
+
+# Upper bound of results per page
+MAX_PAGE_SIZE = 1000
+
+# Serializes writers of this process; writes of other processes are serialized by
+# taking SQLite's write lock up front with BEGIN IMMEDIATE
+_WRITE_LOCK = threading.Lock()
+_SCHEMA_READY = set()
+
+
+def store_path():
+    """Return path of the SQLite file, TRAJECTORY_STORE_PATH or a file in MEDIA_ROOT."""
+    return str(getattr(settings, 'TRAJECTORY_STORE_PATH', None) or
+               os.path.join(settings.MEDIA_ROOT, 'trajectory_store.sqlite3'))
+
+
+def connect():
+    """Open a connection to the store, creating its schema on first use."""
+    path = store_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA foreign_keys = ON")
+    if path not in _SCHEMA_READY:
+        # WAL lets queries run while a dataset is being indexed
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(SCHEMA)
+        _SCHEMA_READY.add(path)
+    return conn
+
+
+def parse_time(value):
+    """Parse epoch seconds or an ISO 8601 date-time into epoch seconds.
+
+    Raises:
+        ValueError: if value is neither
+    """
+    if value in (None, ''):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def _bounding_boxes(coords, lengths):
+    """Return per-trip (min_lon, max_lon, min_lat, max_lat) of non-empty trips."""
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[lengths > 0]
+    mins = np.minimum.reduceat(coords, starts, axis=0)
+    maxs = np.maximum.reduceat(coords, starts, axis=0)
+    return np.column_stack([mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]])
+
+
+def index_dataset(file_path, kind):
+    """Load a trajectory file into the store, replacing an earlier copy of it.
+
+    Trips are stamped with their "timestamp" column, taken as the epoch start time of a
+    trip sampled every TRAJECTORY_SAMPLING_SECONDS. Files without timestamps, such as
+    generated ones, are stamped with the time they were written.
+
+    Args:
+        file_path(str): path of a generated or matched trajectory file
+        kind(str): "generated" or "matched"
+
+    Returns:
+        int: number of trajectories indexed
+    """
+    filename = os.path.basename(file_path)
+    created_at = os.path.getmtime(file_path)
+    interval = getattr(settings, 'TRAJECTORY_SAMPLING_SECONDS', 15)
+    total = 0
+
+    with _WRITE_LOCK:
+        conn = connect()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                remove_dataset(filename, conn)
+                dataset_id = conn.execute(
+                    "INSERT INTO datasets (filename, kind, created_at) VALUES (?, ?, ?)",
+                    (filename, kind, created_at)).lastrowid
+
+            batches = iter_trajectory_batches(file_path, BATCH_ROWS, columns=('trip_id', 'timestamp', 'geometry'))
+            for others, coords, lengths in batches:
+                keep = lengths > 0
+                if not keep.any():
+                    continue
+                boxes = _bounding_boxes(coords, lengths)
+                parts = np.split(coords, np.cumsum(lengths)[:-1])
+
+                trip_ids = others['trip_id'].astype(str).tolist() if 'trip_id' in others else [None] * len(lengths)
+                if 'timestamp' in others:
+                    starts = others['timestamp'].astype(float).to_numpy()
+                    ends = starts + (lengths - 1).clip(min=0) * interval
+                else:
+                    starts = ends = np.full(len(lengths), created_at)
+
+                rows = [
+                    (dataset_id, trip_ids[i], float(starts[i]), float(ends[i]), int(lengths[i]),
+                     np.ascontiguousarray(parts[i], dtype=np.float64).tobytes())
+                    for i in np.flatnonzero(keep)
+                ]
+                with conn:
+                    # Ids are assigned here so that box rows can share them. The write lock is taken
+                    # before reading MAX(id), so another process can't claim the same ids meanwhile
+                    conn.execute("BEGIN IMMEDIATE")
+                    first_id = (conn.execute("SELECT COALESCE(MAX(id), 0) FROM trajectories").fetchone()[0]) + 1
+                    conn.executemany(
+                        "INSERT INTO trajectories (id, dataset_id, trip_id, start_time, end_time, num_points, coords) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(first_id + i, *row) for i, row in enumerate(rows)])
+                    conn.executemany(
+                        "INSERT INTO trajectory_bbox VALUES (?, ?, ?, ?, ?)",
+                        [(first_id + i, *bounds) for i, bounds in enumerate(boxes.tolist())])
+                total += len(rows)
+
+            with conn:
+                conn.execute("UPDATE datasets SET num_trajectories = ? WHERE id = ?", (total, dataset_id))
+        finally:
+            conn.close()
+    return total
+
+
+def index_saved_file(file_path, kind):
+    """Index a file right after it was written, without failing the job that wrote it.
+
+    Disabled when TRAJECTORY_SPATIAL_INDEX is False.
+    """
+    if not getattr(settings, 'TRAJECTORY_SPATIAL_INDEX', True):
+        return
+    try:
+        index_dataset(file_path, kind)
+    except Exception as e:
+        print(f"Failed to index {file_path}: {e}")
+
+
+def remove_dataset(filename, conn=None):
+    """Drop a dataset and its trajectories from the store."""
+    own = conn is None
+    if own:
+        conn = connect()
+    try:
+        row = conn.execute("SELECT id FROM datasets WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM trajectory_bbox WHERE id IN (SELECT id FROM trajectories WHERE dataset_id = ?)",
+                     (row[0],))
+        conn.execute("DELETE FROM trajectories WHERE dataset_id = ?", (row[0],))
+        conn.execute("DELETE FROM datasets WHERE id = ?", (row[0],))
+        if own:
+            conn.commit()
+    finally:
+        if own:
+            conn.close()
+
+
+def is_indexed(filename):
+    conn = connect()
+    try:
+        return conn.execute("SELECT 1 FROM datasets WHERE filename = ?", (filename,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+def list_datasets():
+    """Return indexed datasets, most recent first."""
+    conn = connect()
+    try:
+        rows = conn.execute(
+            "SELECT filename, kind, num_trajectories, created_at FROM datasets ORDER BY created_at DESC").fetchall()
+    finally:
+        conn.close()
+    return [{'filename': filename, 'kind': kind, 'num_trajectories': count, 'created_at': created_at}
+            for filename, kind, count, created_at in rows]
+
+
+def search(bbox=None, start=None, end=None, dataset=None, kind=None, limit=100, after=0,
+           exact=True, include_geometry=True):
+    """Find trajectories by bounding box, time window and dataset, one page at a time.
+
+    The R*Tree narrows candidates to trips whose bounding box overlaps bbox. With exact
+    set, candidates are then tested against bbox with their actual geometry, so trips
+    that only pass around a corner of the area are left out.
+
+    Args:
+        bbox(tuple): (min_lon, min_lat, max_lon, max_lat) of the area of interest
+        start(float): epoch seconds; trips ending earlier are excluded
+        end(float): epoch seconds; trips starting later are excluded
+        dataset(str): restrict to one indexed file
+        kind(str): restrict to "generated" or "matched" files
+        limit(int): page size, at most MAX_PAGE_SIZE
+        after(int): cursor returned as "next" by the previous page
+        exact(bool): refine bounding-box matches with the trajectory geometry
+        include_geometry(bool): return coordinates of each trip
+
+    Returns:
+        dict: "results" of the page and "next" cursor, None on the last page
+    """
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    clauses, params = ["t.id > ?"], [int(after)]
+    tables = "trajectories t JOIN datasets d ON d.id = t.dataset_id"
+
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        tables = "trajectory_bbox r JOIN trajectories t ON t.id = r.id JOIN datasets d ON d.id = t.dataset_id"
+        clauses += ["r.max_lon >= ?", "r.min_lon <= ?", "r.max_lat >= ?", "r.min_lat <= ?"]
+        params += [min_lon, max_lon, min_lat, max_lat]
+    if start is not None:
+        clauses.append("t.end_time >= ?")
+        params.append(start)
+    if end is not None:
+        clauses.append("t.start_time <= ?")
+        params.append(end)
+    if dataset:
+        clauses.append("d.filename = ?")
+        params.append(dataset)
+    if kind:
+        clauses.append("d.kind = ?")
+        params.append(kind)
+
+    query = (f"SELECT t.id, d.filename, t.trip_id, t.start_time, t.end_time, t.num_points, t.coords "
+             f"FROM {tables} WHERE {' AND '.join(clauses)} ORDER BY t.id")
+    area = None
+    if bbox is not None and exact:
+        from shapely import LineString, Point, box
+        area = box(*bbox)
+
+    results, last_id, exhausted = [], None, True
+    conn = connect()
+    try:
+        for row_id, filename, trip_id, start_time, end_time, num_points, blob in conn.execute(query, params):
+            if len(results) == limit:
+                exhausted = False
+                break
+            last_id = row_id
+            coords = np.frombuffer(blob, dtype=np.float64).reshape(-1, 2)
+            if area is not None:
+                shape = LineString(coords) if len(coords) > 1 else Point(coords[0])
+                if not shape.intersects(area):
+                    continue
+
+            result = {
+                'id': row_id,
+                'dataset': filename,
+                'trip_id': trip_id,
+                'start_time': start_time,
+                'end_time': end_time,
+                'num_points': num_points,
+                'bbox': [*coords.min(axis=0).tolist(), *coords.max(axis=0).tolist()]
+            }
+            if include_geometry:
+                result['geometry'] = {'type': 'LineString', 'coordinates': coords.tolist()}
+            results.append(result)
+    finally:
+        conn.close()
+
+    return {
+        'results': results,
+        'next': None if exhausted else last_id
+    }
+
@@ -0,0 +1,169 @@
+"""
+    Byte quotas of media folders with least-recently-used eviction and periodic housekeeping
+"""
+import os
+import re
+import time
+import threading
+
+from django.conf import settings
+
+from .downloads import ENCODINGS, FILE_INDEX, variant_path
+
+# Names the server gives caches; any other cache name was chosen by a user and is pinned
+SYSTEM_CACHE_NAME = re.compile(r'^(temp_)?cache_[0-9a-f-]+\.pkl$')
+
+# Serializes eviction passes of the housekeeping thread and explicit calls
+_EVICTION_LOCK = threading.Lock()
+
+
+def media_dir(subdir):
+    return os.path.join(settings.MEDIA_ROOT, subdir)
+
+
+def storage_quotas():
+    """Return byte quota of each media sub-folder that has one."""
+    return {subdir: quota for subdir, quota in getattr(settings, 'STORAGE_QUOTAS', {}).items() if quota}
+
+
+def touch(path):
+    """Record an access to a file for LRU eviction.
+
+    The access time is set explicitly, since many file systems update it lazily or not at
+    all. The modification time, which download validators and the model registry rely
+    on, is left untouched.
+    """
+    try:
+        os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+    except OSError:
+        pass
+
+
+def is_pinned(path):
+    """Whether a file is exempt from eviction.
+
+    Cache files are pinned when named by a user, listed in STORAGE_PINNED_CACHES or
+    preloaded at startup. The road network set as MAP_MATCHING_NETWORK is pinned too.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    name = os.path.basename(path)
+    if directory == os.path.abspath(media_dir("networks")):
+        return name == getattr(settings, 'MAP_MATCHING_NETWORK', None)
+    if directory != os.path.abspath(media_dir("cache")):
+        return False
+    pinned = set(getattr(settings, 'STORAGE_PINNED_CACHES', [])) | set(getattr(settings, 'PRELOAD_NGRAM_CACHES', []))
+    return name in pinned or not SYSTEM_CACHE_NAME.match(name)
+
+
+def discard_output(file_path):
+    """Remove an output file with its compressed variants, download and search index entries."""
+    from .spatial_store import remove_dataset
+
+    filename = os.path.basename(file_path)
+    for path in [file_path] + [variant_path(file_path, encoding) for encoding in ENCODINGS]:
+        if os.path.exists(path):
+            os.remove(path)
+    FILE_INDEX.forget(filename)
+    if getattr(settings, 'TRAJECTORY_SPATIAL_INDEX', True):
+        remove_dataset(filename)
+
+
+def forget_upload(path):
+    """Clear the file of generation configs that referenced an evicted upload."""
+    from .models import GenerationConfig
+
+    name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+    GenerationConfig.objects.filter(file=name).update(file=None)
+
+
+def usage(subdir):
+    """Return files directly inside a media sub-folder as (path, bytes, last used) tuples.
+
+    Last use is the later of access and modification time, so files still being written
+    count as fresh.
+    """
+    files = []
+    try:
+        entries = list(os.scandir(media_dir(subdir)))
+    except FileNotFoundError:
+        return files
+    for entry in entries:
+        try:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files.append((entry.path, stat.st_size, max(stat.st_atime, stat.st_mtime)))
+        except FileNotFoundError:
+            continue
+    return files
+
+
+def enforce_quota(subdir, quota, now=None):
+    """Evict least recently used files of a folder until it fits into its quota.
+
+    Pinned files and files used within STORAGE_EVICTION_GRACE_SECONDS are never evicted,
+    so a folder may stay over quota when they alone exceed it. Generation configs that
+    referenced an evicted upload are left without a file rather than a dangling one.
+
+    Returns:
+        list: paths of evicted files
+    """
+    now = time.time() if now is None else now
+    grace = getattr(settings, 'STORAGE_EVICTION_GRACE_SECONDS', 3600)
+    files = usage(subdir)
+    excess = sum(size for _, size, _ in files) - quota
+    evicted = []
+    for path, size, last_used in sorted(files, key=lambda file: file[2]):
+        if excess <= 0:
+            break
+        if now - last_used < grace or is_pinned(path):
+            continue
+        try:
+            discard_output(path)
+            if subdir == 'uploads':
+                forget_upload(path)
+        except Exception as e:
+            print(f"Failed to evict {path}: {e}")
+            continue
+        excess -= size
+        evicted.append(path)
+    return evicted
+
+
+def enforce_quotas():
+    """Bring every folder with a quota under it.
+
+    Returns:
+        dict: evicted paths by sub-folder
+    """
+    with _EVICTION_LOCK:
+        return {subdir: enforce_quota(subdir, quota) for subdir, quota in storage_quotas().items()}
+
+
+def housekeep():
+    """One pass of periodic housekeeping: storage quotas, stale progress queues and model bundles."""
+    from .jobs import sweep_progress_queues
+    from .shared_models import SHARED_MODELS
+
+    evicted = enforce_quotas()
+    for subdir, paths in evicted.items():
+        if paths:
+            print(f"Evicted {len(paths)} files from {subdir} to stay within its quota")
+    sweep_progress_queues()
+    SHARED_MODELS.sweep()
+
+
+def start_housekeeping():
+    """Run housekeep() every STORAGE_SWEEP_INTERVAL_SECONDS in a daemon thread."""
+    interval = getattr(settings, 'STORAGE_SWEEP_INTERVAL_SECONDS', 300)
+    if not interval:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                housekeep()
+            except Exception as e:
+                print(f"Housekeeping failed: {e}")
+
+    threading.Thread(target=run, daemon=True).start()
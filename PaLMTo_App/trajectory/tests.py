@@ -1,3 +1,442 @@
-from django.test import TestCase
+import os
+import re
+import json
+import sys
+import shutil
+import tempfile
+import subprocess
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.test import RequestFactory, SimpleTestCase, override_settings
+
+from .downloads import make_etag, negotiate_encoding, parse_range, serve_file
+from .geo_process import boundary_from_bounds
+from .generation import CHUNK_SIZE, MAX_ABANDONED_PER_TRAJECTORY, LoadedModel, generate_sentences
+from .graph import ReachabilityIndex, TransitionGraph
+from .imputation import Imputer
+from .map_matching import MapMatcher, RoadNetwork
+from .metrics import StageRecorder
+from .tokens import GridIndex, NgramModel, Sentences, TokenTable
+from .views import NgramGenerationView
+
+# Dependencies that must only be imported by the code paths using them
+LAZY_MODULES = ('pandas', 'geopandas', 'shapely', 'scipy', 'pyarrow', 'timezonefinder', 'Palmto_gen')
+
+# Cumulative import time of the URLconf, i.e. every view, that startup may spend
+IMPORT_BUDGET_SECONDS = 1.0
+
+
+class ImportTimeTests(SimpleTestCase):
+    """Guard process startup against eager imports of heavy dependencies."""
+
+    def import_urls(self, *options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'PaLMTo_App.settings'))
+        code = ("import sys, django; django.setup(); import trajectory.urls; "
+                "print(' '.join(sorted({name.split('.')[0] for name in sys.modules})))")
+        return subprocess.run([sys.executable, *options, '-c', code], cwd=settings.BASE_DIR, env=env,
+                              capture_output=True, text=True, check=True)
+
+    def test_views_import_no_heavy_dependencies(self):
+        loaded = set(self.import_urls().stdout.split())
+        self.assertEqual(loaded & set(LAZY_MODULES), set())
+
+    def test_urlconf_import_time_within_budget(self):
+        # Lines read "import time: self [us] | cumulative | name", nested names indented
+        timings = self.import_urls('-X', 'importtime').stderr
+        match = re.search(r'^import time:\s+\d+ \|\s+(\d+) \| trajectory\.urls$', timings, re.MULTILINE)
+        self.assertIsNotNone(match)
+        self.assertLess(int(match.group(1)) / 1e6, IMPORT_BUDGET_SECONDS)
+
+
+class GenerationReproducibilityTests(SimpleTestCase):
+    """Guard that a seed yields the same trajectories whatever the number of workers."""
+
+    GRID = 12
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Random walks over a small grid stand in for an uploaded dataset
+        rng = np.random.default_rng(0)
+        walks = []
+        for _ in range(300):
+            col, row = rng.integers(cls.GRID, size=2)
+            walk = []
+            for _ in range(rng.integers(6, 25)):
+                walk.append(int(col * cls.GRID + row))
+                d_col, d_row = [(0, 1), (1, 0), (0, -1), (-1, 0)][rng.integers(4)]
+                col = min(max(col + d_col, 0), cls.GRID - 1)
+                row = min(max(row + d_row, 0), cls.GRID - 1)
+            walks.append(walk)
+        ids = np.arange(cls.GRID ** 2)
+        table = TokenTable(cls.GRID, np.column_stack([ids // cls.GRID, ids % cls.GRID]) * 0.01)
+        ngrams = NgramModel.from_sentences(Sentences.from_token_lists(walks), cls.GRID ** 2)
+        cls.model = LoadedModel({'ngrams': ngrams, 'tokens': table})
+
+    def test_same_seed_same_output_for_any_worker_count(self):
+        num_trajs = 2 * CHUNK_SIZE + 100
+        for method in ('length_constrained', 'point_to_point', 'bidirectional'):
+            with self.subTest(method=method):
+                single = generate_sentences(self.model, method, num_trajs, traj_len=10, seed=11, workers=1)
+                pooled = generate_sentences(self.model, method, num_trajs, traj_len=10, seed=11, workers=3)
+                self.assertTrue(single[0])
+                self.assertEqual(single, pooled)
+
+    def test_unreachable_length_gives_up(self):
+        # Walks of the model never come close to this length, so every attempt is dropped
+        sentences, _, abandoned = generate_sentences(self.model, 'length_constrained', 2, traj_len=100000,
+                                                     seed=11, workers=1)
+        self.assertEqual(sentences, [])
+        self.assertEqual(abandoned, MAX_ABANDONED_PER_TRAJECTORY * 2 + 1)
+
+
+class GridSizeTests(SimpleTestCase):
+    """Guard packed n-gram keys against grids with more cells than they can encode."""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as f:
+            f.write('trip_id,geometry\n')
+            for trip_id in (1, 2):
+                points = [[-8.62 + 0.004 * i, 41.14 + 0.003 * i * trip_id] for i in range(8)]
+                f.write(f'{trip_id},"{points}"\n')
+        self.addCleanup(os.remove, self.path)
+
+    def build(self, mode):
+        return NgramGenerationView()._process_to_ngrams({'cell_size': 500, 'ingest_mode': mode},
+                                                        StageRecorder(), self.path)
+
+    def test_too_fine_grid_is_refused(self):
+        for mode in ('memory', 'chunked'):
+            with self.subTest(mode=mode), mock.patch('trajectory.tokens.MAX_CELLS', 16):
+                with self.assertRaisesRegex(ValueError, 'too fine'):
+                    self.build(mode)
+
+    def test_grid_below_limit_is_built(self):
+        ngrams, table, sentences, _ = self.build('memory')
+        self.assertLess(table.num_cells, 64)
+        self.assertEqual(len(sentences), 2)
+        self.assertGreater(ngrams.num_trigrams, 0)
+
+
+class DownloadTests(SimpleTestCase):
+    """Guard byte ranges, content negotiation and conditional GET of downloads."""
+
+    SIZE = 4096
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.path = os.path.join(media, 'trips.csv')
+        self.content = bytes(range(256)) * (self.SIZE // 256)
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+        self.etag = make_etag(os.stat(self.path))
+
+    def get(self, **headers):
+        response = serve_file(RequestFactory().get('/', **headers), self.path, 'trips.csv')
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_parse_range(self):
+        cases = {
+            'bytes=0-9': (0, 9),
+            'bytes=10-': (10, 99),
+            'bytes=90-500': (90, 99),
+            'bytes=-10': (90, 99),
+            'bytes=-500': (0, 99),
+            'bytes=100-': False,
+            'bytes=20-10': False,
+            'bytes=-0': False,
+            'bytes=-': None,
+            'bytes=0-1,5-6': None,
+            'items=0-9': None,
+            '': None
+        }
+        for header, expected in cases.items():
+            with self.subTest(header=header):
+                self.assertEqual(parse_range(header, 100), expected)
+
+    def test_negotiate_encoding(self):
+        with mock.patch('trajectory.downloads.zstandard', None):
+            self.assertEqual(negotiate_encoding('gzip, deflate'), 'gzip')
+            self.assertEqual(negotiate_encoding('gzip;q=0'), None)
+            self.assertEqual(negotiate_encoding('*;q=0.5'), 'gzip')
+            self.assertEqual(negotiate_encoding('*, gzip;q=0'), None)
+            self.assertEqual(negotiate_encoding('zstd'), None)
+            self.assertEqual(negotiate_encoding(None), None)
+        with mock.patch('trajectory.downloads.zstandard', object()):
+            self.assertEqual(negotiate_encoding('gzip, zstd;q=0.1'), 'zstd')
+            self.assertEqual(negotiate_encoding('zstd;q=0, gzip'), 'gzip')
+            self.assertEqual(negotiate_encoding('zstd;q=0.5.1, gzip'), 'gzip')
+
+    def test_full_and_partial_content(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(self.body(response), self.content)
+
+        response = self.get(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{self.SIZE}')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(self.body(response), self.content[100:200])
+
+        response = self.get(HTTP_RANGE='bytes=-16')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.content[-16:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE=f'bytes={self.SIZE}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{self.SIZE}')
+
+    def test_if_none_match(self):
+        for header in (self.etag, f'W/{self.etag}', f'"other", {self.etag}', '*'):
+            with self.subTest(header=header):
+                self.assertEqual(self.get(HTTP_IF_NONE_MATCH=header).status_code, 304)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+    def test_if_range(self):
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(self.body(response), self.content[:10])
+
+        # A stale validator means the whole, changed file is sent
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+
+
+class ImputationTests(SimpleTestCase):
+    """Guard how gaps are found and which cell paths bridge them."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.grid = GridIndex(boundary_from_bounds(-8.62, 41.14, -8.56, 41.185), 500)
+        n_cols, n_rows = cls.grid.n_cols, cls.grid.n_rows
+        cls.cell = staticmethod(lambda col, row: col * n_rows + row)
+
+        # Eastbound drives along every row: the model never moves north, south or west
+        rows = [[cls.cell(col, row) for col in range(n_cols)] for row in range(n_rows)]
+        cls.eastbound = TransitionGraph.from_model(
+            NgramModel.from_sentences(Sentences.from_token_lists(rows), cls.grid.num_cells))
+
+        # Random walks between neighbouring cells allow many paths between two cells
+        rng = np.random.default_rng(0)
+        walks = []
+        for _ in range(400):
+            col, row = int(rng.integers(n_cols)), int(rng.integers(n_rows))
+            walk = []
+            for _ in range(20):
+                walk.append(cls.cell(col, row))
+                d_col, d_row = [(0, 1), (1, 0), (0, -1), (-1, 0)][rng.integers(4)]
+                col = min(max(col + d_col, 0), n_cols - 1)
+                row = min(max(row + d_row, 0), n_rows - 1)
+            walks.append(walk)
+        cls.walks = TransitionGraph.from_model(
+            NgramModel.from_sentences(Sentences.from_token_lists(walks), cls.grid.num_cells))
+
+    def imputer(self, graph=None, mode='likely', hops=100):
+        return Imputer(self.grid, graph or self.eastbound, mode, hops)
+
+    def trips(self, *cells_of_trips):
+        """Coordinates and lengths of trajectories recorded at the centroids of cells."""
+        cells = [cell for trip in cells_of_trips for cell in trip]
+        coords = self.grid.tokens.centroids[cells]
+        return coords, np.array([len(trip) for trip in cells_of_trips], dtype=np.int64)
+
+    def test_find_gaps(self):
+        cell = self.cell
+        tokens = np.array([cell(0, 0), cell(1, 1), cell(3, 1), -1, cell(6, 1),
+                           cell(0, 5), cell(0, 5), cell(4, 5)])
+        # Neighbours, points outside the grid and the jump between trips are no gaps
+        gaps = self.imputer().find_gaps(tokens, np.array([5, 3]))
+        self.assertEqual(gaps.tolist(), [1, 6])
+
+    def test_likely_paths_and_hop_cap(self):
+        cell = self.cell
+        sources = np.array([cell(0, 2), cell(0, 2), cell(4, 2)])
+        targets = np.array([cell(4, 2), cell(1, 2), cell(0, 2)])
+        paths = self.imputer().shortest_paths(sources, targets, np.random.default_rng(0))
+        # The model only drives east, so the westbound gap can't be bridged
+        self.assertEqual(paths, [[cell(1, 2), cell(2, 2), cell(3, 2)], [], None])
+
+        # The cap counts the cells inserted into a gap
+        self.assertIsNone(self.imputer(hops=2).shortest_paths(sources[:1], targets[:1], None)[0])
+        self.assertIsNotNone(self.imputer(hops=3).shortest_paths(sources[:1], targets[:1], None)[0])
+
+    def test_impute_inserts_cell_centroids(self):
+        import pandas as pd
+
+        cell = self.cell
+        coords, lengths = self.trips([cell(0, 1), cell(3, 1), cell(4, 1)], [cell(5, 0), cell(1, 0)])
+        df, stats = self.imputer().impute(pd.DataFrame({'trip_id': [7, 8]}), coords, lengths)
+
+        self.assertEqual(df['trip_id'].tolist(), [7, 8])
+        self.assertEqual(df['imputed_points'].tolist(), [2, 0])
+        expected = self.grid.tokens.centroids[[cell(0, 1), cell(1, 1), cell(2, 1), cell(3, 1), cell(4, 1)]]
+        np.testing.assert_allclose(df['geometry'][0], expected)
+        self.assertEqual(stats, {'trajectories': 2, 'points': 5, 'gaps': 2, 'filledGaps': 1,
+                                 'unfilledGaps': 1, 'imputedPoints': 2})
+
+    def test_sampled_paths_follow_the_model_and_repeat_per_seed(self):
+        import pandas as pd
+
+        cell = self.cell
+        coords, lengths = self.trips([cell(0, 0), cell(6, 7)], [cell(8, 1), cell(1, 8)])
+        others = pd.DataFrame({'trip_id': [1, 2]})
+        imputer = self.imputer(self.walks, 'sampled')
+        runs = {seed: [imputer.impute(others, coords, lengths, seed)[0] for _ in range(2)] for seed in range(5)}
+
+        for seed, (first, second) in runs.items():
+            self.assertEqual(first['geometry'].tolist(), second['geometry'].tolist())
+            for geometry in first['geometry']:
+                tokens = self.grid.lookup(np.array(geometry))
+                cells = np.column_stack([tokens // self.grid.n_rows, tokens % self.grid.n_rows])
+                steps = np.abs(np.diff(cells, axis=0))
+                self.assertTrue((steps.sum(axis=1) == 1).all())
+        self.assertGreater(len({str(first['geometry'].tolist()) for first, _ in runs.values()}), 1)
+
+
+class ReachabilityTests(SimpleTestCase):
+    """Guard that reachability answers and hop bounds never contradict the graph."""
+
+    CELLS = 60
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from scipy.sparse.csgraph import shortest_path
+
+        # Mostly forward edges with a few cycles, so there are both components of several
+        # cells and many pairs that can't reach each other
+        rng = np.random.default_rng(3)
+        bigrams = [[cell, cell + int(step)] for cell in range(cls.CELLS) for step in rng.integers(1, 6, size=2)
+                   if cell + step < cls.CELLS]
+        bigrams += [[cell + 4, cell] for cell in range(0, cls.CELLS, 15)]
+        ngrams = NgramModel.from_sentences(Sentences.from_token_lists(bigrams), cls.CELLS)
+        cls.graph = TransitionGraph.from_model(ngrams)
+        cls.hops = shortest_path(cls.graph.to_csgraph(np.ones(cls.graph.num_edges)), unweighted=True)
+        cls.sources, cls.targets = np.divmod(np.arange(cls.CELLS ** 2), cls.CELLS)
+
+    def test_closure_is_exact(self):
+        index = ReachabilityIndex.build(self.graph)
+        self.assertIsNotNone(index.closure)
+        self.assertLess(index.num_components, self.CELLS)
+        expected = np.isfinite(self.hops[self.sources, self.targets])
+        self.assertEqual(index.reachable_many(self.sources, self.targets).tolist(), expected.tolist())
+        for source, target in [(0, 4), (4, 0), (self.CELLS - 1, 0)]:
+            self.assertEqual(index.reachable(source, target), bool(np.isfinite(self.hops[source, target])))
+
+    def test_landmarks_never_deny_a_path(self):
+        with mock.patch('trajectory.graph.MAX_CLOSURE_COMPONENTS', 0):
+            index = ReachabilityIndex.build(self.graph, num_landmarks=4)
+        self.assertIsNone(index.closure)
+
+        answers = index.reachable_many(self.sources, self.targets)
+        reachable = np.isfinite(self.hops[self.sources, self.targets])
+        # False is exact, True may be wrong
+        self.assertFalse((reachable & ~answers).any())
+        self.assertTrue((~reachable & ~answers).any())
+        for source, target in zip(self.sources[::97].tolist(), self.targets[::97].tolist()):
+            self.assertEqual(index.reachable(source, target), answers[source * self.CELLS + target])
+
+    def test_hop_bounds_are_lower_bounds(self):
+        index = ReachabilityIndex.build(self.graph, num_landmarks=4)
+        bounds = index.hop_bounds(self.sources, self.targets)
+        hops = self.hops[self.sources, self.targets]
+        reachable = np.isfinite(hops)
+        self.assertTrue((bounds[reachable] <= hops[reachable]).all())
+        self.assertGreater(bounds.max(), 0)
+        self.assertEqual(index.hop_bounds(self.sources[:5], self.targets[:5]).shape, (5,))
+
+
+class MapMatchingTests(SimpleTestCase):
+    """Guard that matches follow the direction of roads and split where no route connects."""
+
+    LON, LAT = -8.62, 41.14
+    # Intersections of a 6x6 street grid; the third street from the south is one-way eastbound
+    LONS = (LON + 0.0025 * np.arange(6)).tolist()
+    LATS = (LAT + 0.002 * np.arange(6)).tolist()
+    ONE_WAY = 2
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        features = []
+        for j, lat in enumerate(cls.LATS):
+            properties = {'highway': 'residential', **({'oneway': 'yes'} if j == cls.ONE_WAY else {})}
+            features.append((properties, [[lon, lat] for lon in cls.LONS]))
+        for lon in cls.LONS:
+            features.append(({'highway': 'residential'}, [[lon, lat] for lat in cls.LATS]))
+        # A road far east of the grid that no route reaches
+        features.append(({'highway': 'residential'}, [[cls.LON + 0.05, cls.LAT], [cls.LON + 0.06, cls.LAT]]))
+
+        handle, path = tempfile.mkstemp(suffix='.geojson')
+        with os.fdopen(handle, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'properties': properties, 'geometry': {'type': 'LineString', 'coordinates': line}}
+                for properties, line in features]}, f)
+        try:
+            cls.network = RoadNetwork.load(path)
+        finally:
+            os.remove(path)
+        cls.matcher = MapMatcher(cls.network, radius=100, sigma=10, beta=50, k=8)
+
+    def drive(self, lat, count=20):
+        """Points a few meters off a street, heading east every 40 meters."""
+        return [[self.LON + 0.0003 + 0.0005 * i, lat + 0.00003] for i in range(count)]
+
+    def match(self, points):
+        features = self.matcher.match_batch([(1, points)])
+        self.assertEqual(len(features), 1)
+        return features[0]
+
+    def test_one_way_roads_have_one_direction(self):
+        # Five pieces per street, both ways except on the one-way street, and the far road
+        self.assertEqual(self.network.num_edges, 2 * 5 * 12 - 5 + 2)
+        lonlat = self.network.lonlat
+        on_one_way = np.isclose(lonlat[self.network.edge_from, 1], self.LATS[self.ONE_WAY]) & \
+            np.isclose(lonlat[self.network.edge_to, 1], self.LATS[self.ONE_WAY])
+        heading = lonlat[self.network.edge_to, 0] - lonlat[self.network.edge_from, 0]
+        self.assertTrue((heading[on_one_way] > 0).all())
+
+    def test_driving_with_the_traffic(self):
+        points = self.drive(self.LATS[self.ONE_WAY])
+        feature = self.match(points)
+        properties = feature['properties']
+        self.assertEqual(properties['trip_id'], 1)
+        self.assertGreater(properties['confidence'], 0.9)
+        self.assertAlmostEqual(properties['distance'], 800, delta=20)
+        lats = [lat for _, lat in feature['geometry']['coordinates']]
+        np.testing.assert_allclose(lats, self.LATS[self.ONE_WAY], atol=1e-5)
+
+    def test_driving_against_a_one_way(self):
+        forward = self.match(self.drive(self.LATS[self.ONE_WAY]))['properties']
+        backward = self.match(self.drive(self.LATS[self.ONE_WAY])[::-1])['properties']
+        self.assertLess(backward['confidence'], 0.5)
+        self.assertLess(backward['distance'], forward['distance'])
+
+    def test_unconnected_points_split_the_match(self):
+        far = [[self.LON + 0.052 + 0.001 * i, self.LAT + 0.00002] for i in range(6)]
+        feature = self.match(self.drive(self.LATS[3], 8) + far)
+        properties = feature['properties']
+        # The break counts as one transition of probability zero, not as distance driven
+        self.assertLess(properties['confidence'], 1)
+        self.assertGreater(properties['confidence'], 0.8)
+        self.assertLess(properties['distance'], 1000)
+        lons = [lon for lon, _ in feature['geometry']['coordinates']]
+        self.assertLess(min(lons), self.LONS[-1])
+        self.assertGreater(max(lons), self.LON + 0.05)
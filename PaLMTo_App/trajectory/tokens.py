@@ -0,0 +1,341 @@
+"""
+    Dense integer cell tokens, flat sentence arrays and array-backed n-gram counts
+"""
+from io import StringIO
+from itertools import chain
+from contextlib import redirect_stdout
+
+import numpy as np
+
+# Version of the cache layout written by the n-gram builder. Version 1 caches hold the
+# Palmto_gen objects (tuple-keyed n-gram dicts, grid and sentence GeoDataFrames).
+CACHE_FORMAT_VERSION = 2
+
+# N-gram keys pack up to three tokens into one int64, 21 bits each
+MAX_CELLS = 2 ** 21
+
+
+def check_grid_size(num_cells):
+    """Refuse grids whose cell IDs don't fit into packed n-gram keys.
+
+    Raises:
+        ValueError: if the grid has MAX_CELLS cells or more
+    """
+    if num_cells >= MAX_CELLS:
+        raise ValueError(f"Grid of {num_cells} cells is too fine; use a larger cell size.")
+
+
+class TokenTable:
+    """Map dense int32 cell IDs to the (col, row) IDs of Palmto_gen and to cell centroids.
+
+    Cell IDs are column-major like the grid of Palmto_gen: id = col * n_rows + row.
+    """
+
+    def __init__(self, n_rows, centroids):
+        self.n_rows = int(n_rows)
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float64)
+
+    @property
+    def num_cells(self):
+        return len(self.centroids)
+
+    @classmethod
+    def from_grid_center(cls, grid_center):
+        """Build a table from the centroid GeoDataFrame returned by Palmto_gen.
+
+        Args:
+            grid_center(gpd.GeoDataFrame): cell centroids with "geometry" and "ID" columns
+        """
+        cols, rows = (np.array(values, dtype=np.int64) for values in zip(*grid_center['ID']))
+        n_rows = int(rows.max()) + 1
+        centroids = np.empty((len(grid_center), 2), dtype=np.float64)
+        centroids[cols * n_rows + rows] = np.column_stack([grid_center.geometry.x, grid_center.geometry.y])
+        return cls(n_rows, centroids)
+
+    def encode(self, ids):
+        """Convert (col, row) IDs to dense cell IDs."""
+        if not len(ids):
+            return np.empty(0, dtype=np.int32)
+        cols, rows = np.array(ids, dtype=np.int64).T
+        return (cols * self.n_rows + rows).astype(np.int32)
+
+    def decode(self, token):
+        """Convert a dense cell ID to the (col, row) ID of Palmto_gen."""
+        return divmod(int(token), self.n_rows)
+
+
+class GridIndex:
+    """Vectorized lookup of the Palmto_gen grid cell containing each point.
+
+    The grid itself comes from ConvertToToken, so cell IDs and centroids are identical
+    to those of an in-memory build. Points are placed by arithmetic on the regular cell
+    spacing instead of a spatial join; a point lying exactly on a shared cell edge goes
+    to the cell above or to the right rather than being dropped.
+    """
+
+    def __init__(self, study_area, cell_size):
+        import pandas as pd
+        from Palmto_gen import ConvertToToken
+
+        from .sizing import grid_shape
+
+        # Refuse a too fine grid before spending time and memory on its cells
+        _, _, n_cols, n_rows = grid_shape(study_area.total_bounds, cell_size)
+        check_grid_size(n_cols * n_rows)
+
+        creator = ConvertToToken(pd.DataFrame({'geometry': pd.Series([], dtype=object)}), study_area, cell_size)
+        with redirect_stdout(StringIO()):
+            grid, n_rows, num_cells = creator.create_grid()
+        check_grid_size(num_cells)
+        grid = creator.assign_ids(grid, n_rows)
+
+        self.cells = grid.geometry
+        self.tokens = TokenTable.from_grid_center(creator.find_grid_center(grid))
+        self.num_cells = num_cells
+        self.n_rows = n_rows
+        self.n_cols = num_cells // n_rows
+
+        x0, y0, x1, y1 = grid.geometry[0].bounds
+        self.x0, self.y0 = x0, y0
+        self.cell_w, self.cell_h = x1 - x0, y1 - y0
+
+    def lookup(self, coords):
+        """Return dense cell IDs of points, or -1 for points outside the grid."""
+        cols = np.floor((coords[:, 0] - self.x0) / self.cell_w).astype(np.int64)
+        rows = np.floor((coords[:, 1] - self.y0) / self.cell_h).astype(np.int64)
+        inside = (cols >= 0) & (cols < self.n_cols) & (rows >= 0) & (rows < self.n_rows)
+        return np.where(inside, cols * self.n_rows + rows, -1)
+
+
+class Sentences:
+    """Trajectories as one flat int32 token array with offsets and per-point coordinates.
+
+    Sentence i spans tokens[offsets[i]:offsets[i + 1]]. Coordinates, when present, are
+    aligned with tokens; for original trajectories they are the recorded GPS points,
+    for generated ones the centroids of their cells.
+    """
+
+    def __init__(self, tokens, offsets, coords=None, trip_ids=None):
+        self.tokens = np.ascontiguousarray(tokens, dtype=np.int32)
+        self.offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self.coords = None if coords is None else np.ascontiguousarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.trip_ids = np.arange(1, len(self) + 1) if trip_ids is None else np.asarray(trip_ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def trip_index(self):
+        """Index of the sentence each token belongs to."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    @classmethod
+    def from_token_lists(cls, sentences, table=None):
+        """Build sentences from lists of dense cell IDs, placing points at cell centroids.
+
+        Args:
+            sentences(list): token sequences, e.g. returned by a sampler
+            table(TokenTable): source of coordinates, None to store tokens only
+        """
+        lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        tokens = np.fromiter(chain.from_iterable(sentences), dtype=np.int32, count=int(offsets[-1]))
+        coords = None if table is None else table.centroids[tokens]
+        return cls(tokens, offsets, coords)
+
+    @classmethod
+    def from_grouped(cls, grouped_df, table):
+        """Convert the per-trip DataFrame of ConvertToToken.create_tokens.
+
+        Args:
+            grouped_df(pd.DataFrame): trips indexed by trip_id with "geometry" lists of
+                Shapely points and "ID" lists of (col, row) tuples
+            table(TokenTable): table the IDs are encoded with
+        """
+        lengths = grouped_df['ID'].apply(len).to_numpy(dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        tokens = table.encode(list(chain.from_iterable(grouped_df['ID'])))
+        coords = np.array([(point.x, point.y) for point in chain.from_iterable(grouped_df['geometry'])],
+                          dtype=np.float64).reshape(-1, 2)
+        return cls(tokens, offsets, coords, grouped_df.index.to_numpy())
+
+    @classmethod
+    def concat(cls, parts):
+        """Join a non-empty list of sentences end to end."""
+        starts = np.cumsum([0] + [len(part.tokens) for part in parts])
+        offsets = np.concatenate([[0]] + [part.offsets[1:] + start for part, start in zip(parts, starts)])
+        coords = None
+        if all(part.coords is not None for part in parts):
+            coords = np.concatenate([part.coords for part in parts])
+        return cls(np.concatenate([part.tokens for part in parts]), offsets, coords,
+                   np.concatenate([part.trip_ids for part in parts]))
+
+    def take(self, indices):
+        """Return the sentences at the given positions, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        positions = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        coords = None if self.coords is None else self.coords[positions]
+        return Sentences(self.tokens[positions], offsets, coords, self.trip_ids[indices])
+
+    def sample(self, n, seed=None):
+        """Draw up to n sentences without replacement."""
+        rng = np.random.default_rng(seed)
+        return self.take(rng.choice(len(self), size=min(int(n), len(self)), replace=False))
+
+    def coords_of(self, i):
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def to_frame(self):
+        """Return a DataFrame with "trip_id" and "geometry" lists of [lon, lat] pairs."""
+        import pandas as pd
+
+        geometry = [part.tolist() for part in np.split(self.coords, self.offsets[1:-1])] if len(self) else []
+        return pd.DataFrame({'trip_id': self.trip_ids, 'geometry': geometry})
+
+
+def pack(columns, num_cells):
+    """Pack token columns of n-grams into one int64 key per n-gram."""
+    key = np.asarray(columns[0], dtype=np.int64)
+    for column in columns[1:]:
+        key = key * num_cells + np.asarray(column, dtype=np.int64)
+    return key
+
+
+def unpack(keys, n, num_cells):
+    """Split packed n-gram keys back into n token columns."""
+    columns = []
+    for _ in range(n):
+        keys, token = np.divmod(keys, num_cells)
+        columns.append(token)
+    return columns[::-1]
+
+
+def merge_counts(keys, counts, more_keys, more_counts):
+    """Add two sets of keyed counts.
+
+    Returns:
+        tuple: sorted unique keys and their summed counts
+    """
+    all_keys = np.concatenate([keys, more_keys])
+    if not len(all_keys):
+        return all_keys.astype(np.int64), np.empty(0, dtype=np.int64)
+    unique, inverse = np.unique(all_keys, return_inverse=True)
+    summed = np.bincount(inverse, weights=np.concatenate([counts, more_counts]), minlength=len(unique))
+    return unique, summed.astype(np.int64)
+
+
+def _count(keys):
+    if not len(keys):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    unique, counts = np.unique(keys, return_counts=True)
+    return unique, counts.astype(np.int64)
+
+
+class NgramModel:
+    """Bigram and trigram counts of a corpus with the start and end bigrams of its trips.
+
+    N-grams are stored as sorted packed int64 keys with aligned counts; start_end holds
+    one (first, second, second-to-last, last) row of tokens per eligible trip. The
+    counts are those of Palmto_gen's NgramGenerator for the original sentences;
+    reversed n-grams are the same keys with their tokens in reverse order.
+    """
+
+    def __init__(self, num_cells, bigram_keys, bigram_counts, trigram_keys, trigram_counts, start_end):
+        self.num_cells = int(num_cells)
+        self.bigram_keys = bigram_keys
+        self.bigram_counts = bigram_counts
+        self.trigram_keys = trigram_keys
+        self.trigram_counts = trigram_counts
+        self.start_end = np.asarray(start_end, dtype=np.int32).reshape(-1, 4)
+
+    @classmethod
+    def empty(cls, num_cells):
+        none = np.empty(0, dtype=np.int64)
+        return cls(num_cells, none, none, none, none, np.empty((0, 4), dtype=np.int32))
+
+    @property
+    def num_bigrams(self):
+        return len(self.bigram_keys)
+
+    @property
+    def num_trigrams(self):
+        return len(self.trigram_keys)
+
+    @classmethod
+    def from_sentences(cls, sentences, num_cells):
+        """Count n-grams within each sentence and collect start/end bigrams.
+
+        Start and end bigrams are taken after collapsing consecutive repeats, from
+        trips that still have more than three tokens, as Palmto_gen does.
+        """
+        tokens, trips = sentences.tokens, sentences.trip_index
+
+        same_1 = trips[:-1] == trips[1:]
+        bigram_keys, bigram_counts = _count(pack([tokens[:-1][same_1], tokens[1:][same_1]], num_cells))
+        same_2 = trips[:-2] == trips[2:]
+        trigram_keys, trigram_counts = _count(
+            pack([tokens[:-2][same_2], tokens[1:-1][same_2], tokens[2:][same_2]], num_cells))
+
+        keep = np.ones(len(tokens), dtype=bool)
+        keep[1:] = (tokens[1:] != tokens[:-1]) | (trips[1:] != trips[:-1])
+        dedup = tokens[keep]
+        counts = np.bincount(trips[keep], minlength=len(sentences))
+        ends = np.cumsum(counts)
+        eligible = counts > 3
+        starts, ends = (ends - counts)[eligible], ends[eligible]
+        start_end = np.column_stack([dedup[starts], dedup[starts + 1], dedup[ends - 2], dedup[ends - 1]])
+
+        return cls(num_cells, bigram_keys, bigram_counts, trigram_keys, trigram_counts, start_end)
+
+    @classmethod
+    def from_palmto(cls, ngrams, start_end_points, table):
+        """Convert the tuple-keyed n-gram dicts and start/end list of Palmto_gen."""
+        def encode(ngram_dict, n):
+            if not ngram_dict:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+            tokens = table.encode([token for key in ngram_dict for token in key]).reshape(-1, n)
+            keys = pack(tokens.T, table.num_cells)
+            order = np.argsort(keys)
+            return keys[order], np.fromiter(ngram_dict.values(), dtype=np.int64)[order]
+
+        bigram_keys, bigram_counts = encode(ngrams['bigrams_original'], 2)
+        trigram_keys, trigram_counts = encode(ngrams['trigrams_original'], 3)
+        start_end = table.encode([token for (first, last) in start_end_points for token in (*first, *last)])
+        return cls(table.num_cells, bigram_keys, bigram_counts, trigram_keys, trigram_counts, start_end)
+
+    def merge(self, other):
+        """Add counts and start/end bigrams of another corpus over the same grid."""
+        self.bigram_keys, self.bigram_counts = merge_counts(
+            self.bigram_keys, self.bigram_counts, other.bigram_keys, other.bigram_counts)
+        self.trigram_keys, self.trigram_counts = merge_counts(
+            self.trigram_keys, self.trigram_counts, other.trigram_keys, other.trigram_counts)
+        self.start_end = np.concatenate([self.start_end, other.start_end])
+        return self
+
+    def trigrams(self):
+        """Return original trigrams as three token columns."""
+        return unpack(self.trigram_keys, 3, self.num_cells)
+
+
+def upgrade_cache(cached_data):
+    """Convert a version 1 cache in place to the array-backed layout.
+
+    Returns:
+        dict: the same cache with "tokens", "ngrams" and "sentences" as TokenTable,
+            NgramModel and Sentences
+    """
+    if cached_data.get('format_version', 1) >= CACHE_FORMAT_VERSION:
+        return cached_data
+
+    table = TokenTable.from_grid_center(cached_data.pop('grid'))
+    cached_data['tokens'] = table
+    cached_data['ngrams'] = NgramModel.from_palmto(cached_data['ngrams'], cached_data.pop('start_end_points'), table)
+    cached_data['sentences'] = Sentences.from_grouped(cached_data.pop('sentence_df'), table)
+    cached_data['format_version'] = CACHE_FORMAT_VERSION
+    return cached_data
@@ -1,16 +1,25 @@
 from django.urls import path
 from .views import GenerationConfigView, download_files, Trajectory3DView, CacheStatsView
-from .views import MapMatchingView, NgramGenerationView, ProgressView, rename_cache
+from .views import MapMatchingView, NgramGenerationView, ProgressView, rename_cache, BatchGenerationView
+from .views import TrajectorySearchView, TrajectoryDatasetsView, ImputationView, CancelJobView, JobView
+from .views import CellSizeView
 
 
 urlpatterns = [
     path('generate/', GenerationConfigView.as_view(), name='generate'),
     path('generate/ngrams', NgramGenerationView.as_view(), name='generate_ngrams'),
+    path('generate/ngrams/cell-size', CellSizeView.as_view(), name='recommend_cell_size'),
+    path('generate/batch', BatchGenerationView.as_view(), name='generate_batch'),
+    path('impute/', ImputationView.as_view(), name='impute'),
     path('download/<str:filename>', download_files, name='download_files'),
     path('3d-view/', Trajectory3DView.as_view(), name="3d-view"),
     path('map-match/', MapMatchingView.as_view(), name="map_match"),
     path('progress/', ProgressView.as_view(), name='progress'),
+    path('cancel/', CancelJobView.as_view(), name='cancel'),
+    path('jobs/<str:task_id>', JobView.as_view(), name='job'),
     path('rename-cache/', rename_cache, name='rename_cache'),
-    path('get-stats-from-cache/', CacheStatsView.as_view(), name='get-stats-from-cache')
+    path('get-stats-from-cache/', CacheStatsView.as_view(), name='get-stats-from-cache'),
+    path('trajectories/search', TrajectorySearchView.as_view(), name='trajectory_search'),
+    path('trajectories/datasets', TrajectoryDatasetsView.as_view(), name='trajectory_datasets')
 ]
 
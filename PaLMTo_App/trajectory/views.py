@@ -2,45 +2,79 @@
 from rest_framework import status, serializers
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
 
 # Django libraries
 from django.views import View
 from django.conf import settings
 
 from django.core.files import File
-from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.core.files.uploadedfile import InMemoryUploadedFile
 
 # System libraries
 import os
+import time
 import uuid
 import shutil
-from io import StringIO
-from contextlib import redirect_stdout
 
 # Third-party libraries
 import ast
-import time
 import pickle
 import json
 import threading
-import requests
-import pandas as pd
-from queue import Queue, Empty
+from queue import Empty
 from datetime import datetime, timedelta
-from Palmto_gen import ConvertToToken, NgramGenerator, TrajGenerator
 
 # Local imports
-from .models import GeneratedTrajectory
+from .models import GeneratedTrajectory, GenerationConfig
 from .serializers import GenerationConfigSerializer
+from .metrics import StageRecorder, StageTimer, render_metrics
+from .admission import ADMISSION, AdmissionRejected, admitted, estimate_generation_job, estimate_ngram_job
+from .admission import estimate_batch_generation_job, estimate_imputation_job, estimate_map_matching_job
+from .cancellation import CANCELLATION, JobCancelled, cancellable, checkpoint, job_timeout, on_cancel, remove_file
+from .generation import generation_workers, run_batch, sentences_to_trajs
+from .generation import POINT_TO_POINT_METHODS, derive_seed, generate_sentences, new_seed
+from .graph import ReachabilityIndex, TransitionGraph
+from .fidelity import fidelity_report
+from .ingest import build_ngrams_chunked, chunk_rows, tokenize_frame, use_chunked_ingest
+from .sizing import dry_run
+from .tokens import CACHE_FORMAT_VERSION, GridIndex, NgramModel, Sentences
+from .registry import REGISTRY
+from .jobs import PROGRESS_QUEUES, create_job, finished_event, job_status, progress_queue
+from .imputation import IMPUTATION_MODES, Imputer, batch_rows, run_imputation
+from .map_matching import MapMatcher, iter_matches, load_network, network_dir, network_format
+from .map_matching import batch_rows as matching_batch_rows
+from .formats import CONTENT_TYPES, check_format, format_of, output_filename, read_errors, read_trajectories
+from .formats import TrajectoryWriter, write_trajectories
+from .downloads import FILE_INDEX, is_safe_name, register_download, serve_file
+from .spatial_store import index_dataset, index_saved_file, is_indexed, list_datasets, parse_time, search
+from .storage import discard_output, touch
 from .geo_process import extract_boundary, traj_to_geojson, extract_area_center, heatmap_geojson, convert_time
 
 # Holds statistics related to trajectory generation
 STATS = {}
 
-# A global queue for holding progress messages
-PROGRESS_QUEUES = {}
+
+def publish_cancelled(task_id, error):
+    """Tell the client of a job that it stopped at a checkpoint and its output was removed.
+
+    Args:
+        task_id(str): identifier of the job
+        error(cancellation.JobCancelled): exception raised at the checkpoint
+    """
+    progress_queue(task_id).put({
+        'type': 'cancelled',
+        'reason': error.reason,
+        'message': f'{str(error)}; partial output was removed'
+    })
+
+
+def discard_record(config):
+    """Delete a GenerationConfig with its copy of the source file and its trajectory records."""
+    if config.file:
+        config.file.delete(save=False)
+    config.delete()
 
 class GenerationConfigView(APIView):
     """
@@ -76,12 +110,27 @@ class GenerationConfigView(APIView):
         else:
             data['delete_after'] = False
 
+        # Refuse jobs that can't fit into the memory budget before spawning a thread
+        try:
+            self._extract_seed(data.get('seed'))
+            check_format(data.get('output_format'))
+            estimate = self._estimate_memory(data)
+            ADMISSION.check(estimate)
+        except (AdmissionRejected, TypeError, ValueError) as e:
+            # Only drop caches uploaded with this request, never the user's saved ones
+            if data['delete_after']:
+                os.remove(os.path.join(settings.MEDIA_ROOT, "cache", data['cache_file']))
+            if isinstance(e, AdmissionRejected):
+                return Response({"error": str(e)}, status=e.status_code)
+            return Response({"error": f"Invalid generation parameters: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
         task_id = str(uuid.uuid4())
+        create_job(task_id, 'generation')
 
         # Start a background thread 
         thread = threading.Thread(
             target=self._process_with_progress,
-            args = (data, task_id)
+            args = (data, task_id, estimate)
         )
 
         # Allow main thread to exit
@@ -93,130 +142,147 @@ class GenerationConfigView(APIView):
             "message":"Trajectory generation started"
         }, status=status.HTTP_202_ACCEPTED)
     
-    def _process_with_progress(self, data, task_id):
+    def _estimate_memory(self, data):
+        """Estimate peak memory of a generation job from its cache file and parameters.
+
+        Returns:
+            admission.JobEstimate: calibrated estimate used for admission control
+        """
+        _, num_trajs, traj_len = self._extract_extra_config(data)
+        cache_path = os.path.join(settings.MEDIA_ROOT, "cache", str(data.get('cache_file')))
+        return estimate_generation_job(cache_path, num_trajs, traj_len)
+
+    def _process_with_progress(self, data, task_id, estimate):
         """
 
         Args:
             data(QueryDict): request data containing additional parameters and cache 
             task_id(str): a unique identifier for frontend to track backend updates 
+            estimate(admission.JobEstimate): predicted peak memory reserved while the job runs
         """
         try:
-            if task_id not in PROGRESS_QUEUES:
-                PROGRESS_QUEUES[task_id] = Queue()
-            
-            queue = PROGRESS_QUEUES[task_id]
-
-            queue.put({
-                'type': 'progress',
-                'message': 'Starting trajectory generation process',
-                'progress': 10
+            queue = progress_queue(task_id)
+            with cancellable(task_id, job_timeout('generate')) as token:
+                # A cache uploaded with the request is of no use once its job is cancelled
+                if data['delete_after']:
+                    token.on_cancel(remove_file, os.path.join(settings.MEDIA_ROOT, "cache", data['cache_file']))
+                with admitted(estimate, task_id, queue):
+                    self._run_generation(data, queue)
+        except JobCancelled as e:
+            publish_cancelled(task_id, e)
+        except Exception as e:
+            progress_queue(task_id).put({
+                'type': 'error',
+                'message': f'Error during trajectory generation: {str(e)}'
             })
-            time.sleep(1)
 
-            # Step 1: Extract cached data once and reuse it
-            queue.put({
-                'type': 'progress',
-                'message': 'Loading cached data',
-                'progress': 15
-            })
-            cached_data = self._process_cache(data)
+    def _run_generation(self, data, queue):
+        """Run every stage of a trajectory generation job and publish its result.
 
-            # Step 2: save parameters of trajectory generation to database
-            queue.put({
-                'type': 'progress',
-                'message': 'Saving configuration to database',
-                'progress': 20
-            })
-            uploaded = self.save_to_record(data, cached_data)
+        Args:
+            data(QueryDict): request data containing additional parameters and cache 
+            queue(Queue): queue for storing progress updates
+        """
+        recorder = StageRecorder(queue)
 
-            # Step 3: process trajectory generation
-            queue.put({
-                'type': 'progress',
-                'message': 'Loading cached n-gram data',
-                'progress': 40
-            })
-            time.sleep(1)
-            sentence_df, study_area, new_trajs, new_trajs_gdf = self. _process_traj_generation(data, queue, cached_data)
+        queue.put({
+            'type': 'progress',
+            'message': 'Starting trajectory generation process',
+            'progress': 10
+        })
 
-            queue.put({
-                'type': 'progress',
-                'message': 'Trajectories generated successfully',
-                'progress': 60
-            })
-            time.sleep(1)
+        # Step 1: Extract cached data once and reuse it
+        with recorder.stage('load_cache', 'Loading cached data', 15) as stage:
+            cached_data = self._process_cache(data)
+            stage.rows = len(cached_data['sentences'])
 
-            # Step 4: save generated trajectories to local disk
-            queue.put({
-                'type': 'progress',
-                'message': 'Saving generated trajectories',
-                'progress': 70
-            })
-            generated_file = self.save_trajectory(new_trajs, uploaded)
+        # Fix the seed up front so it is stored with the configuration and reported back
+        data['seed'] = self._extract_seed(data.get('seed'))
 
-            # Step 5: generate visualization data
-            queue.put({
-                'type': 'progress',
-                'message': 'Preparing visualization data',
-                'progress': 85
-            })
-            visual_data = self.generate_trajectory_visual(sentence_df, new_trajs_gdf, study_area)
-            heatmap_data = self.compare_trajectory_heatmap(sentence_df, new_trajs_gdf,
+        # Step 2: save parameters of trajectory generation to database
+        with recorder.stage('save_record', 'Saving configuration to database', 20):
+            uploaded = self.save_to_record(data, cached_data)
+            on_cancel(discard_record, uploaded)
+
+        # Step 3: process trajectory generation
+        with recorder.stage('generate', 'Generating trajectories', 40) as stage:
+            sentences, study_area, new_trajs, abandoned = self._process_traj_generation(data, queue, cached_data)
+            stage.rows = len(new_trajs)
+            stage.points = len(new_trajs.tokens)
+
+        # Step 4: save generated trajectories to local disk
+        with recorder.stage('save_file', 'Saving generated trajectories', 70) as stage:
+            generated_file = self.save_trajectory(new_trajs.to_frame(), uploaded,
+                                                  output_format=data.get('output_format'))
+            stage.rows = len(new_trajs)
+
+        # Step 5: generate visualization data
+        with recorder.stage('visualize', 'Preparing visualization data', 80):
+            visual_data = self.generate_trajectory_visual(sentences, new_trajs, study_area)
+
+        with recorder.stage('heatmap', 'Preparing heatmap data', 90):
+            heatmap_data = self.compare_trajectory_heatmap(sentences, new_trajs,
                                                     study_area, int(data["num_trajectories"]))
 
-            # Step 5: cleanup
-            queue.put({
-                'type': 'progress',
-                'message': 'Cleaning up temporary files',
-                'progress': 95
-            })
-            self.delete_cache_file(data)
+        with recorder.stage('fidelity', 'Scoring fidelity of generated trajectories', 93) as stage:
+            fidelity = fidelity_report(sentences, new_trajs, cached_data['ngrams'])
+            stage.rows = len(new_trajs)
 
-            queue.put({
-                'type': 'complete',
-                'message': 'Trajectory generation completed successfully!',
-                'progress': 100,
-                'result': {
-                    'id': uploaded.id,
-                    'visualization': visual_data,
-                    'heatmap': heatmap_data,
-                    'generated_file': generated_file,
-                }
-            })
-        except Exception as e:
-            if task_id in PROGRESS_QUEUES:
-                PROGRESS_QUEUES[task_id].put({
-                    'type': 'error',
-                    'message': f'Error during trajectory generation: {str(e)}'
-                })
+        # Step 6: cleanup
+        queue.put({
+            'type': 'progress',
+            'message': 'Cleaning up temporary files',
+            'progress': 95
+        })
+        self.delete_cache_file(data)
+
+        queue.put({
+            'type': 'complete',
+            'message': 'Trajectory generation completed successfully!',
+            'progress': 100,
+            'result': {
+                'id': uploaded.id,
+                'visualization': visual_data,
+                'heatmap': heatmap_data,
+                'generated_file': generated_file,
+                'seed': data['seed'],
+                'generated': len(new_trajs),
+                'abandoned': abandoned,
+                'fidelity': fidelity,
+            },
+            'metrics': recorder.summary()
+        })
     
-    def _process_cache(self, data):
-        """Read cache file and extract pickled Python objects.
+    def _load_model(self, data):
+        """Return the loaded model of the cache file named in a request.
 
         Args:
             data(QueryDict): an object sent from frontend request
 
         Returns:
-            cached_data(dict): unpickled data
-        
+            generation.LoadedModel: model shared through the registry with other requests
         """
         cache_file = data.get('cache_file')
         cache_file_content = data.get('cache_file_content')
 
         if not cache_file and not cache_file_content:
             raise ValueError("No ngram file provided.")
-        
-        if isinstance(cache_file, str):
-            # Open from disk if it's a filename    
-            full_path = os.path.join(settings.MEDIA_ROOT, "cache", cache_file)
-            if not os.path.exists(full_path):
-                raise FileNotFoundError(f"Ngram file {cache_file} not found.")
-            # Read cache file
-            with open(full_path, 'rb') as f:
-                cached_data = pickle.load(f)
-        else:
+
+        if not isinstance(cache_file, str):
             raise ValueError("Invalid cache file type.")
+        return REGISTRY.get(cache_file)
+
+    def _process_cache(self, data):
+        """Read cache file and extract pickled Python objects.
+
+        Args:
+            data(QueryDict): an object sent from frontend request
+
+        Returns:
+            cached_data(dict): unpickled data, converted to the current cache layout
         
-        return cached_data
+        """
+        return self._load_model(data).cached_data
 
     def _extract_extra_config(self, data):
         """Retrieve user-supplied configurations in step three of form
@@ -227,11 +293,22 @@ class GenerationConfigView(APIView):
         if data.get("generation_method") == "length_constrained":
             gen_method = "length_constrained"
             traj_len = int(data.get("trajectory_len"))
+        elif data.get("generation_method") in POINT_TO_POINT_METHODS:
+            gen_method = data.get("generation_method")
         else:
             gen_method = "point_to_point"
         
         return gen_method, num_trajs, traj_len
 
+    def _extract_seed(self, seed):
+        """Validate a user-supplied random seed, drawing a fresh one if none was given."""
+        if seed in (None, ''):
+            return new_seed()
+        seed = int(seed)
+        if not 0 <= seed < 2 ** 63:
+            raise ValueError("seed must be a non-negative 63-bit integer")
+        return seed
+
     def save_to_record(self, data, cached_data):
         """Save configurations for trajectory generation to local sql database.
         
@@ -251,6 +328,7 @@ class GenerationConfigView(APIView):
 
             try:
                 f = open(file_path, 'rb')
+                touch(file_path)
                 recreated_file = File(f, name=file_name)
                 model_data['file'] = recreated_file
             except Exception as e:
@@ -266,6 +344,9 @@ class GenerationConfigView(APIView):
 
         if gen_method == "length_constrained":
             model_data['trajectory_len'] = traj_len
+
+        if data.get('seed') is not None:
+            model_data['seed'] = int(data.get('seed'))
         
         serializer = GenerationConfigSerializer(data=model_data)
         if serializer.is_valid():
@@ -290,10 +371,10 @@ class GenerationConfigView(APIView):
         
         Returns:
             tuple:
-                - sentence_df (pandas.DataFrame): DataFrame of original trajectories as sentences.
+                - sentences (tokens.Sentences): original trajectories as sentences.
                 - study_area (geopandas.GeoDataFrame): GeoDataFrame defining the study area's boundary.
-                - new_trajs (pandas.DataFrame): an object of generated trajectories.
-                - new_trajs_gdf (geopandas.GeoDataFrame): GeoDataFrame of generated trajectories for visualization.
+                - new_trajs (tokens.Sentences): generated trajectories.
+                - abandoned (int): sampling attempts given up on the way.
         """
         gen_method, num_trajs, traj_len = self._extract_extra_config(data)
         queue.put({
@@ -302,10 +383,9 @@ class GenerationConfigView(APIView):
             'progress': 45
         })
 
-        ngrams = cached_data['ngrams']
-        start_end_points = cached_data['start_end_points']
-        grid = cached_data['grid']
-        sentence_df = cached_data['sentence_df']
+        model = self._load_model(data)
+        table = cached_data['tokens']
+        sentences = cached_data['sentences']
         study_area = cached_data['study_area']
 
         queue.put({
@@ -314,35 +394,45 @@ class GenerationConfigView(APIView):
             'progress': 50
         })
 
+        def report(done):
+            queue.put({
+                'type': 'progress',
+                'message': f'Generated {done} of {num_trajs} trajectories',
+                'progress': 50 + int(15 * done / num_trajs)
+            })
 
-        if gen_method == "length_constrained":
-            traj_generator = TrajGenerator(ngrams, start_end_points, num_trajs, grid)
-            new_trajs, new_trajs_gdf = traj_generator.generate_trajs_using_origin(traj_len, seed=None)
-        else:
-            traj_generator = TrajGenerator(ngrams, start_end_points, num_trajs, grid)
-            new_trajs, new_trajs_gdf = traj_generator.generate_trajs_using_origin_destination()
-        return sentence_df, study_area, new_trajs, new_trajs_gdf
+        # Chunks of trajectories are sampled from independent RNG streams of one seed
+        generated, _, abandoned = generate_sentences(model, gen_method, num_trajs, traj_len,
+                                                     seed=data.get('seed'), on_progress=report)
+        if not generated:
+            raise ValueError(f"No trajectories could be generated; {abandoned} sampling attempts "
+                             f"were abandoned within the search budget.")
+        return sentences, study_area, sentences_to_trajs(generated, table), abandoned
  
-    def save_trajectory(self, trajs, config_instance, save_dir="generated"):
+    def save_trajectory(self, trajs, config_instance, save_dir="generated", output_format=None):
         """
             Save generated trajectories to local machine as well as database table.
 
             trajs: trajectory data formatted as a list of coordinate pairs
             config_instance: foreign key of GeneratedTrajecotry table
             save_dir: media sub-folder for saving trajectory files
+            output_format: "csv" (default), "parquet" or "feather"
 
             Return filename of saved trajectory. 
         """
 
         # Form a unique file name for generated trajectories
         file_id = uuid.uuid4()
-        filename = f'generated_trajectories_{file_id}.csv'
+        filename = output_filename(f'generated_trajectories_{file_id}', check_format(output_format))
         subdir = os.path.join(settings.MEDIA_ROOT, save_dir)
         file_path = os.path.join(subdir, filename)
 
         os.makedirs(subdir, exist_ok=True)
         # Save files to server file system
-        trajs.to_csv(file_path, index=False)
+        on_cancel(discard_output, file_path)
+        write_trajectories(trajs, file_path)
+        register_download(file_path)
+        index_saved_file(file_path, 'generated')
 
         # Save files to a database table
         generated_traj = GeneratedTrajectory(config=config_instance, generated_file=file_path)
@@ -350,35 +440,35 @@ class GenerationConfigView(APIView):
 
         return filename
 
-    def generate_trajectory_visual(self, df, new_trajs_gdf, study_area):
+    def generate_trajectory_visual(self, sentences, new_trajs, study_area):
         """
             Prepare trajectory data for frontend visualization
 
-            df: original dataframe formatted as lists of Shapely points
-            new_trajs_gdf: GeoDataFrame generated trajectories as lists of Shapely points
+            sentences: original trajectories as tokens.Sentences
+            new_trajs: generated trajectories as tokens.Sentences
             study_area: a GeoDataFrame defining geographical boundary of an area
 
             Return a dictionary containing GeoJSON data for original and generated trajectories, along with
             the center of study area
         """
         # Convert trajectory data to geojson for frontend visualization
-        original = traj_to_geojson(df)
-        generated = traj_to_geojson(new_trajs_gdf)
+        original = traj_to_geojson(sentences)
+        generated = traj_to_geojson(new_trajs)
         center = extract_area_center(study_area)
 
         return {"original": original, "generated": generated, "center": center}
 
-    def compare_trajectory_heatmap(self, df, new_trajs_gdf, study_area, sample):
+    def compare_trajectory_heatmap(self, sentences, new_trajs, study_area, sample):
         """
             Prepare trajectory data for frontend heatmap 
         
-            sample: a subset of df trajectories for visualization 
+            sample: number of trajectories drawn from each side for visualization 
 
             Return a dictionary containg heatmap data for original and generated trajectories, center of study
             area and its bounds
         """
-        original_heatmap = heatmap_geojson(df.sample(sample), study_area)
-        generated_heatmap = heatmap_geojson(new_trajs_gdf.sample(sample), study_area)
+        original_heatmap = heatmap_geojson(sentences, study_area, max_trajectories=sample)
+        generated_heatmap = heatmap_geojson(new_trajs, study_area, max_trajectories=sample)
 
         bounds = study_area.total_bounds.tolist()
         center = extract_area_center(study_area)
@@ -408,6 +498,353 @@ class GenerationConfigView(APIView):
                 except Exception as e:
                     pass
 
+class BatchGenerationView(GenerationConfigView):
+    """
+        A class for running many generation configurations against one cached n-gram model,
+        loading the model and its sampling state only once.
+    """
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+
+    def post(self, request):
+        """Handler of batch trajectory generation with live progress updates
+
+        Args:
+            request(rest_framework.request.Request): an object containing a cache_file field naming a
+                saved cache, a configs list of objects with "num_trajectories", "generation_method" and
+                optional "trajectory_len" keys, an optional include_visuals flag and an optional
+                output_format of "csv", "parquet" or "feather".
+
+        Returns:
+            response(rest.Response): a dict containing task id and server message
+        """
+        cache_file = request.data.get('cache_file')
+        configs = request.data.get('configs')
+        include_visuals = str(request.data.get('include_visuals', 'false')).lower() == 'true'
+
+        if not isinstance(cache_file, str) or not cache_file:
+            return Response({"error": "No cache file provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            if isinstance(configs, str):
+                configs = json.loads(configs)
+            if not isinstance(configs, list) or not configs:
+                raise ValueError("configs must be a non-empty list")
+            parsed = [self._extract_extra_config(config) for config in configs]
+            if any(num_trajs <= 0 for _, num_trajs, _ in parsed):
+                raise ValueError("num_trajectories must be positive")
+
+            # Configs without their own seed get one derived from the batch seed
+            batch_seed = self._extract_seed(request.data.get('seed'))
+            seeds = [self._extract_seed(config['seed']) if config.get('seed') not in (None, '')
+                     else derive_seed(batch_seed, i) % 2 ** 63 for i, config in enumerate(configs)]
+            output_format = check_format(request.data.get('output_format'))
+        except (TypeError, ValueError, AttributeError) as e:
+            return Response({"error": f"Invalid generation configs: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_path = os.path.join(settings.MEDIA_ROOT, "cache", cache_file)
+        if not os.path.exists(cache_path):
+            return Response({"error": f"Cache file {cache_file} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        workers = min(generation_workers(), len(parsed))
+        try:
+            estimate = estimate_batch_generation_job(cache_path, parsed, workers)
+            ADMISSION.check(estimate)
+        except AdmissionRejected as e:
+            return Response({"error": str(e)}, status=e.status_code)
+
+        task_id = str(uuid.uuid4())
+        create_job(task_id, 'batch_generation')
+        thread = threading.Thread(
+            target=self._process_batch_with_progress,
+            args=({'cache_file': cache_file, 'output_format': output_format}, parsed, seeds, include_visuals, task_id, estimate)
+        )
+        thread.daemon = True
+        thread.start()
+
+        return Response({
+            "task_id": task_id,
+            "message": f"Batch generation of {len(parsed)} configurations started"
+        }, status=status.HTTP_202_ACCEPTED)
+
+    def _process_batch_with_progress(self, data, configs, seeds, include_visuals, task_id, estimate):
+        """Send live progress updates while a batch runs under its memory reservation.
+
+        Args:
+            data(dict): request data containing name of cache file and output format
+            configs(list): tuples of (generation_method, num_trajectories, trajectory_len)
+            seeds(list): random seed of each config
+            include_visuals(bool): whether to build visualization and heatmap of each run
+            task_id(str): a unique identifier for frontend to track backend updates
+            estimate(admission.JobEstimate): predicted peak memory reserved while the job runs
+        """
+        try:
+            queue = progress_queue(task_id)
+            with cancellable(task_id, job_timeout('batch')), admitted(estimate, task_id, queue):
+                self._run_batch(data, configs, seeds, include_visuals, queue)
+        except JobCancelled as e:
+            publish_cancelled(task_id, e)
+        except Exception as e:
+            progress_queue(task_id).put({
+                'type': 'error',
+                'message': f'Error during batch generation: {str(e)}'
+            })
+
+    def _run_batch(self, data, configs, seeds, include_visuals, queue):
+        """Sample every config from one loaded model, save one file per config and publish results.
+
+        Visualizations of the original data are shared by all runs, so they are built once.
+        """
+        recorder = StageRecorder(queue)
+
+        with recorder.stage('load_cache', 'Loading cached data', 5) as stage:
+            model = self._load_model(data)
+            cached_data = model.cached_data
+            stage.rows = len(cached_data['sentences'])
+
+        sentences = cached_data['sentences']
+        study_area = cached_data['study_area']
+        table = cached_data['tokens']
+
+        total = sum(config[1] for config in configs)
+
+        def report(done):
+            queue.put({
+                'type': 'progress',
+                'message': f'Generated {done} of {total} trajectories across {len(configs)} configurations',
+                'progress': 10 + int(60 * done / total)
+            })
+
+        with recorder.stage('generate', f'Generating {len(configs)} configurations', 10) as stage:
+            batch_sentences, batch_abandoned = run_batch(model, configs, seeds, on_progress=report)
+            stage.rows = sum(len(sentences) for sentences in batch_sentences)
+            stage.points = sum(len(sentence) for sentences in batch_sentences for sentence in sentences)
+
+        runs = []
+        with recorder.stage('save_file', 'Saving generated trajectories', 75) as stage:
+            for (gen_method, num_trajs, traj_len), seed, generated, abandoned in zip(
+                    configs, seeds, batch_sentences, batch_abandoned):
+                config = {
+                    'num_trajectories': num_trajs,
+                    'generation_method': gen_method,
+                    'trajectory_len': traj_len,
+                    'seed': seed,
+                    'delete_after': False
+                }
+                checkpoint()
+                if not runs:
+                    uploaded = first = self.save_to_record(config, cached_data)
+                else:
+                    # Point later records at the first copy of the source file instead of copying it again
+                    uploaded = GenerationConfig.objects.create(
+                        file=first.file.name or None,
+                        cell_size=first.cell_size,
+                        num_trajectories=num_trajs,
+                        trajectory_length=traj_len or None,
+                        generation_method=gen_method,
+                        seed=seed
+                    )
+                on_cancel(discard_record, uploaded)
+                new_trajs = sentences_to_trajs(generated, table)
+                runs.append({
+                    'id': uploaded.id,
+                    'generated_file': self.save_trajectory(new_trajs.to_frame(), uploaded,
+                                                           output_format=data.get('output_format')),
+                    'generation_method': gen_method,
+                    'num_trajectories': num_trajs,
+                    'trajectory_len': traj_len,
+                    'seed': seed,
+                    'generated': len(new_trajs),
+                    'abandoned': abandoned,
+                    'trajs': new_trajs
+                })
+            stage.rows = len(runs)
+
+        with recorder.stage('visualize', 'Preparing visualization data', 85):
+            visual_data = {
+                'original': traj_to_geojson(sentences),
+                'center': extract_area_center(study_area)
+            }
+            if include_visuals:
+                for run in runs:
+                    run['visualization'] = traj_to_geojson(run['trajs'])
+
+        with recorder.stage('heatmap', 'Preparing heatmap data', 92):
+            sample = max(config[1] for config in configs)
+            bounds = study_area.total_bounds.tolist()
+            heatmap_data = {
+                'original': heatmap_geojson(sentences, study_area, max_trajectories=sample),
+                'center': visual_data['center'],
+                'bounds': [[bounds[1], bounds[0]], [bounds[3], bounds[2]]]
+            }
+            if include_visuals:
+                for run in runs:
+                    run['heatmap'] = heatmap_geojson(run['trajs'], study_area)
+
+        with recorder.stage('fidelity', 'Scoring fidelity of generated trajectories', 96) as stage:
+            for run in runs:
+                run['fidelity'] = fidelity_report(sentences, run['trajs'], cached_data['ngrams'])
+            stage.rows = sum(run['generated'] for run in runs)
+
+        for run in runs:
+            del run['trajs']
+
+        queue.put({
+            'type': 'complete',
+            'message': f'Batch generation of {len(runs)} configurations completed successfully!',
+            'progress': 100,
+            'result': {
+                'visualization': visual_data,
+                'heatmap': heatmap_data,
+                'runs': runs
+            },
+            'metrics': recorder.summary()
+        })
+
+class ImputationView(GenerationConfigView):
+    """
+        A class for filling gaps of uploaded sparse trajectories with cell paths of a cached
+        n-gram model, writing the results to disk batch by batch.
+    """
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request):
+        """Handler of trajectory imputation with live progress updates
+
+        Args:
+            request(rest_framework.request.Request): an object containing a file of gapped
+                trajectories, a cache_file field naming a saved cache, an optional mode of
+                "likely" (default) or "sampled", an optional seed and an optional output_format
+                of "csv", "parquet" or "feather".
+
+        Returns:
+            response(rest.Response): a dict containing task id and server message
+        """
+        data = request.data
+        uploaded_file = data.get('file')
+        cache_file = data.get('cache_file')
+        mode = data.get('mode') or 'likely'
+
+        if not uploaded_file:
+            return Response({"error": "No trajectory file provided"}, status=status.HTTP_400_BAD_REQUEST)
+        if not isinstance(cache_file, str) or not cache_file:
+            return Response({"error": "No cache file provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            format_of(uploaded_file.name)
+            if mode not in IMPUTATION_MODES:
+                raise ValueError(f"mode must be one of {list(IMPUTATION_MODES)}")
+            seed = self._extract_seed(data.get('seed'))
+            output_format = check_format(data.get('output_format'))
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        cache_path = os.path.join(settings.MEDIA_ROOT, "cache", cache_file)
+        if not os.path.exists(cache_path):
+            return Response({"error": f"Cache file {cache_file} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        # Save uploaded file to disk under a unique name
+        upload_dir = os.path.join(settings.MEDIA_ROOT, "cache", "uploaded")
+        os.makedirs(upload_dir, exist_ok=True)
+        file_path = os.path.join(upload_dir, f"{uuid.uuid4().hex}_{os.path.basename(uploaded_file.name)}")
+        with open(file_path, "wb") as out_file:
+            for chunk in uploaded_file.chunks():
+                out_file.write(chunk)
+
+        workers = generation_workers()
+        try:
+            estimate = estimate_imputation_job(cache_path, file_path, batch_rows(), workers)
+            ADMISSION.check(estimate)
+        except AdmissionRejected as e:
+            remove_file(file_path)
+            return Response({"error": str(e)}, status=e.status_code)
+        except Exception as e:
+            remove_file(file_path)
+            return Response({"error": f"Invalid imputation request: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        task_id = str(uuid.uuid4())
+        create_job(task_id, 'imputation')
+        job = {'cache_file': cache_file, 'mode': mode, 'seed': seed, 'output_format': output_format,
+               'expected_rows': estimate.features['num_trajectories']}
+        thread = threading.Thread(
+            target=self._process_imputation_with_progress,
+            args=(job, file_path, task_id, estimate, workers)
+        )
+        thread.daemon = True
+        thread.start()
+
+        return Response({
+            "task_id": task_id,
+            "message": "Imputation started"
+        }, status=status.HTTP_202_ACCEPTED)
+
+    def _process_imputation_with_progress(self, data, file_path, task_id, estimate, workers):
+        """Send live progress updates while an imputation job runs under its memory reservation.
+
+        Args:
+            data(dict): name of cache file, imputation mode, seed, output format and the
+                estimated number of trajectories
+            file_path(str): path of uploaded file of gapped trajectories
+            task_id(str): a unique identifier for frontend to track backend updates
+            estimate(admission.JobEstimate): predicted peak memory reserved while the job runs
+            workers(int): number of imputation worker processes
+        """
+        try:
+            queue = progress_queue(task_id)
+            with cancellable(task_id, job_timeout('impute')), admitted(estimate, task_id, queue):
+                self._run_imputation(data, file_path, queue, workers)
+        except JobCancelled as e:
+            publish_cancelled(task_id, e)
+        except Exception as e:
+            progress_queue(task_id).put({
+                'type': 'error',
+                'message': f'Error during imputation: {str(e)}'
+            })
+        finally:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def _run_imputation(self, data, file_path, queue, workers):
+        """Impute every trajectory of an uploaded file and publish the output file and statistics."""
+        recorder = StageRecorder(queue)
+
+        with recorder.stage('load_cache', 'Loading cached data', 10) as stage:
+            cached_data = self._process_cache(data)
+            imputer = Imputer.from_cache(cached_data, mode=data['mode'])
+            stage.rows = imputer.graph.num_edges
+
+        filename = output_filename(f"imputed_trajectories_{uuid.uuid4()}", data['output_format'])
+        subdir = os.path.join(settings.MEDIA_ROOT, "imputed")
+        os.makedirs(subdir, exist_ok=True)
+        output_path = os.path.join(subdir, filename)
+        on_cancel(discard_output, output_path)
+
+        def report(totals):
+            queue.put({
+                'type': 'progress',
+                'message': f"Imputed {totals['trajectories']} trajectories, filled "
+                           f"{totals['filledGaps']} of {totals['gaps']} gaps",
+                'progress': 20 + int(70 * min(totals['trajectories'] / max(data['expected_rows'], 1), 1))
+            })
+
+        with recorder.stage('impute', 'Imputing trajectories', 20) as stage:
+            stats = run_imputation(imputer, file_path, output_path, data['seed'], on_progress=report, workers=workers)
+            stage.rows = stats['trajectories']
+            stage.points = stats['points'] + stats['imputedPoints']
+        register_download(output_path)
+
+        queue.put({
+            'type': 'complete',
+            'message': 'Trajectory imputation completed successfully!',
+            'progress': 100,
+            'result': {
+                'imputed_file': filename,
+                'stats': stats,
+                'mode': data['mode'],
+                'seed': data['seed']
+            },
+            'metrics': recorder.summary()
+        })
+
 class NgramGenerationView(APIView):
     parser_classes = [MultiPartParser, FormParser]
 
@@ -422,6 +859,11 @@ class NgramGenerationView(APIView):
         uploaded_file = data['file']
         file_name = uploaded_file.name
 
+        try:
+            format_of(file_name)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         # Save uploaded file to disk 
         cache_dir = os.path.join(settings.MEDIA_ROOT, "cache", "uploaded")
         os.makedirs(cache_dir, exist_ok=True)
@@ -432,13 +874,26 @@ class NgramGenerationView(APIView):
             for chunk in uploaded_file.chunks():
                 out_file.write(chunk)
 
+        # Refuse uploads whose n-gram build can't fit into the memory budget
+        try:
+            rows = chunk_rows() if use_chunked_ingest(data, file_path) else None
+            estimate = estimate_ngram_job(file_path, int(data['cell_size']), rows)
+            ADMISSION.check(estimate)
+        except AdmissionRejected as e:
+            remove_file(file_path)
+            return Response({"error": str(e)}, status=e.status_code)
+        except (KeyError, ValueError) as e:
+            remove_file(file_path)
+            return Response({"error": f"Invalid cell size: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
         # A unique identifier for client to track progress
         task_id = str(uuid.uuid4())
+        create_job(task_id, 'ngram')
 
         # Start processing in backend thread
         thread = threading.Thread(
             target=self._process_with_progress,
-            args=(data, task_id, file_path, file_name)
+            args=(data, task_id, file_path, file_name, estimate)
         )
 
         # Allows main process to exit without waiting
@@ -450,7 +905,7 @@ class NgramGenerationView(APIView):
             "message": "Processing started"
         }, status=status.HTTP_202_ACCEPTED)
     
-    def _process_with_progress(self, data, task_id, uploaded_file_path, uploaded_file_name):
+    def _process_with_progress(self, data, task_id, uploaded_file_path, uploaded_file_name, estimate):
         """Send live progress updates while orchestrating operations involved in ngram creation.
 
         Args:
@@ -458,129 +913,183 @@ class NgramGenerationView(APIView):
             task_id(str): a unique identifier for frontend to track progress updates
             uploaded_file_path(str): path of uploaded trajectory file saved in disk
             uploaded_file_name(str): name of saved trajectory file
+            estimate(admission.JobEstimate): predicted peak memory reserved while the job runs
         """
         try:
-            if task_id not in PROGRESS_QUEUES:
-                PROGRESS_QUEUES[task_id] = Queue()
+            queue = progress_queue(task_id)
+            with cancellable(task_id, job_timeout('ngrams')), admitted(estimate, task_id, queue):
+                self._run_ngram_build(data, queue, uploaded_file_path, uploaded_file_name)
+        except JobCancelled as e:
+            publish_cancelled(task_id, e)
+        except Exception as e:
+            progress_queue(task_id).put({
+                'type': 'error',
+                'message': f'Error during processing: {str(e)}'
+            })
 
-            queue = PROGRESS_QUEUES[task_id]
+    def _run_ngram_build(self, data, queue, uploaded_file_path, uploaded_file_name):
+        """Build n-grams from an uploaded file, cache them on disk and publish stats.
 
-            # Send initial response
-            queue.put({
-                'type': 'progress',
-                'message': 'Starting ngram generation',
-                'progress': 10
-            })
-            time.sleep(1)
-
-            cell_size = int(data['cell_size'])
-
-            ngrams, start_end_points, grid, sentence_df, study_area = self._process_to_ngrams(data, queue, uploaded_file_path)
-
-            cached_data = {
-                'ngrams': ngrams,
-                'start_end_points': start_end_points,
-                'grid': grid,
-                'sentence_df': sentence_df,
-                'study_area': study_area,
-                'cell_size': cell_size,
-                'file_path': uploaded_file_path,
-                'file_name': uploaded_file_name,
-                'stats': STATS,
-                'created_at': datetime.now().isoformat()
-            }
+        Args:
+            data(QueryDict): request data containing "cell_size" and "file" fields
+            queue(Queue): queue for storing progress updates
+            uploaded_file_path(str): path of uploaded trajectory file saved in disk
+            uploaded_file_name(str): name of saved trajectory file
+        """
+        recorder = StageRecorder(queue)
 
-            queue.put({
-                'type': 'progress',
-                'message': 'Saving cache file',
-                'progress': 90
-            })
+        # Send initial response
+        queue.put({
+            'type': 'progress',
+            'message': 'Starting ngram generation',
+            'progress': 10
+        })
 
-            filename = f'cache_{cell_size}.pkl'
-            subdir = os.path.join(settings.MEDIA_ROOT, "cache")
-            os.makedirs(subdir, exist_ok=True)
+        cell_size = int(data['cell_size'])
 
+        ngrams, table, sentences, study_area = self._process_to_ngrams(data, recorder, uploaded_file_path)
+
+        with recorder.stage('graph_build', 'Indexing reachability of transition graph', 80) as stage:
+            reachability = ReachabilityIndex.build(TransitionGraph.from_model(ngrams))
+            stage.rows = reachability.num_components
+
+        cached_data = {
+            'format_version': CACHE_FORMAT_VERSION,
+            'ngrams': ngrams,
+            'tokens': table,
+            'sentences': sentences,
+            'reachability': reachability,
+            'study_area': study_area,
+            'cell_size': cell_size,
+            'file_path': uploaded_file_path,
+            'file_name': uploaded_file_name,
+            'stats': STATS,
+            'created_at': datetime.now().isoformat()
+        }
+
+        filename = f'cache_{cell_size}.pkl'
+        subdir = os.path.join(settings.MEDIA_ROOT, "cache")
+        os.makedirs(subdir, exist_ok=True)
+
+        with recorder.stage('save_cache', 'Saving cache file', 90):
             file_path = os.path.join(subdir, filename)
             with open(file_path, "wb") as f:
                 pickle.dump(cached_data, f)
+            register_download(file_path)
 
-            # Send message of completing ngram creation
-            queue.put({
-                'type': 'complete',
-                'message': 'Ngram generation completed successfully!',
-                'progress': 100,
-                'stats': STATS,
-                'cache_file': filename
-            })
-        except Exception as e:
-            if task_id in PROGRESS_QUEUES:
-                PROGRESS_QUEUES[task_id].put({
-                    'type': 'error',
-                    'message': f'Error during processing: {str(e)}'
-                })
+        # Send message of completing ngram creation
+        queue.put({
+            'type': 'complete',
+            'message': 'Ngram generation completed successfully!',
+            'progress': 100,
+            'stats': STATS,
+            'cache_file': filename,
+            'metrics': recorder.summary()
+        })
             
-    def _process_to_ngrams(self, data, queue, uploaded_file_path):
-        """Generate ngram dictionaries with progress updates
+    def _process_to_ngrams(self, data, recorder, uploaded_file_path):
+        """Generate ngram counts with progress updates
+
+        Large files, or requests with "ingest_mode" set to "chunked", are streamed through
+        ingest.build_ngrams_chunked so that the whole dataset never sits in memory.
 
         Args:
-            queue(queue.Queue): thread-safe FIFO queue object for passing info between background 
-                thread and SSE view.
+            recorder(metrics.StageRecorder): stage timer factory bound to the thread-safe FIFO queue
+                used for passing info between background thread and SSE view.
+
+        Returns:
+            tuple: NgramModel, TokenTable of the grid, original trajectories as Sentences and study_area
         """
         global STATS
 
-        queue.put({
-                'type': 'progress',
-                'message': 'Reading trajectory file',
-                'progress': 20
-            })
-        
         cell_size = int(data['cell_size'])
-        df = pd.read_csv(uploaded_file_path)
-        # Convert geometry column to Python list
-        df['geometry'] = df['geometry'].apply(ast.literal_eval)
-        study_area = extract_boundary(df)
-
-        queue.put({
-            'type': 'progress',
-            'message': 'Creating tokens and grid',
-            'progress': 40
-        })
-     
-        TokenCreator = ConvertToToken(df, study_area, cell_size=cell_size)
+        if use_chunked_ingest(data, uploaded_file_path):
+            ngrams, table, sentences, study_area, stats = build_ngrams_chunked(uploaded_file_path, cell_size, recorder)
+            STATS.update(stats)
+            return ngrams, table, sentences, study_area
+
+        with recorder.stage('ingest', 'Reading trajectory file', 20) as stage:
+            # Timestamps aren't needed for n-grams; columnar files skip them on disk
+            df = read_trajectories(uploaded_file_path, columns=['trip_id', 'geometry'])
+            study_area = extract_boundary(df)
+            stage.rows = len(df)
+            stage.points = int(df['geometry'].apply(len).sum())
+
+        with recorder.stage('tokenize', 'Creating tokens and grid', 40) as stage:
+            # Same grid as ConvertToToken; points are placed chunk by chunk, so that a
+            # cancelled job or one out of time stops between two chunks
+            grid_index = GridIndex(study_area, cell_size)
+            table = grid_index.tokens
+            sentences = tokenize_frame(df, grid_index)
+            STATS["cellsCreated"] = grid_index.num_cells
+            STATS["totalPairs"] = int(df['geometry'].apply(len).sum())
+            del df
+            stage.rows = len(sentences)
+            stage.points = STATS["totalPairs"]
+
+        with recorder.stage('ngram_build', 'Generating ngrams', 70) as stage:
+            ngrams = NgramModel.from_sentences(sentences, table.num_cells)
+            STATS["uniqueBigrams"] = ngrams.num_bigrams
+            STATS["uniqueTrigrams"] = ngrams.num_trigrams
+            stage.rows = len(sentences)
+
+        return ngrams, table, sentences, study_area
+
+class CellSizeView(APIView):
+    """
+        A class for recommending a cell size from a dry run over a sample of an upload
+    """
+    parser_classes = [MultiPartParser, FormParser]
 
-        # Capture stdout from create_tokens method
-        f = StringIO()
-        with redirect_stdout(f):
-            grid, sentence_df = TokenCreator.create_tokens()
-        content = f.getvalue()
-        STATS["cellsCreated"] = int(content.strip().split(":")[1])
-        STATS["totalPairs"] = int(df['geometry'].apply(len).sum())
+    def post(self, request):
+        """Predict the n-gram model of candidate cell sizes and recommend one, in a few seconds.
 
-        queue.put({
-            'type': 'progress',
-            'message': 'Generating ngrams',
-            'progress': 70
-        })
+        Args:
+            request(rest_framework.request.Request): a "file" of trajectories, optional
+                comma-separated "candidates" in meters and an "ingest_mode" as for n-gram building
 
-        ngram_model = NgramGenerator(sentence_df)
+        Returns:
+            rest_framework.response.Response: sample, dataset size, per-candidate predictions,
+                the recommended cell size and the reason for it
+        """
+        data = request.data
+        uploaded_file = data.get('file')
+        if uploaded_file is None:
+            return Response({"error": "No trajectory file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Capture stdout from create_ngrams method
-        f.seek(0)
-        with redirect_stdout(f):
-            ngrams, start_end_points = ngram_model.create_ngrams()
-        content = f.getvalue()
-        STATS["uniqueBigrams"] = int(content.split("\n")[1].split(":")[1])
-        STATS["uniqueTrigrams"] = int(content.split("\n")[2].split(":")[1])
+        try:
+            format_of(uploaded_file.name)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        candidates = None
+        if data.get('candidates'):
+            invalid = Response({"error": "Candidates must be comma-separated positive cell sizes in meters"},
+                               status=status.HTTP_400_BAD_REQUEST)
+            try:
+                candidates = [int(size) for size in str(data['candidates']).split(',')]
+            except ValueError:
+                return invalid
+            if min(candidates) <= 0:
+                return invalid
 
-        queue.put({
-            'type': 'progress',
-            'message': 'Ngrams generation completed',
-            'progress': 85
-        })
-        time.sleep(1)
+        # The dry run only reads a sample, so the upload is dropped right after it
+        cache_dir = os.path.join(settings.MEDIA_ROOT, "cache", "uploaded")
+        os.makedirs(cache_dir, exist_ok=True)
+        file_path = os.path.join(cache_dir, f"temp_{uuid.uuid4()}_{os.path.basename(uploaded_file.name)}")
+        try:
+            with open(file_path, "wb") as out_file:
+                for chunk in uploaded_file.chunks():
+                    out_file.write(chunk)
+            result = dry_run(file_path, candidates, chunked=use_chunked_ingest(data, file_path))
+        except read_errors() as e:
+            return Response({"error": str(e) or "Trajectory file could not be read"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            remove_file(file_path)
+
+        return Response(result, status=status.HTTP_200_OK)
 
-        return ngrams, start_end_points, grid, sentence_df, study_area
-    
 class Trajectory3DView(APIView):
     """
         A class for handling frontend request that renders 3D visualization 
@@ -588,6 +1097,7 @@ class Trajectory3DView(APIView):
     """
     def get(self, request):
         # TODO: replace demo file with dynamically generated file
+        import pandas as pd
         file_path = os.path.join(settings.MEDIA_ROOT, 'demo.csv')
         df = pd.read_csv(file_path)
         processed_data = self.prepare_3d_data(df)
@@ -646,86 +1156,252 @@ class Trajectory3DView(APIView):
 
 class MapMatchingView(APIView):
     """
-        A class for mapping trajectory trip to actual road network
+        A class for mapping trajectory trip to actual road network as a background job,
+        streaming matched features and writing them to disk batch by batch.
     """
     def post(self, request):
+        """Handler of map matching with live progress updates
+
+        Args:
+            request(rest_framework.request.Request): an object containing a filename of
+                generated trajectories, an optional percentage of them to match, an optional
+                output_format and an optional road "network" file or name of one
+
+        Returns:
+            response(rest.Response): a dict containing task id and server message
+        """
         # Get file name from request
         file_name = request.data.get('filename')
-        percentage = request.data.get('percentage', 1.0)
 
         if not file_name:
             return Response({"Error": "No file name provided"}, status=status.HTTP_400_BAD_REQUEST)
-        
+
         # Get full file path
         file_path = os.path.join(settings.MEDIA_ROOT, "generated", file_name)
 
-        if not os.path.exists(file_path):
+        if not is_safe_name(file_name) or not os.path.exists(file_path):
             return Response({"Error": f"File {file_path} not found"}, status=status.HTTP_404_NOT_FOUND)
-        
+
+        try:
+            percentage = float(request.data.get('percentage', 1.0))
+            if not 0 < percentage <= 100:
+                raise ValueError("percentage must be within (0, 100]")
+            output_format = check_format(request.data.get('output_format'))
+            network_name = self.network_name(request)
+        except (TypeError, ValueError) as e:
+            return Response({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        network_path = os.path.join(network_dir(), network_name) if network_name else None
+        if network_path and not os.path.exists(network_path):
+            return Response({"Error": f"Road network {network_name} not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        workers = generation_workers()
         try:
-            matched_trajs = []
-            df = pd.read_csv(file_path)
-            df['geometry'] = df['geometry'].apply(ast.literal_eval)
-            sub_df = df.sample(frac=percentage/100, random_state=404)
-
-            for _, row in sub_df.iterrows():
-                traj = row['geometry']
-
-                # Convert trajectory into OSRM-complaint format
-                traj_trip = []
-                for coord in traj:
-                    traj_trip.append(f"{coord[0]},{coord[1]}")
-                osrm_str = ";".join(traj_trip)
-                osrm_url = "http://router.project-osrm.org/match/v1/driving/"
-                full_url = f"{osrm_url}{osrm_str}?overview=full&annotations=true&geometries=geojson"
-
-                # Make request to OSRM
-                response = requests.get(full_url, timeout=10)
-
-                if response.status_code == 200:
-                    matched_data = response.json()
-
-                    if 'matchings' in matched_data and matched_data['matchings']:
-                        matching = matched_data['matchings'][0]
-
-                        # Create GeoJSON feature for frontend
-                        matched_feature = {
-                            'type': 'Feature',
-                            'properties': {
-                                'trip_id': row['trip_id'],
-                                'confidence': matching.get('confidence', 0),
-                                'distance': matching.get('distance', 0),
-                                'duration': matching.get('duration', 0)
-                            },
-                            'geometry': matching['geometry']
-                        }
-                        matched_trajs.append(matched_feature)
-
-            matched_filename = self.save_matched_trajs(matched_trajs)
-            map_data = {'type': 'FeatureCollection', 'features': matched_trajs}
+            estimate = estimate_map_matching_job(file_path, network_path, workers)
+            ADMISSION.check(estimate)
+        except AdmissionRejected as e:
+            return Response({"Error": str(e)}, status=e.status_code)
 
-            return Response({
-                'map_data': map_data,
-                'output_file': matched_filename
-            }, status=status.HTTP_200_OK)
-        except Exception as e:
-            return Response({"Error": f"Failed to process {file_name}: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+        task_id = str(uuid.uuid4())
+        create_job(task_id, 'map_matching')
+        job = {'filename': file_name, 'percentage': percentage, 'output_format': output_format,
+               'network': network_name}
+        thread = threading.Thread(
+            target=self._process_matching_with_progress,
+            args=(job, file_path, task_id, estimate, workers)
+        )
+        thread.daemon = True
+        thread.start()
+
+        return Response({
+            "task_id": task_id,
+            "message": "Map matching started"
+        }, status=status.HTTP_202_ACCEPTED)
 
-    def save_matched_trajs(self, matched_data, save_dir="matched"):
+    def network_name(self, request):
         """
-            Save trajectories snapped to actual roads in a csv file.
+            Return name of the road network file to match against, or None to use OSRM.
 
-            matched_data: GeoJSON feature collection data with matched trajectories and
-                          related attributes
-            save_dir: media sub-folder for saving csv file 
+            An uploaded "network" file is saved to the networks media folder, replacing one
+            of the same name; otherwise "network" names a file already there, falling back
+            to MAP_MATCHING_NETWORK.
         """
-        file_id = uuid.uuid4()
-        out_filename = f'matched_trajectories_{file_id}.csv'
-        subdir = os.path.join(settings.MEDIA_ROOT, save_dir)
+        uploaded = request.FILES.get('network')
+        if uploaded is not None:
+            name = os.path.basename(uploaded.name)
+            network_format(name)
+            os.makedirs(network_dir(), exist_ok=True)
+            temp_path = os.path.join(network_dir(), f".{uuid.uuid4()}.tmp")
+            try:
+                with open(temp_path, "wb") as out_file:
+                    for chunk in uploaded.chunks():
+                        out_file.write(chunk)
+                os.replace(temp_path, os.path.join(network_dir(), name))
+            finally:
+                remove_file(temp_path)
+            return name
 
+        name = request.data.get('network') or getattr(settings, 'MAP_MATCHING_NETWORK', None)
+        if not name:
+            return None
+        if not is_safe_name(name):
+            raise ValueError(f"Invalid road network name: {name}")
+        network_format(name)
+        return name
+
+    def _process_matching_with_progress(self, data, file_path, task_id, estimate, workers):
+        """Send live progress updates while a map matching job runs under its memory reservation.
+
+        Args:
+            data(dict): name of trajectory file, percentage to match, output format and name
+                of road network, None for OSRM
+            file_path(str): path of generated trajectory file
+            task_id(str): a unique identifier for frontend to track backend updates
+            estimate(admission.JobEstimate): predicted peak memory reserved while the job runs
+            workers(int): number of matching worker processes
+        """
+        try:
+            queue = progress_queue(task_id)
+            with cancellable(task_id, job_timeout('map_match')), admitted(estimate, task_id, queue):
+                self._run_matching(data, file_path, queue, workers)
+        except JobCancelled as e:
+            publish_cancelled(task_id, e)
+        except Exception as e:
+            progress_queue(task_id).put({
+                'type': 'error',
+                'message': f"Failed to process {data['filename']}: {str(e)}"
+            })
+
+    def _run_matching(self, data, file_path, queue, workers):
+        """Match a sample of a trajectory file batch by batch, publishing features of each batch.
+
+        Progress events carry the features matched since the previous one under "features",
+        so clients draw them as they arrive; the final event names the output file. It is
+        indexed before that event is sent, so a client that missed progress events can reload
+        every matched trajectory from /trajectories/search.
+        """
+        recorder = StageRecorder(queue)
+
+        with recorder.stage('load_trajectories', 'Reading trajectories', 5) as stage:
+            df = read_trajectories(file_path, columns=['trip_id', 'geometry'])
+            sub_df = df.sample(frac=data['percentage']/100, random_state=404)
+            trips = list(zip(sub_df['trip_id'].tolist(), sub_df['geometry'].tolist()))
+            stage.rows = len(trips)
+            stage.points = points = sum(len(coords) for _, coords in trips)
+
+        matcher = None
+        if data['network']:
+            with recorder.stage('load_network', 'Loading road network', 10) as stage:
+                touch(os.path.join(network_dir(), data['network']))
+                matcher = MapMatcher(load_network(data['network']))
+                stage.rows = matcher.network.num_edges
+
+        filename = output_filename(f"matched_trajectories_{uuid.uuid4()}", data['output_format'])
+        subdir = os.path.join(settings.MEDIA_ROOT, "matched")
         os.makedirs(subdir, exist_ok=True)
-        full_path = os.path.join(subdir, out_filename)
+        output_path = os.path.join(subdir, filename)
+        on_cancel(discard_output, output_path)
+
+        done = matched = 0
+        with recorder.stage('map_match', 'Matching trajectories', 15) as stage:
+            with TrajectoryWriter(output_path) as writer:
+                for size, features in self.iter_matched(trips, matcher, workers):
+                    if features:
+                        writer.write(self.matched_frame(features))
+                    done += size
+                    matched += len(features)
+                    queue.put({
+                        'type': 'progress',
+                        'message': f"Matched {matched} of {done} trajectories",
+                        'progress': 15 + int(80 * done / max(len(trips), 1)),
+                        'features': features
+                    })
+            stage.rows = done
+            stage.points = points
+        if not matched:
+            write_trajectories(self.matched_frame([]), output_path)
+        register_download(output_path)
+        index_saved_file(output_path, 'matched')
+
+        queue.put({
+            'type': 'complete',
+            'message': 'Map matching completed successfully!',
+            'progress': 100,
+            'result': {
+                'output_file': filename,
+                'trajectories': done,
+                'matched': matched,
+                'network': data['network']
+            },
+            'metrics': recorder.summary()
+        })
+
+    def iter_matched(self, trips, matcher, workers):
+        """
+            Yield the number of trajectories of each batch and GeoJSON features matched from it.
+
+            trips: (trip_id, list of [lon, lat] pairs) of each trajectory
+            matcher: MapMatcher of a local road network, None to use OSRM
+            workers: number of worker processes of the local matcher
+        """
+        if matcher is not None:
+            yield from iter_matches(matcher, trips, workers)
+            return
+        rows = matching_batch_rows()
+        for start in range(0, len(trips), rows):
+            batch = trips[start:start + rows]
+            yield len(batch), self.match_trajs(batch)
+
+    def match_trajs(self, trips):
+        """
+            Snap each trajectory to the road network with the public OSRM match service.
+
+            trips: (trip_id, list of [lon, lat] pairs) of each trajectory
+
+            Return a list of GeoJSON features of matched trajectories
+        """
+        import requests
+
+        matched_trajs = []
+        for trip_id, traj in trips:
+            checkpoint()
+
+            # Convert trajectory into OSRM-complaint format
+            traj_trip = []
+            for coord in traj:
+                traj_trip.append(f"{coord[0]},{coord[1]}")
+            osrm_str = ";".join(traj_trip)
+            osrm_url = f"{getattr(settings, 'MAP_MATCHING_OSRM_URL', 'http://router.project-osrm.org')}/match/v1/driving/"
+            full_url = f"{osrm_url}{osrm_str}?overview=full&annotations=true&geometries=geojson"
+
+            # Make request to OSRM
+            response = requests.get(full_url, timeout=10)
+
+            if response.status_code == 200:
+                matched_data = response.json()
+
+                if 'matchings' in matched_data and matched_data['matchings']:
+                    matching = matched_data['matchings'][0]
+
+                    # Create GeoJSON feature for frontend
+                    matched_feature = {
+                        'type': 'Feature',
+                        'properties': {
+                            'trip_id': trip_id,
+                            'confidence': matching.get('confidence', 0),
+                            'distance': matching.get('distance', 0),
+                            'duration': matching.get('duration', 0)
+                        },
+                        'geometry': matching['geometry']
+                    }
+                    matched_trajs.append(matched_feature)
+        return matched_trajs
+
+    def matched_frame(self, matched_data):
+        """
+            Convert matched trajectories to a dataframe of the columns of matched output files.
 
+            matched_data: GeoJSON features with matched trajectories and related attributes
+        """
         csv_data = []
         for feature in matched_data:
             trip_id = feature['properties']['trip_id']
@@ -734,20 +1410,74 @@ class MapMatchingView(APIView):
             duration = feature['properties']['duration']
 
             coords = feature['geometry']['coordinates']
-            geometry_str = str(coords)
 
             csv_data.append({
                 "trip_id": trip_id,
                 "confidence": confidence,
                 "distance": distance,
                 "duration": duration,
-                "geometry": geometry_str
+                "geometry": coords
             })
 
-        df = pd.DataFrame(csv_data)
-        df.to_csv(full_path, index=False)
+        import pandas as pd
+        return pd.DataFrame(csv_data, columns=["trip_id", "confidence", "distance", "duration", "geometry"])
+
+class TrajectorySearchView(APIView):
+    """
+        A class for querying stored generated and matched trajectories by area, time window and dataset
+    """
+    def get(self, request):
+        """Return one page of trajectories matching query parameters.
+
+        Args:
+            request(rest_framework.request.Request): query parameters "bbox" as
+                "min_lon,min_lat,max_lon,max_lat", "start" and "end" as epoch seconds or ISO 8601,
+                "dataset" naming a generated or matched file, "kind", "limit", "after" cursor, and
+                "exact" and "geometry" flags
+
+        Returns:
+            rest_framework.response.Response: "results", "next" cursor and query time in "took_ms"
+        """
+        params = request.query_params
+        try:
+            bbox = None
+            if params.get('bbox'):
+                bbox = [float(value) for value in params['bbox'].split(',')]
+                if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+                    raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+            start = parse_time(params.get('start'))
+            end = parse_time(params.get('end'))
+            limit = int(params.get('limit', 100))
+            after = int(params.get('after', 0))
+        except (TypeError, ValueError) as e:
+            return Response({"error": f"Invalid query: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        dataset = params.get('dataset')
+        if dataset and not is_indexed(dataset):
+            # Files written before the store existed are indexed on first use
+            path = FILE_INDEX.resolve(dataset) if is_safe_name(dataset) else None
+            kind = os.path.basename(os.path.dirname(path)) if path else None
+            if kind not in ('generated', 'matched'):
+                return Response({"error": f"Dataset {dataset} not found"}, status=status.HTTP_404_NOT_FOUND)
+            index_dataset(path, kind)
+
+        started = time.perf_counter()
+        page = search(bbox=bbox, start=start, end=end, dataset=dataset, kind=params.get('kind'),
+                      limit=limit, after=after,
+                      exact=params.get('exact', 'true').lower() != 'false',
+                      include_geometry=params.get('geometry', 'true').lower() != 'false')
+        page['took_ms'] = round((time.perf_counter() - started) * 1000, 2)
+
+        return Response(page, status=status.HTTP_200_OK)
+
+
+class TrajectoryDatasetsView(APIView):
+    """
+        A class for listing files loaded into the trajectory store
+    """
+    def get(self, request):
+        return Response({'datasets': list_datasets()}, status=status.HTTP_200_OK)
 
-        return out_filename
 
 class CacheStatsView(APIView):
     """Extract stats data from a cached ngram file.
@@ -792,20 +1522,27 @@ class ProgressView(View):
             return Response({"error": "No task_id provided"}, status=status.HTTP_400_BAD_REQUEST)
         
         def event_stream():
+            # A client reconnecting after its job ended gets the stored final event
             if task_id not in PROGRESS_QUEUES:
-                PROGRESS_QUEUES[task_id] = Queue()
-            
-            queue = PROGRESS_QUEUES[task_id]
+                event = finished_event(task_id)
+                if event is not None:
+                    yield f"data: {json.dumps(event)}\n\n"
+                    return
+
+            queue = progress_queue(task_id)
 
             try:
                 while True:
                     try:
                         progress_data = queue.get(timeout=30)
 
+                        # The final event is stored, so the queue can go before it's sent
                         if progress_data.get('type') == 'complete':
+                            PROGRESS_QUEUES.pop(task_id, None)
                             yield f"data: {json.dumps(progress_data)}\n\n"
                             break
-                        elif progress_data.get('type') == 'error':
+                        elif progress_data.get('type') in ('error', 'cancelled'):
+                            PROGRESS_QUEUES.pop(task_id, None)
                             yield f"data: {json.dumps(progress_data)}\n\n"
                             break
                         else:
@@ -816,10 +1553,6 @@ class ProgressView(View):
             
             except Exception as e:
                 yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
-            finally:
-                # Clean up queue
-                if task_id in PROGRESS_QUEUES:
-                    del PROGRESS_QUEUES[task_id]
         
         response = StreamingHttpResponse(
             event_stream(),
@@ -831,32 +1564,105 @@ class ProgressView(View):
 
         return response
 
+class CancelJobView(APIView):
+    """
+        A class for stopping a running background job at its next cancellation checkpoint
+    """
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+
+    def post(self, request):
+        """Cancel the job of a task id.
+
+        The job removes its partial output and reports a "cancelled" event to its progress
+        stream once it reaches a checkpoint.
+
+        Args:
+            request(rest_framework.request.Request): an object containing a task_id field
+
+        Returns:
+            response(rest.Response): 202 if the job was asked to stop, 404 if no such job is running
+        """
+        task_id = request.data.get('task_id')
+        if not task_id:
+            return Response({"error": "No task_id provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not CANCELLATION.cancel(task_id):
+            return Response({"error": f"No running job with task_id {task_id}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            "task_id": task_id,
+            "message": "Cancellation requested"
+        }, status=status.HTTP_202_ACCEPTED)
+
+class JobView(APIView):
+    """
+        A class for polling status of a background job and fetching its result after it ended
+    """
+    def get(self, request, task_id):
+        """Return the stored status of a job.
+
+        Records are kept for JOB_RESULT_TTL_SECONDS after a job's last update, so a client
+        that lost its progress stream can fetch the result without running the job again.
+
+        Args:
+            request(rest_framework.request.Request): required for Django view
+            task_id(str): identifier returned when the job was started
+
+        Returns:
+            response(rest.Response): status, progress and latest message of the job, and under
+                "event" the final progress event once it has ended; 404 if unknown or expired
+        """
+        job = job_status(task_id)
+        if job is None:
+            return Response({"error": f"No job with task_id {task_id}"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job, status=status.HTTP_200_OK)
+
 # Function-based view
 def download_files(request, filename):
     """
         Download files from the server
 
         filename: name of file to be downloaded
+
+        Supports conditional GET with ETag or Last-Modified, single byte ranges and gzip
+        or zstd content coding.
     """
-    # Check if files existly directly in root folder
-    full_path = os.path.join(settings.MEDIA_ROOT, filename)
-
-    if not os.path.exists(full_path):
-        # Go to sub-dir if not found in root
-        subdirs = ["generated", "matched", "cache"]
-        for subdir in subdirs:
-            full_path = os.path.join(settings.MEDIA_ROOT, subdir, filename)
-            if os.path.exists(full_path):
-                break
-
-    if os.path.exists(full_path):
-        response = FileResponse(open(full_path, "rb"))
-        response['Content-Disposition'] = f"attachment; filename={filename}"
-        response['Content-Type'] = 'text/csv'
-        return response
-    else:
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponse(f"Request method {request.method} not supported.", status=405)
+
+    full_path = FILE_INDEX.resolve(filename) if is_safe_name(filename) else None
+    if full_path is None:
         return HttpResponse("File not found", status=404)
 
+    touch(full_path)
+    return serve_file(request, full_path, filename)
+
+def metrics(request):
+    """Expose stage timing histograms in Prometheus text format.
+
+    Args:
+        request(django.http.HttpRequest): required for Django view
+
+    Returns:
+        HttpResponse: plain text exposition of all registered histograms
+    """
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def readiness(request):
+    """Report whether this worker has finished warming up, for load balancer health checks.
+
+    Args:
+        request(django.http.HttpRequest): required for Django view
+
+    Returns:
+        JsonResponse: 200 once warm, 503 while warming up or after preloading failed
+    """
+    body = {
+        'status': REGISTRY.state,
+        'models': REGISTRY.loaded(),
+        'errors': REGISTRY.errors
+    }
+    return JsonResponse(body, status=200 if REGISTRY.state == 'ready' else 503)
+
 def rename_cache(request):
     """Rename a cache file in the cache subdir.
 
@@ -898,6 +1704,8 @@ def rename_cache(request):
     
     try:
         shutil.copy2(old_path, new_path)
+        if not os.path.isabs(new_name):
+            register_download(new_path)
         return HttpResponse(f"Moved {old_path} to {new_name}.", status=200)
     except Exception as e:
         return HttpResponse(f"Error renaming file: {str(e)}", status=400)
\ No newline at end of file